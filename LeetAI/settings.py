@@ -16,7 +16,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.environ.get("SECRET_KEY", "dev-insecure-only")
 
 # On Render we set env var RENDER=true; that turns DEBUG off in prod.
-DEBUG = "RENDER" not in os.environ
+# DJANGO_DEBUG=true/false overrides it (e.g. production-like local benchmarks).
+DEBUG = os.environ.get("DJANGO_DEBUG", str("RENDER" not in os.environ)).lower() in ("1", "true", "yes")
 
 ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
 RENDER_EXTERNAL_HOSTNAME = os.environ.get("RENDER_EXTERNAL_HOSTNAME")
@@ -59,6 +60,8 @@ TAILWIND_APP_NAME = "theme"
 # NPM_BIN_PATH = "/opt/homebrew/bin/npm"  # or "/usr/local/bin/npm" on Intel Macs
 
 MIDDLEWARE = [
+    "chatbot.middleware.MetricsMiddleware",  # first, so it times the whole stack
+    "chatbot.middleware.ProfilingMiddleware",  # before sessions, so their load/save is profiled
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",  # must be right after SecurityMiddleware
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -96,7 +99,7 @@ WSGI_APPLICATION = "LeetAI.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",  # fine for simple deploys
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.environ.get("SQLITE_PATH") or BASE_DIR / "db.sqlite3",
     }
 }
 
@@ -106,6 +109,63 @@ if dj_database_url:
     if cfg:
         DATABASES["default"].update(cfg)
 
+# ------------------------------------------------------------------------------
+# Caches
+# ------------------------------------------------------------------------------
+CACHE_BACKENDS = {
+    "locmem": "django.core.cache.backends.locmem.LocMemCache",  # per-process, LRU
+    "file": "django.core.cache.backends.filebased.FileBasedCache",  # shared by workers on one host
+    "db": "django.core.cache.backends.db.DatabaseCache",  # shared; needs `manage.py createcachetable`
+}
+
+
+def cache_config(kind, name, timeout, max_entries):
+    kind = kind if kind in CACHE_BACKENDS else "locmem"
+    location = {
+        "locmem": name,
+        "file": str(BASE_DIR / ".cache" / name),
+        "db": f"cache_{name}",
+    }[kind]
+    return {
+        "BACKEND": CACHE_BACKENDS[kind],
+        "LOCATION": location,
+        "TIMEOUT": timeout,
+        "OPTIONS": {"MAX_ENTRIES": max_entries},
+    }
+
+
+CACHES = {
+    # Also holds what workers share: routing stats, rate-limit buckets, single-flight locks,
+    # job partial text and Stop signals. With more than one process use CACHE_BACKEND=db
+    # (or file, on one host); with locmem each worker keeps its own.
+    "default": cache_config(os.environ.get("CACHE_BACKEND", "locmem"), "default", 300, 10000),
+    # Completion cache for repeated prompts (see chatbot/completion_cache.py); "off" disables it
+    "completions": cache_config(
+        os.environ.get("LLM_CACHE_BACKEND", "locmem"),
+        "completions",
+        int(os.environ.get("LLM_CACHE_TTL", "3600")),
+        int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "1000")),
+    ),
+    # Rendered Markdown of assistant replies, keyed by content hash (see chatbot/rendering.py)
+    "rendered": cache_config(
+        os.environ.get("RENDER_CACHE_BACKEND", "locmem"),
+        "rendered",
+        int(os.environ.get("RENDER_CACHE_TTL", "86400")),
+        int(os.environ.get("RENDER_CACHE_MAX_ENTRIES", "5000")),
+    ),
+    # Rendered sidebar/message-list HTML of the chat page, keyed by version (see chatbot/fragments.py)
+    "fragments": cache_config(
+        os.environ.get("FRAGMENT_CACHE_BACKEND", "locmem"),
+        "fragments",
+        int(os.environ.get("FRAGMENT_CACHE_TTL", "3600")),
+        int(os.environ.get("FRAGMENT_CACHE_MAX_ENTRIES", "2000")),
+    ),
+}
+FRAGMENT_CACHE_ENABLED = os.environ.get("FRAGMENT_CACHE_BACKEND", "locmem").lower() != "off"
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_BACKEND", "locmem").lower() != "off"
+# How many trailing transcript messages take part in the cache key
+LLM_CACHE_WINDOW = int(os.environ.get("LLM_CACHE_WINDOW", "3"))
+
 # ------------------------------------------------------------------------------
 # Internationalization
 # ------------------------------------------------------------------------------
@@ -124,7 +184,16 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 static_candidates = [BASE_DIR / "static", BASE_DIR / "chatbot" / "static"]
 STATICFILES_DIRS = [p for p in static_candidates if p.exists()]
 
-STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+# Hashed, compressed copies from collectstatic; WhiteNoise serves files with a content
+# hash in the name as "max-age=315360000, public, immutable" (others get WHITENOISE_MAX_AGE).
+# (STATICFILES_STORAGE is ignored since Django 5.1, so this has to go through STORAGES.)
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+}
+# Fall back to the unhashed URL (short max-age) instead of a 500 when a file is missing
+# from the manifest, e.g. before collectstatic has run
+WHITENOISE_MANIFEST_STRICT = False
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
@@ -160,6 +229,141 @@ GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
 DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY")
 
+# Failover: providers tried after LLM_PROVIDER on timeouts, 429 and 5xx (comma-separated)
+LLM_FALLBACK_PROVIDERS = [p.strip().lower() for p in os.environ.get("LLM_FALLBACK_PROVIDERS", "").split(",") if p.strip()]
+# Hedging: race the next provider when the first has not answered within its recent p95
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_DEFAULT_DELAY = float(os.environ.get("LLM_HEDGE_DEFAULT_DELAY", "5"))  # until enough samples
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "1"))
+# Circuit breaker per provider: open after N consecutive failures, probe again after RESET seconds
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+
+# Routing: "static" keeps the order above; "adaptive" orders providers by live stats
+# (EWMA latency, error rate) plus LLM_ROUTING_COST_WEIGHT seconds per $/1M output tokens.
+LLM_ROUTING = os.environ.get("LLM_ROUTING", "static").lower()
+LLM_ROUTING_COST_WEIGHT = float(os.environ.get("LLM_ROUTING_COST_WEIGHT", "0"))
+LLM_ROUTING_ALPHA = float(os.environ.get("LLM_ROUTING_ALPHA", "0.2"))
+LLM_ROUTING_PRIOR_LATENCY = float(os.environ.get("LLM_ROUTING_PRIOR_LATENCY", "3"))
+LLM_ROUTING_EXPLORE = float(os.environ.get("LLM_ROUTING_EXPLORE", "0.05"))  # share of requests sent to a non-best provider
+
+# Coalesce identical in-flight prompts into one upstream call (across workers with a shared CACHE_BACKEND)
+LLM_SINGLE_FLIGHT = os.environ.get("LLM_SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+
+# Background generation: ask/ enqueues a Job and answers 202; `manage.py llm_worker` runs it
+LLM_JOB_QUEUE = os.environ.get("LLM_JOB_QUEUE", "false").lower() in ("1", "true", "yes")
+LLM_JOB_CONCURRENCY = int(os.environ.get("LLM_JOB_CONCURRENCY", "4"))  # running jobs per provider, all workers
+LLM_JOB_POLL = float(os.environ.get("LLM_JOB_POLL", "0.5"))  # worker sleep when the queue is empty
+LLM_JOB_WAIT = float(os.environ.get("LLM_JOB_WAIT", "25"))  # longest long-poll on jobs/<id>/?wait=
+LLM_JOB_MAX_ATTEMPTS = int(os.environ.get("LLM_JOB_MAX_ATTEMPTS", "2"))  # tries for jobs whose worker died
+
+# Rate limiting: token buckets per user (session) and per provider (see chatbot/ratelimit.py).
+# "wait" queues a request until its buckets refill (up to MAX_WAIT seconds); "reject" answers 429 at once.
+LLM_RATE_LIMIT = os.environ.get("LLM_RATE_LIMIT", "true").lower() in ("1", "true", "yes")
+LLM_RATE_LIMIT_MODE = os.environ.get("LLM_RATE_LIMIT_MODE", "wait").lower()
+LLM_RATE_LIMIT_MAX_WAIT = float(os.environ.get("LLM_RATE_LIMIT_MAX_WAIT", "10"))
+LLM_USER_RPM = int(os.environ.get("LLM_USER_RPM", "20"))
+LLM_USER_TPM = int(os.environ.get("LLM_USER_TPM", "20000"))
+# Override the catalog's per-provider limits, e.g. "groq=30/6000,openai=5000/800000" (0 = unlimited)
+LLM_PROVIDER_LIMITS = {
+    name.strip().lower(): tuple(int(n) for n in limits.split("/", 1))
+    for name, limits in (
+        item.split("=", 1) for item in os.environ.get("LLM_PROVIDER_LIMITS", "").split(",") if "=" in item
+    )
+}
+
+# Prompt assembly: newest messages are packed into this many tokens (see chatbot/context.py)
+LLM_CONTEXT_BUDGET = int(os.environ.get("LLM_CONTEXT_BUDGET", "6000"))
+# Longest reply asked of a provider (max_tokens), kept free for it within the model's context
+# window; a call asks for less when the prompt or the deadline leaves less room
+LLM_MAX_OUTPUT_TOKENS = int(os.environ.get("LLM_MAX_OUTPUT_TOKENS", "2048"))
+# When the budget cuts the history, move the window start in steps of this many messages
+# so consecutive turns share a prefix for providers' prompt caches (1 = slide every turn)
+LLM_CONTEXT_ALIGN = int(os.environ.get("LLM_CONTEXT_ALIGN", "8"))
+
+# Gemini explicit context caching (see chatbot/prompt_cache.py): store a conversation's prefix
+# as cachedContents once it has grown by MIN_TOKENS; billed per token-hour while it lives
+LLM_GEMINI_CONTEXT_CACHE = os.environ.get("LLM_GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+LLM_GEMINI_CACHE_MIN_TOKENS = int(os.environ.get("LLM_GEMINI_CACHE_MIN_TOKENS", "4096"))
+LLM_GEMINI_CACHE_TTL = int(os.environ.get("LLM_GEMINI_CACHE_TTL", "600"))  # seconds
+
+# Optional rolling summary of messages that no longer fit the budget (see chatbot/summary.py)
+LLM_SUMMARY_ENABLED = os.environ.get("LLM_SUMMARY_ENABLED", "false").lower() in ("1", "true", "yes")
+# Summarize once at least this many messages have fallen out of the window
+LLM_SUMMARY_BATCH = int(os.environ.get("LLM_SUMMARY_BATCH", "4"))
+
+# Retrieval (see chatbot/retrieval.py): snippets from a local problem/editorial index, built
+# with `manage.py llm_index`, are added to the prompt; a no-op until the index exists
+LLM_RAG = os.environ.get("LLM_RAG", "true").lower() in ("1", "true", "yes")
+LLM_RAG_INDEX_DIR = os.environ.get("LLM_RAG_INDEX_DIR") or BASE_DIR / ".cache" / "rag"
+LLM_RAG_TOP_K = int(os.environ.get("LLM_RAG_TOP_K", "3"))
+LLM_RAG_MIN_SCORE = float(os.environ.get("LLM_RAG_MIN_SCORE", "0.15"))  # cosine similarity
+LLM_RAG_MAX_TOKENS = int(os.environ.get("LLM_RAG_MAX_TOKENS", "600"))
+LLM_RAG_NPROBE = int(os.environ.get("LLM_RAG_NPROBE", "8"))  # IVF lists scanned per query
+
+# Solution sandbox (see chatbot/sandbox.py): `analyze/` runs pasted Python solutions in a
+# pool of resource-limited worker processes and reports their empirical complexity
+LLM_SANDBOX = os.environ.get("LLM_SANDBOX", "false").lower() in ("1", "true", "yes")
+LLM_SANDBOX_WORKERS = int(os.environ.get("LLM_SANDBOX_WORKERS", "2"))  # per web process
+LLM_SANDBOX_TIMEOUT = float(os.environ.get("LLM_SANDBOX_TIMEOUT", "10"))  # wall seconds per run
+LLM_SANDBOX_QUEUE_WAIT = float(os.environ.get("LLM_SANDBOX_QUEUE_WAIT", "5"))  # for an idle worker
+LLM_SANDBOX_MAX_CALL_SECONDS = float(os.environ.get("LLM_SANDBOX_MAX_CALL_SECONDS", "1"))
+LLM_SANDBOX_MAX_N = int(os.environ.get("LLM_SANDBOX_MAX_N", str(1 << 17)))
+LLM_SANDBOX_MEMORY_MB = int(os.environ.get("LLM_SANDBOX_MEMORY_MB", "256"))  # address space per worker
+LLM_SANDBOX_MAX_JOBS = int(os.environ.get("LLM_SANDBOX_MAX_JOBS", "50"))  # runs before a worker is recycled
+
+# Upstream HTTP: one pooled httpx client per provider (see chatbot/clients.py)
+# Send every provider's requests to this scheme://host[:port] instead, keeping the
+# path (e.g. the local mock from `manage.py llm_mock`)
+LLM_UPSTREAM_ORIGIN = os.environ.get("LLM_UPSTREAM_ORIGIN", "").rstrip("/")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+
+# Deadline budget per chat request (see chatbot/deadlines.py): every upstream call must end
+# within LLM_REQUEST_DEADLINE seconds of the request arriving, below gunicorn's default 30s
+# worker timeout. max_tokens is sized from each provider's observed speed (or the priors
+# below until there are samples) and capped at LLM_MAX_OUTPUT_TOKENS; no call starts when
+# fewer than LLM_MIN_TOKENS would fit. LLM_DEADLINE_MARGIN is kept back for storing and
+# rendering the reply.
+LLM_REQUEST_DEADLINE = float(os.environ.get("LLM_REQUEST_DEADLINE", "25"))
+LLM_DEADLINE_MARGIN = float(os.environ.get("LLM_DEADLINE_MARGIN", "2"))
+LLM_DEADLINE_PRIOR_TTFT = float(os.environ.get("LLM_DEADLINE_PRIOR_TTFT", "1.5"))
+LLM_DEADLINE_PRIOR_TOKENS_PER_SEC = float(os.environ.get("LLM_DEADLINE_PRIOR_TOKENS_PER_SEC", "40"))
+LLM_MIN_TOKENS = int(os.environ.get("LLM_MIN_TOKENS", "64"))
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "true").lower() in ("1", "true", "yes")
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "200"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "40"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# History pages: messages and sidebar conversations per page; older ones load on scroll
+CHAT_PAGE_SIZE = int(os.environ.get("CHAT_PAGE_SIZE", "30"))
+CHAT_SIDEBAR_PAGE_SIZE = int(os.environ.get("CHAT_SIDEBAR_PAGE_SIZE", "30"))
+
+# Serve ask/ and ask/stream/ with the async views (run under LeetAI.asgi + uvicorn workers)
+LLM_ASYNC_VIEWS = os.environ.get("LLM_ASYNC_VIEWS", "false").lower() in ("1", "true", "yes")
+
+# ------------------------------------------------------------------------------
+# Metrics (Prometheus, see chatbot/metrics.py)
+# ------------------------------------------------------------------------------
+# Recorded when prometheus_client is installed; scraped at /metrics.
+# Under gunicorn also set PROMETHEUS_MULTIPROC_DIR so all workers are aggregated.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>"; unset, it is served only with DEBUG
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# Database sessions with load/save timings
+SESSION_ENGINE = "chatbot.sessions"
+
+# Request profiles (see chatbot/profiling.py): staff add ?profile=1 (or X-Profile: 1) to a
+# request, or PROFILE_SAMPLE_RATE of all requests are profiled; listed at /admin/profiles/.
+# Without a staff session, ?profile=1 needs "X-Profile-Token: <PROFILE_TOKEN>" (unset: staff only).
+PROFILING = os.environ.get("PROFILING", "false").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))  # seconds between stack samples
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or BASE_DIR / ".cache" / "profiles"
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "200"))  # oldest are deleted
+PROFILE_MAX_PER_MINUTE = int(os.environ.get("PROFILE_MAX_PER_MINUTE", "30"))  # the rest are not profiled
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+
 # ------------------------------------------------------------------------------
 # Logging (surface errors in Render logs)
 # ------------------------------------------------------------------------------
@@ -177,5 +381,7 @@ LOGGING = {
     "loggers": {
         "django": {"handlers": ["console"], "level": LOG_LEVEL, "propagate": True},
         "chatbot": {"handlers": ["console"], "level": LOG_LEVEL, "propagate": True},
+        # Traces every block rule at DEBUG
+        "markdown_it": {"level": "INFO"},
     },
 }
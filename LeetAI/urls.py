@@ -2,9 +2,15 @@ from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import RedirectView
 
+from chatbot.views import metrics_endpoint, profile_detail, profile_list
+
 urlpatterns = [
+    # Request profiles (chatbot/profiling.py), staff only; before admin/ so the admin does not claim them
+    path("admin/profiles/", admin.site.admin_view(profile_list), name="profiles"),
+    path("admin/profiles/<str:profile_id>/", admin.site.admin_view(profile_detail), name="profile"),
     path("admin/", admin.site.urls),
     path("chatbot/", include(("chatbot.urls", "chatbot"), namespace="chatbot")),
+    path("metrics", metrics_endpoint, name="metrics"),  # Prometheus scrape target
     # Optional: make chatbot the homepage
     path("", RedirectView.as_view(pattern_name="chatbot:chatbot_home", permanent=False)),
 ]
@@ -1,3 +1,32 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Conversation, Job, Message
+
+
+class MessageInline(admin.TabularInline):
+    model = Message
+    extra = 0
+    fields = ("seq", "role", "content", "created_at")
+    readonly_fields = ("created_at",)
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ("title", "owner", "message_count", "updated_at")
+    search_fields = ("title", "owner")
+    inlines = [MessageInline]
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ("conversation", "seq", "role", "created_at")
+    list_filter = ("role",)
+    raw_id_fields = ("conversation",)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "provider", "status", "attempts", "worker", "created_at", "finished_at")
+    list_filter = ("status", "provider")
+    raw_id_fields = ("conversation",)
+    readonly_fields = ("created_at", "started_at", "finished_at")
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def _repair_search_index(sender, using, **kwargs):
+    # A table remake in a later migration drops the search triggers on SQLite (see search.py)
+    from .search import repair_index
+
+    repair_index(using)
 
 
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
+
+    def ready(self):
+        post_migrate.connect(_repair_search_index, sender=self)
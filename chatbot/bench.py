@@ -0,0 +1,295 @@
+"""Offline load tests: the app under gunicorn (WSGI or ASGI) against the mock LLM.
+
+``manage.py llm_bench`` starts ``manage.py llm_mock`` and one gunicorn server
+per target in subprocesses, with a throwaway SQLite database and production
+settings (DJANGO_DEBUG=false), then drives each scenario with concurrent
+virtual users. Every user keeps its own session cookie, as a browser would.
+
+Scenarios:
+  new_chat           each user opens a new conversation before every message
+  long_conversation  each user keeps sending to one growing conversation
+  burst              all users send at the same instant, in rounds
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from django.conf import settings
+
+from . import providers, rendering, routing
+
+SCENARIOS = ("new_chat", "long_conversation", "burst")
+TARGETS = ("wsgi", "asgi")
+ERROR_REPLIES = (providers.TIMEOUT_REPLY, providers.CONNECT_ERROR_REPLY, routing.NO_PROVIDER_REPLY, routing.ERROR_REPLY)
+ERROR_HTML = tuple(rendering.render_markdown(reply) for reply in ERROR_REPLIES)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+# --------- Processes ----------
+def _wait_ready(url, proc, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args[0]} exited with {proc.returncode} before becoming ready")
+        try:
+            if httpx.get(url, timeout=1.0, headers={"X-Forwarded-Proto": "https"}).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+def _stop(proc):
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+def start_mock(options, log):
+    port = free_port()
+    cmd = [
+        sys.executable, "manage.py", "llm_mock", "--port", str(port),
+        "--latency", str(options["latency"]), "--tokens-per-sec", str(options["tokens_per_sec"]),
+        "--reply-tokens", str(options["reply_tokens"]), "--error-rate", str(options["error_rate"]),
+    ]
+    proc = subprocess.Popen(cmd, cwd=settings.BASE_DIR, stdout=log, stderr=log)
+    _wait_ready(f"http://127.0.0.1:{port}/health", proc)
+    return proc, f"http://127.0.0.1:{port}"
+
+def server_env(workdir: Path, mock_origin: str, provider: str, target: str) -> dict:
+    env = dict(os.environ)
+    env.pop("RENDER", None)
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    env.update({
+        "DJANGO_DEBUG": "false",
+        "SQLITE_PATH": str(workdir / "bench.sqlite3"),
+        "LLM_UPSTREAM_ORIGIN": mock_origin,
+        "LLM_PROVIDER": provider,
+        "LLM_FALLBACK_PROVIDERS": "",
+        providers.PROVIDERS[provider]["key_env"]: "bench-key",
+        "LLM_ASYNC_VIEWS": "true" if target == "asgi" else "false",
+        # Measure the app, not the per-user admission limits
+        "LLM_RATE_LIMIT": "false",
+    })
+    return env
+
+def prepare_database(env, log):
+    for args in (["migrate", "--noinput"], ["createcachetable"], ["collectstatic", "--noinput"]):
+        subprocess.run([sys.executable, "manage.py", *args], cwd=settings.BASE_DIR, env=env,
+                       stdout=log, stderr=log, check=True)
+
+def start_server(target, env, options, log):
+    port = free_port()
+    if target == "asgi":
+        entry = ["LeetAI.asgi:application", "-k", "uvicorn.workers.UvicornWorker"]
+    else:
+        entry = ["LeetAI.wsgi:application", "--threads", str(options["threads"])]
+    cmd = [
+        sys.executable, "-m", "gunicorn", *entry, "--workers", str(options["workers"]),
+        "--bind", f"127.0.0.1:{port}", "--timeout", "120",
+    ]
+    proc = subprocess.Popen(cmd, cwd=settings.BASE_DIR, env=env, stdout=log, stderr=log)
+    _wait_ready(f"http://127.0.0.1:{port}/chatbot/ping/", proc, timeout=60)
+    return proc, f"http://127.0.0.1:{port}"
+
+def worker_memory(master_pid: int) -> dict:
+    """RSS of the gunicorn workers (children of ``master_pid``) in MB; Linux only."""
+    rss, peak = [], []
+    for status in Path("/proc").glob("[0-9]*/status"):
+        try:
+            fields = dict(line.split(":", 1) for line in status.read_text().splitlines() if ":" in line)
+        except OSError:
+            continue
+        if fields.get("PPid", "").strip() != str(master_pid):
+            continue
+        rss.append(int(fields["VmRSS"].split()[0]) / 1024)
+        peak.append(int(fields["VmHWM"].split()[0]) / 1024)
+    if not rss:
+        return {"workers": 0, "rss_mb": None, "peak_rss_mb": None}
+    return {"workers": len(rss), "rss_mb": round(sum(rss) / len(rss), 1), "peak_rss_mb": round(max(peak), 1)}
+
+
+# --------- Virtual users ----------
+class VirtualUser:
+    """One browser session: its own cookies, CSRF token and conversation."""
+
+    def __init__(self, client: httpx.AsyncClient, base_url: str, stream: bool):
+        self.client = client
+        self.base_url = base_url
+        self.stream = stream
+        self.cookies = {}
+
+    def _headers(self, extra=None):
+        # Production settings: HTTPS is assumed behind a proxy, cookies are Secure
+        headers = {"X-Forwarded-Proto": "https", "Origin": self.base_url.replace("http://", "https://")}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        headers.update(extra or {})
+        return headers
+
+    def _keep_cookies(self, response):
+        self.cookies.update(response.cookies)
+
+    async def get(self, path):
+        r = await self.client.get(self.base_url + path, headers=self._headers())
+        self._keep_cookies(r)
+        return r
+
+    async def open(self):
+        await self.get("/chatbot/")
+
+    async def new_chat(self):
+        await self.get("/chatbot/new/")
+
+    async def ask(self, message) -> dict:
+        """Send one message; returns a sample dict (latency, ttft, ok)."""
+        headers = self._headers({
+            "X-Requested-With": "XMLHttpRequest",
+            "X-CSRFToken": self.cookies.get("csrftoken", ""),
+        })
+        body = {"message": message}
+        start = time.perf_counter()
+        ttft = None
+        ok = False
+        try:
+            if self.stream:
+                async with self.client.stream("POST", self.base_url + "/chatbot/ask/stream/", json=body, headers=headers) as r:
+                    self._keep_cookies(r)
+                    event = None
+                    async for line in r.aiter_lines():
+                        if line.startswith("event:"):
+                            event = line[6:].strip()
+                            if event == "delta" and ttft is None:
+                                ttft = time.perf_counter() - start
+                    ok = r.status_code == 200 and event == "done"
+            else:
+                r = await self.client.post(self.base_url + "/chatbot/ask/", json=body, headers=headers)
+                self._keep_cookies(r)
+                reply = r.json().get("reply_html", "") if r.status_code == 200 else ""
+                ok = bool(reply) and not reply.startswith("<p>Upstream error") and reply not in ERROR_HTML
+        except (httpx.HTTPError, ValueError):
+            ok = False
+        return {"latency": time.perf_counter() - start, "ttft": ttft, "ok": ok}
+
+
+async def _new_chat(user, index, options, samples):
+    await user.open()
+    for i in range(options["requests"]):
+        await user.new_chat()
+        samples.append(await user.ask(f"user {index} question {i}: explain two sum"))
+
+async def _long_conversation(user, index, options, samples):
+    await user.open()
+    await user.new_chat()
+    for i in range(options["turns"]):
+        samples.append(await user.ask(f"user {index} turn {i}: and what about the edge cases?"))
+
+async def _burst(users, options, samples):
+    await asyncio.gather(*(u.open() for u in users))
+    for rnd in range(options["rounds"]):
+        results = await asyncio.gather(*(u.ask(f"user {i} burst {rnd}: explain two sum") for i, u in enumerate(users)))
+        samples.extend(results)
+
+async def run_scenario(scenario, base_url, options) -> dict:
+    limits = httpx.Limits(max_connections=options["users"] * 2, max_keepalive_connections=options["users"])
+    timeout = httpx.Timeout(options["request_timeout"])
+    samples = []
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        users = [VirtualUser(client, base_url, options["stream"]) for _ in range(options["users"])]
+        start = time.perf_counter()
+        if scenario == "burst":
+            await _burst(users, options, samples)
+        else:
+            run_user = _new_chat if scenario == "new_chat" else _long_conversation
+            await asyncio.gather(*(run_user(u, i, options, samples) for i, u in enumerate(users)))
+        elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed)
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def summarize(samples, elapsed) -> dict:
+    latencies = [s["latency"] for s in samples if s["ok"]]
+    ttfts = [s["ttft"] for s in samples if s["ok"] and s["ttft"] is not None]
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if not s["ok"]),
+        "elapsed_s": round(elapsed, 2),
+        "req_per_s": round(len(samples) / elapsed, 2) if elapsed else None,
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+        "ttft_p50_ms": _ms(percentile(ttfts, 50)),
+    }
+
+
+# --------- Driver ----------
+def run(targets, scenarios, options, out=print) -> list[dict]:
+    """Run every scenario against every target; returns one result row per pair."""
+    for name in ("asyncio", "httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="leetai-bench-") as tmp:
+        workdir = Path(tmp)
+        with open(workdir / "processes.log", "w") as log:
+            mock, mock_origin = start_mock(options, log)
+            try:
+                for target in targets:
+                    env = server_env(workdir, mock_origin, options["provider"], target)
+                    prepare_database(env, log)
+                    server, base_url = start_server(target, env, options, log)
+                    try:
+                        for scenario in scenarios:
+                            result = asyncio.run(run_scenario(scenario, base_url, options))
+                            row = {"target": target, "scenario": scenario, **result, **worker_memory(server.pid)}
+                            rows.append(row)
+                            out(format_row(row))
+                    finally:
+                        _stop(server)
+            finally:
+                _stop(mock)
+                log.flush()
+                if options.get("keep_log"):
+                    Path(options["keep_log"]).write_text((workdir / "processes.log").read_text())
+    return rows
+
+COLUMNS = ("target", "scenario", "requests", "errors", "req_per_s", "p50_ms", "p95_ms", "p99_ms",
+           "ttft_p50_ms", "workers", "rss_mb", "peak_rss_mb")
+
+def _cells(values):
+    return "  ".join(
+        f"{v:<17}" if i < 2 else f"{v:>{len(COLUMNS[i])}}" for i, v in enumerate(values)
+    )
+
+def format_header() -> str:
+    return _cells(COLUMNS)
+
+def format_row(row) -> str:
+    return _cells(["-" if row.get(c) is None else str(row[c]) for c in COLUMNS])
+
+def write_json(rows, path):
+    Path(path).write_text(json.dumps(rows, indent=2))
@@ -0,0 +1,63 @@
+"""Long-lived, pooled HTTP clients for upstream LLM calls.
+
+One httpx client per provider keeps TLS connections (and HTTP/2 streams when
+``h2`` is installed) alive across requests instead of reconnecting each time.
+Async clients are bound to an event loop, so they are kept per running loop.
+"""
+import asyncio
+import atexit
+import importlib.util
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+
+_lock = threading.Lock()
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()  # loop -> {provider_name: AsyncClient}
+
+
+def _http2_enabled() -> bool:
+    return getattr(settings, "LLM_HTTP2", True) and importlib.util.find_spec("h2") is not None
+
+def _client_options():
+    return {
+        "http2": _http2_enabled(),
+        "timeout": httpx.Timeout(
+            getattr(settings, "LLM_TIMEOUT", 60.0),
+            connect=getattr(settings, "LLM_CONNECT_TIMEOUT", 10.0),
+        ),
+        "limits": httpx.Limits(
+            max_connections=getattr(settings, "LLM_HTTP_MAX_CONNECTIONS", 200),
+            max_keepalive_connections=getattr(settings, "LLM_HTTP_MAX_KEEPALIVE", 40),
+            keepalive_expiry=getattr(settings, "LLM_HTTP_KEEPALIVE_EXPIRY", 30.0),
+        ),
+    }
+
+def get_client(provider_name: str) -> httpx.Client:
+    client = _clients.get(provider_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(provider_name)
+            if client is None:
+                client = _clients[provider_name] = httpx.Client(**_client_options())
+    return client
+
+def get_async_client(provider_name: str) -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    per_loop = _async_clients.get(loop)
+    if per_loop is None:
+        per_loop = _async_clients[loop] = {}
+    client = per_loop.get(provider_name)
+    if client is None:
+        client = per_loop[provider_name] = httpx.AsyncClient(**_client_options())
+    return client
+
+def pool_info() -> dict:
+    return {"http2": _http2_enabled(), "sync_clients": sorted(_clients)}
+
+@atexit.register
+def _close_clients():
+    for client in list(_clients.values()):
+        client.close()
@@ -0,0 +1,79 @@
+"""Completion cache for repeated prompts.
+
+Replies are stored in the ``completions`` cache alias (see ``CACHES`` in
+settings), keyed on provider, model, the system prompt and the trailing
+``LLM_CACHE_WINDOW`` transcript messages after light normalization, so
+"Explain two sum?" and "explain  two sum" share an entry.
+
+Eviction is the backend's: LocMemCache is a size-bounded LRU with TTL; the
+file and database backends honour the same TTL and MAX_ENTRIES but cull a
+fraction of entries when full instead of strict LRU.
+"""
+import hashlib
+import json
+import re
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+CACHE_ALIAS = "completions"
+_KEY_PREFIX = "completion:"
+_STAT_KEYS = {"hits": "completion-stats:hits", "misses": "completion-stats:misses"}
+
+_WS_RE = re.compile(r"\s+")
+_TRAILING_PUNCT_RE = re.compile(r"[\s.!?]+$")
+
+
+def enabled() -> bool:
+    return getattr(settings, "LLM_CACHE_ENABLED", True)
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = _WS_RE.sub(" ", text).strip()
+    return _TRAILING_PUNCT_RE.sub("", text)
+
+def make_key(provider_name: str, model: str, messages, window: int | None = None) -> str:
+    if window is None:
+        window = getattr(settings, "LLM_CACHE_WINDOW", 3)
+    system = [normalize(m.get("content", "")) for m in messages if m.get("role") == "system"]
+    transcript = [m for m in messages if m.get("role") != "system"][-window:]
+    tail = [[m.get("role"), normalize(m.get("content", ""))] for m in transcript]
+    raw = json.dumps([provider_name, model, system, tail], separators=(",", ":"), ensure_ascii=False)
+    return _KEY_PREFIX + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _count(stat: str):
+    cache = _cache()
+    key = _STAT_KEYS[stat]
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+def lookup(key: str) -> str | None:
+    reply = _cache().get(key)
+    _count("hits" if reply is not None else "misses")
+    metrics.record_cache(CACHE_ALIAS, reply is not None)
+    return reply
+
+def store(key: str, reply: str):
+    _cache().set(key, reply)
+
+def stats() -> dict:
+    counts = _cache().get_many(list(_STAT_KEYS.values()))
+    hits = counts.get(_STAT_KEYS["hits"], 0)
+    misses = counts.get(_STAT_KEYS["misses"], 0)
+    total = hits + misses
+    return {
+        "enabled": enabled(),
+        "backend": settings.CACHES[CACHE_ALIAS]["BACKEND"].rsplit(".", 1)[-1],
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else None,
+    }
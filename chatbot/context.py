@@ -0,0 +1,114 @@
+"""Token-budgeted context assembly for upstream prompts.
+
+Token counts use tiktoken when it is installed and a local approximation
+otherwise; either way each message's count is computed once, when it is
+written, and stored on ``Message.token_count``.
+"""
+import logging
+import math
+import re
+
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Per-message framing overhead (role markers etc.) in chat formats
+MESSAGE_OVERHEAD = 4
+
+# Context window sizes; the longest matching prefix wins
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o": 128_000,
+    "gpt-4.1": 1_000_000,
+    "gpt-3.5-turbo": 16_385,
+    "deepseek-chat": 64_000,
+    "llama-3.1": 131_072,
+    "meta-llama/Meta-Llama-3.1": 131_072,
+    "openai/gpt-4o": 128_000,
+    "gemini-1.5-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+}
+DEFAULT_CONTEXT_LIMIT = 8_192
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encoding = None
+
+
+def _tiktoken_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_tiktoken_encoding().encode(text, disallowed_special=()))
+    # ~4 characters per token for words, one token per punctuation mark
+    return sum(math.ceil(len(piece) / 4) for piece in _WORD_RE.findall(text))
+
+def message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+def model_context_limit(model: str) -> int:
+    best = ""
+    for prefix in MODEL_CONTEXT_LIMITS:
+        if model.startswith(prefix) and len(prefix) > len(best):
+            best = prefix
+    return MODEL_CONTEXT_LIMITS[best] if best else DEFAULT_CONTEXT_LIMIT
+
+def context_budget(model: str) -> int:
+    """Prompt tokens we allow for this model: the configured budget, capped so
+    the reply (LLM_MAX_OUTPUT_TOKENS) still fits in the model's window."""
+    configured = getattr(settings, "LLM_CONTEXT_BUDGET", 6000)
+    reserve = getattr(settings, "LLM_MAX_OUTPUT_TOKENS", 2048)
+    return max(256, min(configured, model_context_limit(model) - reserve))
+
+def output_limit(model: str, prompt_tokens: int) -> int:
+    """Reply tokens a call may ask for: LLM_MAX_OUTPUT_TOKENS, or less when the
+    prompt leaves less room in the model's window."""
+    return min(getattr(settings, "LLM_MAX_OUTPUT_TOKENS", 2048), model_context_limit(model) - prompt_tokens)
+
+def pack_messages(convo, model: str, system_messages: list, min_seq: int = 0, reserve: int = 0):
+    """System messages followed by the most recent transcript that fits the budget
+    (less ``reserve`` tokens kept for messages the caller adds afterwards).
+
+    Reads the conversation newest-first and stops at the first message that no
+    longer fits (or that is older than ``min_seq``, i.e. already summarized),
+    so the work is bounded by the budget, not the history length. The latest
+    message is always included. Returns (messages, seq of the oldest packed message).
+
+    When the budget cuts the history, the window start only moves in steps of
+    LLM_CONTEXT_ALIGN messages, so consecutive turns send the same prefix and
+    providers' prompt caches keep hitting (see prompt_cache.py).
+    """
+    budget = context_budget(model) - reserve
+    used = sum(message_tokens(m["content"]) for m in system_messages)
+    packed = []
+    first_seq = convo.message_count
+    over_budget = False
+    for m in convo.messages_newest_first():
+        cost = m["token_count"] + MESSAGE_OVERHEAD
+        if packed and (m["seq"] < min_seq or used + cost > budget):
+            over_budget = m["seq"] >= min_seq
+            break
+        used += cost
+        packed.append({"role": m["role"], "content": m["content"], "seq": m["seq"], "cost": cost})
+        first_seq = m["seq"]
+    align = getattr(settings, "LLM_CONTEXT_ALIGN", 8)
+    if over_budget and align > 1:
+        start = min(-(-first_seq // align) * align, packed[0]["seq"])
+        while packed[-1]["seq"] < start:
+            used -= packed.pop()["cost"]
+        first_seq = packed[-1]["seq"]
+    packed = [{"role": m["role"], "content": m["content"]} for m in reversed(packed)]
+    logger.info(
+        "context conversation=%s model=%s budget=%d used=%d packed=%d/%d",
+        convo.pk, model, budget, used, len(packed), convo.message_count,
+    )
+    return list(system_messages) + packed, first_seq
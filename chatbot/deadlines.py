@@ -0,0 +1,127 @@
+"""Per-request time budgets and cancellation for upstream calls.
+
+A Budget starts when a chat request arrives and expires
+LLM_REQUEST_DEADLINE seconds later, inside the platform's request timeout
+(gunicorn kills a sync worker after 30s by default). Each upstream call
+gets the time left as its timeout, and a ``max_tokens`` sized from the
+provider's observed time to first token and tokens/sec
+(routing.provider_stats). A generation then ends before the deadline
+instead of being cut off by the platform. A stream still running at the
+deadline is closed, and its reply is marked as truncated.
+
+A budget is also cancelled when the user stops the reply or goes away:
+
+- the Stop button posts to ``ask/cancel/``, which sets a flag in the
+  default cache, so any worker can see it
+- under gunicorn, the request's socket is checked for EOF
+
+Provider calls check ``cancelled()`` between deltas and routing checks it
+while it waits, so the upstream request is closed rather than left to run
+and be billed to completion. Under ASGI, Django also cancels the view task
+when the client disconnects.
+"""
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import context, routing
+from .routing import UpstreamError
+
+DEADLINE_REPLY = "Not enough time was left to ask the model. Please try again."
+TRUNCATED_NOTE = "[Reply cut short to finish within the time limit.]"
+# How often cancelled() looks at the cache flag and the client socket
+CHECK_INTERVAL = 0.25
+
+
+def deadline_seconds() -> float:
+    return getattr(settings, "LLM_REQUEST_DEADLINE", 25.0)
+
+def _cancel_key(owner, request_id) -> str:
+    return f"cancel:{owner}:{request_id}"
+
+def cancel(owner: str, request_id: str):
+    """Stop the owner's request ``request_id`` from any worker."""
+    cache.set(_cancel_key(owner, request_id), True, timeout=deadline_seconds() + 60)
+
+def _client_gone(sock) -> bool:
+    """True once the client has closed the connection (EOF on a peek)."""
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError, ValueError):  # ValueError: TLS sockets cannot peek
+        return False
+    except OSError:
+        return True
+
+
+class Budget:
+    """Time left for one chat request, plus whether it has been cancelled."""
+
+    def __init__(self, seconds: float, cancel_key: str | None = None, sock=None):
+        self.expires = time.monotonic() + seconds
+        self.cancel_key = cancel_key
+        self.sock = sock
+        # Set when a reply was cut short by max_tokens or by the deadline
+        self.truncated = False
+        self._cancelled = threading.Event()
+        self._checked = 0.0
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self) -> bool:
+        if self._cancelled.is_set():
+            return True
+        now = time.monotonic()
+        if now - self._checked >= CHECK_INTERVAL:
+            self._checked = now
+            if (self.cancel_key and cache.get(self.cancel_key)) or _client_gone(self.sock):
+                self._cancelled.set()
+        return self._cancelled.is_set()
+
+    async def acancelled(self) -> bool:
+        if self._cancelled.is_set():
+            return True
+        now = time.monotonic()
+        if self.cancel_key and now - self._checked >= CHECK_INTERVAL:
+            self._checked = now
+            if await cache.aget(self.cancel_key):
+                self._cancelled.set()
+        return self._cancelled.is_set()
+
+    def call_timeout(self) -> float:
+        """Seconds one upstream call may take: the time left, at most LLM_TIMEOUT."""
+        return max(0.1, min(self.remaining(), getattr(settings, "LLM_TIMEOUT", 60.0)))
+
+    def max_tokens(self, provider_name: str, model: str, prompt_tokens: int = 0) -> int:
+        """Output tokens the provider can produce in the time left at its observed
+        speed, capped by context.output_limit. Raises UpstreamError when that is
+        fewer than LLM_MIN_TOKENS, so no call starts that could not finish."""
+        stats = routing.provider_stats(provider_name, model)
+        ttft = stats["ttft"] if stats["ttft"] is not None else getattr(settings, "LLM_DEADLINE_PRIOR_TTFT", 1.5)
+        rate = stats["tokens_per_sec"] or getattr(settings, "LLM_DEADLINE_PRIOR_TOKENS_PER_SEC", 40.0)
+        seconds = self.remaining() - getattr(settings, "LLM_DEADLINE_MARGIN", 2.0) - ttft
+        tokens = min(int(seconds * rate), context.output_limit(model, prompt_tokens))
+        if tokens < getattr(settings, "LLM_MIN_TOKENS", 64):
+            raise UpstreamError(DEADLINE_REPLY)
+        return tokens
+
+
+def budget_for(request, owner: str, payload: dict) -> Budget:
+    """Budget of a chat request; ``payload["request_id"]`` lets the page stop it."""
+    request_id = str(payload.get("request_id") or "")[:64]
+    return Budget(
+        deadline_seconds(),
+        cancel_key=_cancel_key(owner, request_id) if request_id else None,
+        sock=request.META.get("gunicorn.socket"),
+    )
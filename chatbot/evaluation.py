@@ -0,0 +1,363 @@
+"""Offline evaluation: many prompts through the provider layer at once.
+
+``manage.py llm_eval`` reads prompts from JSONL and sends each one to every
+chosen (provider, model) pair, with at most ``concurrency`` calls in flight
+per provider. Each result is appended to the output JSONL as soon as it
+arrives, so a rerun with the same output file skips the (id, provider, model)
+triples that already succeeded and an interrupted run picks up where it stopped.
+
+With ``batch``, providers that offer OpenAI's Batch API ("batch" in the
+catalog) get one batch job for all their prompts instead: about half the
+price, results within 24h. Submitted batch ids are kept in
+``<output>.batches.json`` so a rerun polls the same job rather than paying
+for a second one.
+
+Prompt lines carry ``messages`` (chat format), ``prompt`` or ``title`` and
+``body``, plus an optional ``system``; the id is ``id`` or ``request_id``,
+else the line number.
+"""
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+
+from . import metrics, providers
+from .bench import percentile
+from .clients import get_async_client
+from .providers import PROVIDERS
+from .routing import Throttled, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_POLL_SECONDS = 30.0
+BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+
+
+# --------- Input / output ----------
+def _messages(row, system=None):
+    if isinstance(row.get("messages"), list):
+        messages = list(row["messages"])
+    else:
+        text = row.get("prompt") or "\n\n".join(str(row[k]) for k in ("title", "body") if row.get(k))
+        if not text:
+            raise ValueError("no messages, prompt, title or body")
+        messages = [{"role": "user", "content": str(text)}]
+    system = row.get("system") or system
+    if system and not any(m.get("role") == "system" for m in messages):
+        messages.insert(0, {"role": "system", "content": system})
+    return messages
+
+def load_prompts(path, system=None) -> list[dict]:
+    """[{"id", "messages"}] from a JSONL file; blank lines are skipped."""
+    prompts, seen = [], set()
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                prompt = {"id": str(row.get("id", row.get("request_id", lineno))), "messages": _messages(row, system)}
+            except (ValueError, AttributeError) as e:
+                raise ValueError(f"{path}:{lineno}: {e}")
+            if prompt["id"] in seen:
+                raise ValueError(f"{path}:{lineno}: duplicate id {prompt['id']!r}")
+            seen.add(prompt["id"])
+            prompts.append(prompt)
+    return prompts
+
+def completed_pairs(path) -> set:
+    """(id, provider, model) with a successful result in an earlier run's output."""
+    done = set()
+    if not Path(path).exists():
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interruption
+            if row.get("ok"):
+                done.add((str(row["id"]), row["provider"], row.get("model")))
+    return done
+
+
+class ResultWriter:
+    """Appends one JSON line per result and flushes it straight away."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.rows = []  # results of this run, for the summary
+        self._file = open(self.path, "a+", encoding="utf-8")
+        self._file.seek(0, 2)
+        if self._file.tell():
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != "\n":
+                self._file.write("\n")  # finish a line cut short by an interruption
+
+    def write(self, row):
+        self.rows.append(row)
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _result(prompt, name, model, mode, *, reply=None, error=None, usage=None, latency=None, ttfb=None):
+    prompt_tokens, completion_tokens, cached = usage or (None, None, None)
+    return {
+        "id": prompt["id"], "provider": name, "model": model, "mode": mode, "ok": error is None,
+        "reply": reply, "error": error,
+        "latency_s": None if latency is None else round(latency, 3),
+        "ttfb_s": None if ttfb is None else round(ttfb, 3),
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": cached,
+    }
+
+
+# --------- Direct calls ----------
+async def _call(name, model, messages, retries):
+    """(reply, UpstreamCall) for one prompt, paced by the provider's admission
+    control; retriable failures are retried ``retries`` times with backoff."""
+    attempt = 0
+    while True:
+        call = metrics.UpstreamCall(name, model)
+        try:
+            reply = await providers.aadmitted(
+                name, messages, lambda: providers.acall_provider(name, model, messages, call=call)
+            )
+            return reply, call
+        except Throttled:
+            await asyncio.sleep(1.0)  # our own buckets are full; not a failure
+        except UpstreamError as e:
+            if not e.retriable or attempt >= retries:
+                raise
+            attempt += 1
+            await asyncio.sleep(min(30.0, 2.0 ** attempt))
+
+async def _worker(name, model, queue, writer, retries):
+    while True:
+        try:
+            prompt = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            reply, call = await _call(name, model, prompt["messages"], retries)
+        except UpstreamError as e:
+            writer.write(_result(prompt, name, model, "direct", error=str(e), latency=time.perf_counter() - start))
+            continue
+        writer.write(_result(
+            prompt, name, model, "direct", reply=reply, usage=call.usage,
+            latency=time.perf_counter() - call.start, ttfb=call.ttfb,
+        ))
+
+async def run_direct(name, model, prompts, writer, concurrency, retries):
+    """Send every prompt to one provider with ``concurrency`` calls in flight."""
+    queue = asyncio.Queue()
+    for prompt in prompts:
+        queue.put_nowait(prompt)
+    await asyncio.gather(*(_worker(name, model, queue, writer, retries) for _ in range(max(1, concurrency))))
+
+
+# --------- OpenAI Batch API ----------
+def _label(name, model) -> str:
+    return f"{name}:{model}"
+
+
+class BatchState:
+    """Submitted batches by provider and model, in ``<output>.batches.json``."""
+
+    def __init__(self, output):
+        self.path = Path(f"{output}.batches.json")
+        self.batches = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def get(self, name, model):
+        return self.batches.get(_label(name, model))
+
+    def set(self, name, model, value):
+        if value is None:
+            self.batches.pop(_label(name, model), None)
+        else:
+            self.batches[_label(name, model)] = value
+        if self.batches:
+            self.path.write_text(json.dumps(self.batches, indent=2))
+        elif self.path.exists():
+            self.path.unlink()
+
+def _batch_base(name) -> str:
+    return providers.provider_url(PROVIDERS[name]).rsplit("/chat/completions", 1)[0]
+
+def _batch_headers(name) -> dict:
+    return PROVIDERS[name]["headers"](providers.get_api_key(PROVIDERS[name]["key_env"]), None)
+
+async def _batch_request(client, name, method, path, **kwargs):
+    r = await client.request(method, _batch_base(name) + path, headers=_batch_headers(name), **kwargs)
+    if r.status_code >= 400:
+        raise UpstreamError(f"{name} batch {method} {path}: HTTP {r.status_code} {r.text[:300]}", status=r.status_code)
+    return r
+
+async def _submit_batch(client, name, model, prompts) -> str:
+    lines = "".join(
+        json.dumps({
+            "custom_id": p["id"], "method": "POST", "url": BATCH_ENDPOINT,
+            "body": {"model": model, "messages": p["messages"]},
+        }, ensure_ascii=False) + "\n"
+        for p in prompts
+    )
+    r = await _batch_request(
+        client, name, "POST", "/files",
+        data={"purpose": "batch"}, files={"file": ("llm_eval.jsonl", lines.encode("utf-8"), "application/jsonl")},
+    )
+    r = await _batch_request(
+        client, name, "POST", "/batches",
+        json={"input_file_id": r.json()["id"], "endpoint": BATCH_ENDPOINT, "completion_window": "24h"},
+    )
+    return r.json()["id"]
+
+def _batch_row(name, model, prompt, line) -> dict:
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if line.get("error") or response.get("status_code", 200) >= 400:
+        error = (line.get("error") or body.get("error") or {}).get("message") or f"HTTP {response.get('status_code')}"
+        return _result(prompt, name, model, "batch", error=error)
+    reply = providers.parse_reply(name, body).strip() or providers.EMPTY_REPLY
+    return _result(prompt, name, model, "batch", reply=reply, usage=metrics.usage_tokens(name, body))
+
+async def run_batch(name, model, prompts, writer, state, poll=BATCH_POLL_SECONDS, out=print):
+    """Run the prompts as one batch job (or resume the one already submitted)."""
+    client = get_async_client(name)
+    by_id = {p["id"]: p for p in prompts}
+    label = _label(name, model)
+    saved = state.get(name, model)
+    if saved:
+        batch_id = saved["batch_id"]
+        out(f"{label}: resuming batch {batch_id}")
+    else:
+        batch_id = await _submit_batch(client, name, model, prompts)
+        state.set(name, model, {"batch_id": batch_id, "model": model})
+        out(f"{label}: submitted batch {batch_id} ({len(prompts)} prompts)")
+    while True:
+        batch = (await _batch_request(client, name, "GET", f"/batches/{batch_id}")).json()
+        if batch.get("status") in BATCH_DONE:
+            break
+        counts = batch.get("request_counts") or {}
+        out(f"{label}: batch {batch_id} {batch.get('status')} {counts.get('completed', 0)}/{counts.get('total', '?')}")
+        await asyncio.sleep(poll)
+
+    for key in ("output_file_id", "error_file_id"):
+        if not batch.get(key):
+            continue
+        r = await _batch_request(client, name, "GET", f"/files/{batch[key]}/content")
+        for raw in r.text.splitlines():
+            if not raw.strip():
+                continue
+            line = json.loads(raw)
+            prompt = by_id.get(line.get("custom_id"))
+            if prompt is not None:
+                writer.write(_batch_row(name, model, prompt, line))
+    if batch.get("status") != "completed":
+        out(f"{label}: batch {batch_id} ended {batch.get('status')}; rerun to try the remaining prompts")
+    state.set(name, model, None)
+
+
+# --------- Driver ----------
+def parse_targets(spec) -> list[tuple[str, str]]:
+    """(provider, model) pairs from "openai,groq:llama-3.1-8b-instant"; empty means the configured chain."""
+    if not spec:
+        return providers.provider_chain()
+    targets = []
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, model = item.partition(":")
+        if name not in PROVIDERS:
+            raise ValueError(f"unknown provider {name!r} (choose from {', '.join(PROVIDERS)})")
+        targets.append((name, model or PROVIDERS[name]["default_model"]))
+    return targets
+
+async def _run(plan, writer, options, out):
+    state = BatchState(options["output"])
+    timings = {}
+
+    async def timed(name, model, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except UpstreamError as e:
+            out(f"{_label(name, model)}: {e}")
+        timings[name, model] = time.perf_counter() - start
+
+    await asyncio.gather(*(
+        timed(name, model, run_batch(name, model, todo, writer, state, options["poll"], out) if batch
+              else run_direct(name, model, todo, writer, options["concurrency"], options["retries"]))
+        for name, model, todo, batch in plan
+    ))
+    return timings
+
+def run(options, out=print) -> list[dict]:
+    """Evaluate every prompt on every target; returns one summary row per target."""
+    for name in ("asyncio", "httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    prompts = load_prompts(options["input"], options.get("system"))
+    targets = parse_targets(options.get("providers"))
+    if not targets:
+        raise ValueError("no provider has an API key; set one or pass --providers")
+    missing = [n for n, _ in targets if not providers.get_api_key(PROVIDERS[n]["key_env"])]
+    if missing:
+        raise ValueError(f"missing API key for {', '.join(missing)}")
+
+    done = completed_pairs(options["output"])
+    plan = []
+    for name, model in targets:
+        todo = [p for p in prompts if (p["id"], name, model) not in done]
+        if len(todo) < len(prompts):
+            out(f"{_label(name, model)}: {len(prompts) - len(todo)} of {len(prompts)} prompts already done")
+        if todo:
+            plan.append((name, model, todo, options.get("batch") and PROVIDERS[name].get("batch", False)))
+
+    writer = ResultWriter(options["output"])
+    try:
+        timings = asyncio.run(_run(plan, writer, options, out))
+    finally:
+        writer.close()
+    return [summarize(name, model, batch, writer.rows, timings.get((name, model))) for name, model, _todo, batch in plan]
+
+
+# --------- Summary ----------
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def summarize(name, model, batch, rows, elapsed) -> dict:
+    rows = [r for r in rows if r["provider"] == name and r["model"] == model]
+    ok = [r for r in rows if r["ok"]]
+    latencies = [r["latency_s"] for r in ok if r["latency_s"] is not None]
+    ttfbs = [r["ttfb_s"] for r in ok if r["ttfb_s"] is not None]
+    completion = sum(r["completion_tokens"] or 0 for r in ok)
+    return {
+        "provider": name, "model": model, "mode": "batch" if batch else "direct",
+        "requests": len(rows), "errors": len(rows) - len(ok),
+        "elapsed_s": None if elapsed is None else round(elapsed, 2),
+        "req_per_s": round(len(rows) / elapsed, 2) if elapsed else None,
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+        "ttfb_p50_ms": _ms(percentile(ttfbs, 50)),
+        "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in ok),
+        "completion_tokens": completion,
+        "cached_tokens": sum(r["cached_tokens"] or 0 for r in ok),
+        "out_tok_per_s": round(completion / elapsed, 1) if elapsed else None,
+    }
+
+COLUMNS = ("provider", "model", "mode", "requests", "errors", "elapsed_s", "req_per_s", "p50_ms", "p95_ms", "p99_ms",
+           "ttfb_p50_ms", "prompt_tokens", "completion_tokens", "cached_tokens", "out_tok_per_s")
+
+def _cells(values):
+    return "  ".join(
+        f"{v:<10}" if i == 0 else f"{v:<24}" if i == 1 else f"{v:>{len(COLUMNS[i])}}" for i, v in enumerate(values)
+    )
+
+def format_header() -> str:
+    return _cells(COLUMNS)
+
+def format_row(row) -> str:
+    return _cells(["-" if row.get(c) is None else str(row[c]) for c in COLUMNS])
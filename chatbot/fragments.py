@@ -0,0 +1,69 @@
+"""Cached HTML fragments of the chat page (sidebar and message list).
+
+Each fragment is rendered once per version and kept in the ``fragments``
+cache alias. The message list is keyed by the conversation's
+``message_count``, which every append bumps. The sidebar is keyed by the
+owner's conversation count and newest ``updated_at``, which new
+conversations, appends and title changes all move. Both versions are read
+from the database rather than from a cache counter, so a per-process
+(locmem) cache never serves a fragment that another worker has outdated.
+
+The same versions make up the chat page's ETag (see views.chat_page), so
+an unchanged page costs two small queries and a 304.
+"""
+import hashlib
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from django.template.loader import render_to_string
+
+from . import metrics
+from .models import Conversation
+
+CACHE_ALIAS = "fragments"
+TEMPLATES = ("chatbot/form.html", "chatbot/_sidebar.html", "chatbot/_messages.html")
+_TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
+
+_page_version = None
+
+
+def enabled() -> bool:
+    return getattr(settings, "FRAGMENT_CACHE_ENABLED", True)
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+def sidebar_version(owner: str) -> str:
+    row = Conversation.objects.filter(owner=owner).aggregate(count=Count("id"), latest=Max("updated_at"))
+    latest = row["latest"].timestamp() if row["latest"] else 0
+    return f"{row['count']}-{latest:.6f}"
+
+def page_version() -> str:
+    """Changes with each deploy (page templates, static manifest), so a 304
+    never keeps a browser on an old page. Recomputed per call under DEBUG."""
+    global _page_version
+    if _page_version is None or settings.DEBUG:
+        digest = hashlib.sha256()
+        manifest = Path(settings.STATIC_ROOT or ".") / "staticfiles.json"
+        for path in [_TEMPLATE_DIR / name for name in TEMPLATES] + [manifest]:
+            try:
+                digest.update(path.read_bytes())
+            except OSError:
+                digest.update(b"-")
+        _page_version = digest.hexdigest()[:16]
+    return _page_version
+
+def render(key: str, template: str, build) -> str:
+    """``template`` rendered with the context ``build()`` returns; ``key`` must carry the version."""
+    if not enabled():
+        return render_to_string(template, build())
+    cache = _cache()
+    key = f"frag:{key}"
+    html = cache.get(key)
+    metrics.record_cache(CACHE_ALIAS, html is not None)
+    if html is None:
+        html = render_to_string(template, build())
+        cache.set(key, html)
+    return html
@@ -0,0 +1,181 @@
+"""Database-backed job queue for LLM generations (LLM_JOB_QUEUE).
+
+The chat views enqueue a Job and answer 202 with its id. ``manage.py
+llm_worker`` claims jobs, at most LLM_JOB_CONCURRENCY per provider, and runs
+them with ``run_job``. Clients long-poll ``jobs/<id>/`` or read the
+``jobs/<id>/events/`` stream; partial text is relayed through the default cache.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import completion_cache, providers, singleflight
+from .models import Job
+from .providers import CONNECT_ERROR_REPLY, EMPTY_REPLY
+from .routing import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+INTERRUPTED_REPLY = "The model request was interrupted. Please try again."
+PARTIAL_TTL = 600
+PARTIAL_INTERVAL = 0.25  # seconds between partial-text writes
+
+
+def enabled() -> bool:
+    return getattr(settings, "LLM_JOB_QUEUE", False)
+
+def concurrency() -> int:
+    return getattr(settings, "LLM_JOB_CONCURRENCY", 4)
+
+def lease_seconds(job) -> float:
+    """Longest a job may run before it counts as abandoned: one timeout per provider, plus slack."""
+    return getattr(settings, "LLM_TIMEOUT", 60.0) * (len(job.turn.get("chain") or []) + 1) + 30
+
+def _partial_key(job_id):
+    return f"job-partial:{job_id}"
+
+
+# --------- Web tier ----------
+def enqueue(convo, turn) -> Job:
+    return Job.objects.create(
+        conversation=convo,
+        provider=turn["provider"],
+        turn={
+            "chain": [list(pair) for pair in turn["chain"]],
+            "messages": turn["messages"],
+            "cache_key": turn["cache_key"],
+            "flight_key": turn["flight_key"],
+        },
+    )
+
+def get_owned(job_id, owner) -> Job | None:
+    return Job.objects.filter(pk=job_id, conversation__owner=owner).first()
+
+def pending_for(convo) -> Job | None:
+    return convo.jobs.filter(status__in=(Job.QUEUED, Job.RUNNING)).order_by("created_at").first()
+
+def partial_text(job_id) -> str:
+    return cache.get(_partial_key(job_id)) or ""
+
+def wait(job, timeout: float, poll: float = 0.5) -> Job:
+    """Reload ``job`` until it has finished or ``timeout`` seconds have passed."""
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(min(poll, max(0.0, deadline - time.monotonic())))
+        job.refresh_from_db(fields=["status", "reply", "error", "finished_at"])
+    return job
+
+
+# --------- Workers ----------
+def claim(worker_id: str) -> Job | None:
+    """Take the oldest queued job whose provider is below its concurrency limit."""
+    running = Job.objects.filter(status=Job.RUNNING).values("provider").annotate(n=Count("id"))
+    saturated = [row["provider"] for row in running if row["n"] >= concurrency()]
+    candidates = (
+        Job.objects.filter(status=Job.QUEUED).exclude(provider__in=saturated)
+        .order_by("created_at").values_list("id", flat=True)[:10]
+    )
+    for job_id in candidates:
+        now = timezone.now()
+        # Conditional UPDATE: exactly one worker wins each job
+        claimed = Job.objects.filter(pk=job_id, status=Job.QUEUED).update(
+            status=Job.RUNNING, worker=worker_id, attempts=F("attempts") + 1, started_at=now,
+        )
+        if claimed:
+            job = Job.objects.select_related("conversation").get(pk=job_id)
+            job.lease_until = now + timedelta(seconds=lease_seconds(job))
+            Job.objects.filter(pk=job_id).update(lease_until=job.lease_until)
+            return job
+    return None
+
+def finish(job, reply: str, failed: bool = False) -> bool:
+    """Store the outcome; False if the job was meanwhile taken over by another worker."""
+    updated = Job.objects.filter(pk=job.pk, status=Job.RUNNING, worker=job.worker).update(
+        status=Job.FAILED if failed else Job.DONE,
+        reply=reply,
+        error=reply if failed else "",
+        finished_at=timezone.now(),
+        lease_until=None,
+    )
+    cache.delete(_partial_key(job.pk))
+    return bool(updated)
+
+def requeue_expired() -> int:
+    """Requeue running jobs whose worker vanished; give up after LLM_JOB_MAX_ATTEMPTS."""
+    now = timezone.now()
+    expired = Job.objects.filter(status=Job.RUNNING, lease_until__lt=now).select_related("conversation")
+    count = 0
+    for job in expired:
+        # Either step finds nothing when another worker got to the job first
+        if job.attempts >= getattr(settings, "LLM_JOB_MAX_ATTEMPTS", 2):
+            done = finish(job, INTERRUPTED_REPLY, failed=True)
+            if done:
+                job.conversation.append("assistant", INTERRUPTED_REPLY)
+        else:
+            done = Job.objects.filter(pk=job.pk, status=Job.RUNNING, lease_until__lt=now).update(
+                status=Job.QUEUED, worker="", lease_until=None,
+            )
+        count += bool(done)
+    return count
+
+def _generate_stream(chain, messages, flight_key):
+    if flight_key:
+        return singleflight.stream(flight_key, lambda budget: providers.open_stream(chain, messages, None, budget))
+    return providers.open_stream(chain, messages)
+
+def run_job(job):
+    """Generate a claimed job's reply, append it to the conversation, finish the job."""
+    chain = [tuple(pair) for pair in job.turn["chain"]]
+    messages, cache_key = job.turn["messages"], job.turn.get("cache_key")
+    progress = Progress(job.pk)
+    error = None
+    cached = completion_cache.lookup(cache_key) if cache_key else None
+    if cached is not None:
+        progress.add(cached)
+    else:
+        try:
+            stream = _generate_stream(chain, messages, job.turn.get("flight_key"))
+            try:
+                for delta in stream:
+                    progress.add(delta)
+            finally:
+                stream.close()
+        except UpstreamError as e:
+            error = str(e)
+        except Exception:
+            logger.exception("job %s failed (provider=%s)", job.pk, job.provider)
+            error = CONNECT_ERROR_REPLY
+
+    reply = "".join(progress.parts).strip()
+    if error and reply:
+        reply = f"{reply}\n\n[{error}]"
+    reply = reply or error or EMPTY_REPLY
+    if error is None and cached is None and cache_key and reply != EMPTY_REPLY:
+        completion_cache.store(cache_key, reply)
+    # Finish first: if the lease ran out, requeue_expired already answered the
+    # turn or handed the job to another worker, and this reply must not be added too
+    if finish(job, reply, failed=error is not None):
+        job.conversation.append("assistant", reply)
+    else:
+        logger.warning("job %s was taken over before it finished; dropping its reply", job.pk)
+
+
+class Progress:
+    """Publishes a running job's partial reply, at most every PARTIAL_INTERVAL seconds."""
+
+    def __init__(self, job_id):
+        self.key = _partial_key(job_id)
+        self.parts = []
+        self._published = 0.0
+
+    def add(self, delta):
+        self.parts.append(delta)
+        now = time.monotonic()
+        if now - self._published >= PARTIAL_INTERVAL:
+            self._published = now
+            cache.set(self.key, "".join(self.parts), timeout=PARTIAL_TTL)
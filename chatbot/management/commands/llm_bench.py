@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot import bench
+
+
+class Command(BaseCommand):
+    help = "Load-test the WSGI/ASGI entry points against the local mock LLM (no API credits used)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target", choices=[*bench.TARGETS, "both"], default="both")
+        parser.add_argument("--scenario", choices=[*bench.SCENARIOS, "all"], default="all")
+        parser.add_argument("--provider", choices=["openai", "gemini"], default="openai")
+        parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users.")
+        parser.add_argument("--requests", type=int, default=5, help="Messages per user (new_chat).")
+        parser.add_argument("--turns", type=int, default=20, help="Messages per user (long_conversation).")
+        parser.add_argument("--rounds", type=int, default=5, help="Bursts (burst).")
+        parser.add_argument("--stream", action="store_true", help="Use ask/stream/ and report time to first token.")
+        parser.add_argument("--workers", type=int, default=2)
+        parser.add_argument("--threads", type=int, default=8, help="Threads per WSGI worker.")
+        parser.add_argument("--latency", type=float, default=0.3, help="Mock seconds before the first byte.")
+        parser.add_argument("--tokens-per-sec", type=float, default=60.0)
+        parser.add_argument("--reply-tokens", type=int, default=80)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--request-timeout", type=float, default=120.0)
+        parser.add_argument("--json", dest="json_path", help="Also write the results to this file.")
+        parser.add_argument("--keep-log", help="Copy the server/mock output to this file.")
+
+    def handle(self, *args, **options):
+        targets = bench.TARGETS if options["target"] == "both" else (options["target"],)
+        scenarios = bench.SCENARIOS if options["scenario"] == "all" else (options["scenario"],)
+        self.stdout.write(bench.format_header())
+        try:
+            rows = bench.run(targets, scenarios, options, out=self.stdout.write)
+        except (RuntimeError, OSError) as e:
+            raise CommandError(f"benchmark failed: {e}")
+        if options["json_path"]:
+            bench.write_json(rows, options["json_path"])
@@ -0,0 +1,51 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chatbot import bench, evaluation, mockllm
+from chatbot.providers import PROVIDERS
+
+
+class Command(BaseCommand):
+    help = "Run a JSONL file of prompts through one or more providers; results go to a resumable JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Prompts, one JSON object per line.")
+        parser.add_argument("--output", "-o", help="Results file (default: <input>.results.jsonl).")
+        parser.add_argument(
+            "--providers", help='Comma-separated provider[:model] list; default: LLM_PROVIDER and its fallbacks.'
+        )
+        parser.add_argument("--concurrency", type=int, default=4, help="Calls in flight per provider.")
+        parser.add_argument("--retries", type=int, default=2, help="Retries after a timeout, 429 or 5xx.")
+        parser.add_argument("--system", help="System prompt for lines that do not bring their own.")
+        parser.add_argument("--batch", action="store_true", help="Use the Batch API where the provider offers it.")
+        parser.add_argument("--poll", type=float, default=evaluation.BATCH_POLL_SECONDS, help="Batch poll interval.")
+        parser.add_argument("--mock", action="store_true", help="Call an in-process mock LLM (no API credits used).")
+        parser.add_argument("--json", dest="json_path", help="Also write the summary to this file.")
+
+    def handle(self, *args, **options):
+        options["output"] = options["output"] or f"{os.path.splitext(options['input'])[0]}.results.jsonl"
+        if options["mock"]:
+            server = mockllm.start()
+            for p in PROVIDERS.values():
+                os.environ.setdefault(p["key_env"], "mock-key")
+            try:
+                with override_settings(LLM_UPSTREAM_ORIGIN=f"http://127.0.0.1:{server.server_port}"):
+                    rows = self._run(options)
+            finally:
+                server.shutdown()
+        else:
+            rows = self._run(options)
+        self.stdout.write(evaluation.format_header())
+        for row in rows:
+            self.stdout.write(evaluation.format_row(row))
+        self.stdout.write(f"Results in {options['output']}")
+        if options["json_path"]:
+            bench.write_json(rows, options["json_path"])
+
+    def _run(self, options):
+        try:
+            return evaluation.run(options, out=self.stdout.write)
+        except (ValueError, OSError) as e:
+            raise CommandError(str(e))
@@ -0,0 +1,43 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot import retrieval
+
+
+class Command(BaseCommand):
+    help = "Embed a local corpus of problems/editorials into the retrieval index (no network needed)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("corpus", nargs="+", help="Files or directories (.md, .txt, .jsonl).")
+        parser.add_argument("--out", help="Index directory (default: LLM_RAG_INDEX_DIR).")
+        parser.add_argument("--dim", type=int, default=retrieval.DIM, help="Hash buckets per vector.")
+        parser.add_argument(
+            "--ivf", choices=["auto", "on", "off"], default="auto",
+            help=f"Partition into IVF lists (auto: from {retrieval.IVF_MIN_ROWS} snippets).",
+        )
+        parser.add_argument("--lists", type=int, help="IVF lists (default: sqrt of the snippet count).")
+        parser.add_argument("--query", action="append", default=[], help="Search the new index for this text.")
+
+    def handle(self, *args, **options):
+        if retrieval.np is None:
+            raise CommandError("numpy is required for the retrieval index (pip install numpy)")
+        start = time.perf_counter()
+        try:
+            meta = retrieval.build(
+                options["corpus"], options["out"], dim=options["dim"], ivf=options["ivf"], lists=options["lists"]
+            )
+        except (ValueError, OSError) as e:
+            raise CommandError(str(e))
+        out = options["out"] or retrieval.index_dir()
+        self.stdout.write(
+            f"Indexed {meta['count']} snippets ({meta['dim']} dims, {meta['ivf_lists']} IVF lists) "
+            f"into {out} in {time.perf_counter() - start:.1f}s"
+        )
+        if options["query"]:
+            index = retrieval.Index(Path(out))
+            for query, hits in zip(options["query"], index.search_many(options["query"], k=3)):
+                self.stdout.write(f"\n{query}")
+                for hit in hits:
+                    self.stdout.write(f"  {hit['score']:.3f}  {hit['title']}  ({hit['source']})")
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from chatbot import mockllm
+
+
+class Command(BaseCommand):
+    help = "Serve a local OpenAI-compatible/Gemini stub (set LLM_UPSTREAM_ORIGIN to its address)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8900)
+        parser.add_argument("--latency", type=float, default=0.3, help="Seconds before the first byte.")
+        parser.add_argument("--jitter", type=float, default=0.2, help="+/- share of latency.")
+        parser.add_argument("--tokens-per-sec", type=float, default=60.0)
+        parser.add_argument("--reply-tokens", type=int, default=80)
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail (0-1).")
+        parser.add_argument("--error-status", type=int, default=500)
+
+    def handle(self, *args, **options):
+        behaviour = mockllm.Behaviour(
+            latency=options["latency"],
+            jitter=options["jitter"],
+            tokens_per_sec=options["tokens_per_sec"],
+            reply_tokens=options["reply_tokens"],
+            error_rate=options["error_rate"],
+            error_status=options["error_status"],
+        )
+        server = mockllm.MockServer((options["host"], options["port"]), behaviour)
+        self.stdout.write(f"Mock LLM on http://{options['host']}:{server.server_port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot import search
+
+
+class Command(BaseCommand):
+    help = "Check the full-text search index over messages and recreate missing triggers/columns."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default", help="Database alias (default: default).")
+        parser.add_argument("--check", action="store_true", help="Only report; fail if anything is missing.")
+        parser.add_argument("--rebuild", action="store_true", help="Rebuild the SQLite FTS table anyway.")
+
+    def handle(self, *args, **options):
+        using = options["database"]
+        if options["check"]:
+            missing = search.missing_index(using)
+            if missing:
+                raise CommandError(f"Search index incomplete, missing: {', '.join(missing)}")
+            self.stdout.write("Search index OK")
+            return
+        repaired = search.repair_index(using, rebuild=options["rebuild"])
+        if repaired:
+            self.stdout.write(f"Recreated {', '.join(repaired)} and rebuilt the index")
+        else:
+            self.stdout.write("Search index OK" + (" (rebuilt)" if options["rebuild"] else ""))
@@ -0,0 +1,65 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chatbot import jobs
+from chatbot.providers import CONNECT_ERROR_REPLY
+
+logger = logging.getLogger("chatbot.jobs")
+
+REQUEUE_INTERVAL = 30.0
+
+
+class Command(BaseCommand):
+    help = "Process queued LLM generations (LLM_JOB_QUEUE=true) from the database job queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8, help="Jobs run concurrently by this process.")
+        parser.add_argument("--poll", type=float, default=getattr(settings, "LLM_JOB_POLL", 0.5),
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is drained.")
+
+    def handle(self, *args, **options):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"[:64]
+        stopping = threading.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: stopping.set())
+
+        self.stdout.write(f"llm_worker {worker_id}: {options['threads']} threads, "
+                          f"{jobs.concurrency()} running jobs per provider")
+        running = set()
+        requeued_at = 0.0
+        with ThreadPoolExecutor(max_workers=options["threads"], thread_name_prefix="llm-job") as executor:
+            while not stopping.is_set():
+                if time.monotonic() - requeued_at >= REQUEUE_INTERVAL:
+                    requeued_at = time.monotonic()
+                    if jobs.requeue_expired():
+                        logger.warning("requeued abandoned jobs")
+                running = {f for f in running if not f.done()}
+                job = jobs.claim(worker_id) if len(running) < options["threads"] else None
+                if job is not None:
+                    running.add(executor.submit(self._process, job))
+                    continue
+                if options["once"] and not running:
+                    break
+                stopping.wait(options["poll"])
+            # Let claimed jobs finish; an unfinished one would be requeued after its lease
+        self.stdout.write(f"llm_worker {worker_id}: stopped")
+
+    def _process(self, job):
+        try:
+            jobs.run_job(job)
+        except Exception:
+            logger.exception("job %s crashed", job.pk)
+            if jobs.finish(job, CONNECT_ERROR_REPLY, failed=True):
+                job.conversation.append("assistant", CONNECT_ERROR_REPLY)
+        finally:
+            close_old_connections()
@@ -0,0 +1,193 @@
+"""Prometheus metrics for the chat pipeline.
+
+Recording is a no-op unless ``prometheus_client`` is installed and
+METRICS_ENABLED is on. Under gunicorn each worker keeps its own values; set
+PROMETHEUS_MULTIPROC_DIR to a writable directory (wiped at startup by
+gunicorn.conf.py) and /metrics aggregates the files of all workers.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Optional: metrics are only recorded when prometheus_client is installed
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+# The profiling.Profile of the request being handled, or None when it is not profiled
+_profile = contextvars.ContextVar("leetai_profile", default=None)
+
+
+def enabled() -> bool:
+    return prometheus_client is not None and getattr(settings, "METRICS_ENABLED", True)
+
+
+if prometheus_client is not None:
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        "leetai_request_seconds", "Time to serve a request, including streamed bodies.",
+        ["view", "method", "status"], buckets=LATENCY_BUCKETS,
+    )
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "leetai_stage_seconds", "Time spent in one stage of the chat pipeline.",
+        ["stage"], buckets=LATENCY_BUCKETS,
+    )
+    UPSTREAM_SECONDS = prometheus_client.Histogram(
+        "leetai_upstream_seconds", "Upstream LLM call timings (connect, ttfb, total).",
+        ["provider", "model", "phase"], buckets=LATENCY_BUCKETS,
+    )
+    UPSTREAM_TOKENS = prometheus_client.Histogram(
+        "leetai_upstream_tokens", "Tokens per upstream call (prompt, completion, cached prompt), from usage fields.",
+        ["provider", "model", "kind"], buckets=TOKEN_BUCKETS,
+    )
+    UPSTREAM_ERRORS = prometheus_client.Counter(
+        "leetai_upstream_errors", "Failed upstream calls by HTTP status (or timeout/connect).",
+        ["provider", "status"],
+    )
+    RATE_LIMITED = prometheus_client.Counter(
+        "leetai_rate_limited", "Requests refused by admission control (user or provider buckets).",
+        ["scope"],
+    )
+    CACHE_LOOKUPS = prometheus_client.Counter(
+        "leetai_cache_lookups", "Cache lookups by result.",
+        ["cache", "result"],
+    )
+
+
+# --------- Recording ----------
+def observe_stage(stage: str, seconds: float):
+    if enabled():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+@contextmanager
+def timed(stage: str):
+    """Record the duration of the block under ``leetai_stage_seconds{stage=...}``."""
+    profile = _profile.get()
+    if profile is not None:
+        profile.watch_thread()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe_stage(stage, seconds)
+        record_span(stage, start, seconds)
+
+def set_profile(profile):
+    """Report the stages timed from now on in this context to ``profile`` (None stops)."""
+    _profile.set(profile)
+
+def record_span(name: str, start: float, seconds: float):
+    profile = _profile.get()
+    if profile is not None:
+        profile.spans.append((name, start, seconds))
+
+def observe_request(view: str, method: str, status: int, seconds: float):
+    if enabled():
+        REQUEST_SECONDS.labels(view, method, str(status)).observe(seconds)
+
+def record_cache(cache: str, hit: bool):
+    if enabled():
+        CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+def record_rate_limited(scope: str):
+    if enabled():
+        RATE_LIMITED.labels(scope).inc()
+
+def record_error(provider: str, status):
+    if enabled():
+        UPSTREAM_ERRORS.labels(provider, str(status)).inc()
+
+
+class UpstreamCall:
+    """Timings and token usage of one upstream call.
+
+    Pass ``trace``/``atrace`` as the httpx ``trace`` extension to time new
+    connections (pooled connections report no connect time), call
+    ``headers()`` once the response headers arrive and ``finish()`` at the end.
+    """
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.start = time.perf_counter()
+        self._connect_start = None
+        self.connect = None
+        self.ttfb = None
+        self.usage = None
+
+    def trace(self, event, _info):
+        if event == "connection.connect_tcp.started":
+            self._connect_start = time.perf_counter()
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete") and self._connect_start:
+            self.connect = time.perf_counter() - self._connect_start
+
+    async def atrace(self, event, info):
+        self.trace(event, info)
+
+    def headers(self):
+        self.ttfb = time.perf_counter() - self.start
+
+    def record_usage(self, usage):
+        if usage:
+            self.usage = usage
+
+    def finish(self, error_status=None):
+        record_span(f"upstream {self.provider}", self.start, time.perf_counter() - self.start)
+        if not enabled():
+            return
+        labels = (self.provider, self.model)
+        if self.connect is not None:
+            UPSTREAM_SECONDS.labels(*labels, "connect").observe(self.connect)
+        if self.ttfb is not None:
+            UPSTREAM_SECONDS.labels(*labels, "ttfb").observe(self.ttfb)
+        UPSTREAM_SECONDS.labels(*labels, "total").observe(time.perf_counter() - self.start)
+        if error_status is not None:
+            record_error(self.provider, error_status)
+        if self.usage:
+            prompt, completion, cached = self.usage
+            UPSTREAM_TOKENS.labels(*labels, "prompt").observe(prompt)
+            UPSTREAM_TOKENS.labels(*labels, "completion").observe(completion)
+            if cached is not None:
+                UPSTREAM_TOKENS.labels(*labels, "cached").observe(cached)
+
+
+def usage_tokens(provider_name: str, data) -> tuple[int, int, int | None] | None:
+    """(prompt, completion, cached prompt) tokens from a response or stream
+    chunk's usage fields; cached is None when the provider does not report it."""
+    if not isinstance(data, dict):
+        return None
+    if provider_name == "gemini":
+        usage = data.get("usageMetadata") or {}
+        prompt, completion = usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+        cached = usage.get("cachedContentTokenCount")
+    else:
+        usage = data.get("usage") or {}
+        prompt, completion = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        # OpenAI-style details; DeepSeek reports its disk cache hits separately
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", usage.get("prompt_cache_hit_tokens"))
+    if prompt is None and completion is None:
+        return None
+    return int(prompt or 0), int(completion or 0), None if cached is None else int(cached)
+
+
+# --------- Exposition ----------
+def render_latest() -> tuple[bytes, str]:
+    """(body, content type) of the current metrics, merged across workers when multiprocess."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid: int):
+    if prometheus_client is not None and os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
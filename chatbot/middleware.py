@@ -0,0 +1,132 @@
+"""Request middleware for the chatbot app."""
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from . import metrics, profiling, sessions
+
+
+def _view_name(request) -> str:
+    # Label by URL name, not path, to keep the series count bounded
+    match = getattr(request, "resolver_match", None)
+    return (match.view_name if match else None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """Record ``leetai_request_seconds`` for every request.
+
+    Streaming responses are timed until their body has been sent, so SSE
+    chat replies count their full generation time.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        return self._observe(request, self.get_response(request), start)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        return self._observe(request, await self.get_response(request), start)
+
+    def _observe(self, request, response, start):
+        if not metrics.enabled():
+            return response
+
+        def done():
+            metrics.observe_request(_view_name(request), request.method, response.status_code, time.perf_counter() - start)
+
+        if not response.streaming:
+            done()
+        elif response.is_async:
+            response.streaming_content = _atimed_body(response.streaming_content, done)
+        else:
+            response.streaming_content = _timed_body(response.streaming_content, done)
+        return response
+
+
+def _timed_body(content, done):
+    try:
+        yield from content
+    finally:
+        done()
+
+async def _atimed_body(content, done):
+    try:
+        async for chunk in content:
+            yield chunk
+    finally:
+        done()
+
+
+class ProfilingMiddleware:
+    """Profile requests picked by profiling.trigger and let through by profiling.allowed
+    (``?profile=1`` from staff or with the profile token, or sampled).
+
+    Place it before SessionMiddleware so session load and save are part of
+    the profile (the load happens before it starts when it checks for staff). Streaming responses are profiled until their body has been sent.
+    The saved profile's id is returned in the ``X-Profile-Id`` header, unless
+    the response is a stream.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        reason = profiling.trigger(request)
+        if reason is None:
+            return self.get_response(request)
+        try:
+            if not profiling.allowed(request, reason):
+                return self.get_response(request)
+            profile = profiling.Profile(request, reason)
+            profile.begin()
+            try:
+                response = self.get_response(request)
+            except BaseException:
+                profile.end(None)
+                raise
+            return self._finish(profile, response)
+        finally:
+            sessions.share(None)
+
+    async def __acall__(self, request):
+        reason = profiling.trigger(request)
+        if reason is None:
+            return await self.get_response(request)
+        try:
+            if not await sync_to_async(profiling.allowed)(request, reason):
+                return await self.get_response(request)
+            profile = profiling.Profile(request, reason, all_threads=True)
+            profile.begin()
+            try:
+                response = await self.get_response(request)
+            except BaseException:
+                profile.end(None)
+                raise
+            return self._finish(profile, response)
+        finally:
+            sessions.share(None)
+
+    def _finish(self, profile, response):
+        def done():
+            profile.end(response)
+
+        if not response.streaming:
+            response["X-Profile-Id"] = profile.end(response)
+        elif response.is_async:
+            response.streaming_content = _atimed_body(response.streaming_content, done)
+        else:
+            response.streaming_content = _timed_body(response.streaming_content, done)
+        return response
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:32
+
+import chatbot.models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.CharField(default=chatbot.models.new_conversation_id, editable=False, max_length=32, primary_key=True, serialize=False)),
+                ('owner', models.CharField(max_length=64)),
+                ('title', models.CharField(default='New conversation', max_length=200)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', 'updated_at'], name='chatbot_convo_owner_updated')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('role', models.CharField(max_length=16)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chatbot.conversation')),
+            ],
+            options={
+                'ordering': ['seq'],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'seq'), name='chatbot_message_convo_seq')],
+            },
+        ),
+    ]
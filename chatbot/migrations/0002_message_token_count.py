@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:32
+
+from django.db import migrations, models
+
+
+def backfill_token_counts(apps, schema_editor):
+    from chatbot.context import count_tokens
+
+    Message = apps.get_model("chatbot", "Message")
+    batch = []
+    for message in Message.objects.only("id", "content").iterator(chunk_size=500):
+        message.token_count = count_tokens(message.content)
+        batch.append(message)
+        if len(batch) >= 500:
+            Message.objects.bulk_update(batch, ["token_count"])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ["token_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_token_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:53
+
+import chatbot.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.CharField(default=chatbot.models.new_conversation_id, editable=False, max_length=32, primary_key=True, serialize=False)),
+                ('provider', models.CharField(max_length=32)),
+                ('turn', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=8)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('worker', models.CharField(blank=True, default='', max_length=64)),
+                ('lease_until', models.DateTimeField(blank=True, null=True)),
+                ('reply', models.TextField(blank=True, default='')),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='chatbot.conversation')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'provider', 'created_at'], name='chatbot_job_status_provider')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations
+
+# Full-text index over Message.content (see chatbot/search.py). SQLite gets an
+# external-content FTS5 table kept in step by triggers, Postgres a generated
+# tsvector column with a GIN index; both are maintained on every insert.
+#
+# These objects live outside Django's schema state. On SQLite a later migration
+# that remakes chatbot_message (AlterField and most other changes copy the
+# table) drops the triggers without an error. chatbot.search.repair_index
+# recreates them after every `migrate`; `manage.py llm_search_index --check`
+# verifies them.
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE chatbot_message_fts USING fts5("
+    "content, content='chatbot_message', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER chatbot_message_fts_ai AFTER INSERT ON chatbot_message BEGIN "
+    "INSERT INTO chatbot_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER chatbot_message_fts_ad AFTER DELETE ON chatbot_message BEGIN "
+    "INSERT INTO chatbot_message_fts(chatbot_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER chatbot_message_fts_au AFTER UPDATE OF content ON chatbot_message BEGIN "
+    "INSERT INTO chatbot_message_fts(chatbot_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chatbot_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "INSERT INTO chatbot_message_fts(chatbot_message_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS chatbot_message_fts_ai",
+    "DROP TRIGGER IF EXISTS chatbot_message_fts_ad",
+    "DROP TRIGGER IF EXISTS chatbot_message_fts_au",
+    "DROP TABLE IF EXISTS chatbot_message_fts",
+]
+POSTGRES_FORWARD = [
+    "ALTER TABLE chatbot_message ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+    "CREATE INDEX chatbot_message_search ON chatbot_message USING GIN (search_vector)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS chatbot_message_search",
+    "ALTER TABLE chatbot_message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            _run({"sqlite": SQLITE_BACKWARD, "postgresql": POSTGRES_BACKWARD}),
+        ),
+    ]
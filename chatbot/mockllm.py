@@ -0,0 +1,312 @@
+"""Local stand-in for the OpenAI-compatible and Gemini chat endpoints.
+
+Used by the ``llm_mock`` and ``llm_bench`` management commands to exercise
+the app without calling (or paying for) a real provider. Point the app at it
+with LLM_UPSTREAM_ORIGIN=http://127.0.0.1:<port>; any API key is accepted.
+
+Serves ``.../chat/completions`` (``"stream": true`` for SSE),
+``.../models/<model>:generateContent`` and ``:streamGenerateContent?alt=sse``,
+``.../cachedContents``, the OpenAI Batch API (``.../files``, ``.../batches``;
+a batch completes once ``latency`` has passed), plus ``GET /health`` and
+``GET /stats``.
+
+Like the real providers it reports cached prompt tokens in ``usage``: the
+longest message prefix it has already seen (OpenAI style) or the referenced
+``cachedContent`` (Gemini).
+"""
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "Use a hash map to store each value's index, then scan once: for every "
+    "number check whether target minus it was already seen. This runs in O(n) "
+    "time and O(n) space, which beats the nested-loop brute force."
+).split()
+
+
+class Behaviour:
+    """Latency, throughput and failure profile of the mock provider."""
+
+    def __init__(self, latency=0.3, jitter=0.2, tokens_per_sec=60.0, reply_tokens=80,
+                 error_rate=0.0, error_status=500):
+        self.latency = latency  # seconds before the first byte
+        self.jitter = jitter  # +/- share of latency, uniformly distributed
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def first_byte_delay(self):
+        return max(0.0, self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def generation_time(self, tokens):
+        return tokens / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+
+def _reply_tokens(n):
+    return [w + " " for w in itertools.islice(itertools.cycle(WORDS), n)]
+
+def _prompt_tokens(messages):
+    return sum(len(str(m.get("content") or m.get("parts") or "").split()) for m in messages)
+
+def _gemini_prompt(body):
+    return body.get("contents") or [], [body["systemInstruction"]] if body.get("systemInstruction") else []
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "LeetAI-mock"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/health"):
+            return self._send_json(200, {"ok": True})
+        if self.path.startswith("/stats"):
+            return self._send_json(200, self.server.snapshot())
+        path = self.path.split("?", 1)[0]
+        if "/batches/" in path:
+            batch = self.server.batch(path.rsplit("/", 1)[1])
+            return self._send_json(200, batch) if batch else self._send_json(404, {"error": {"message": "no such batch"}})
+        if path.endswith("/content") and "/files/" in path:
+            raw = self.server.file_content(path.split("/files/", 1)[1].rsplit("/", 1)[0])
+            if raw is None:
+                return self._send_json(404, {"error": {"message": "no such file"}})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/jsonl")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            return self.wfile.write(raw)
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/files"):
+            return self._upload(raw)
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"message": "invalid JSON"}})
+
+        if path.endswith("/batches"):
+            batch = self.server.create_batch(body.get("input_file_id"))
+            return self._send_json(200, batch) if batch else self._send_json(404, {"error": {"message": "no such file"}})
+        if path.endswith("/cachedContents"):
+            contents, system = _gemini_prompt(body)
+            name = self.server.store_cached_content(_prompt_tokens(contents + system))
+            return self._send_json(200, {"name": name, "model": body.get("model")})
+        if path.endswith("/chat/completions"):
+            gemini, stream = False, bool(body.get("stream"))
+            messages = body.get("messages") or []
+            cached = self.server.seen_prefix_tokens(messages)
+            prompt = _prompt_tokens(messages)
+        elif path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+            gemini, stream = True, path.endswith(":streamGenerateContent")
+            contents, system = _gemini_prompt(body)
+            cached = self.server.cached_content_tokens(body.get("cachedContent"))
+            prompt = _prompt_tokens(contents + system) + (cached or 0)
+        else:
+            return self._send_json(404, {"error": {"message": f"unknown endpoint {path}"}})
+
+        behaviour = self.server.behaviour
+        self.server.count("requests")
+        time.sleep(behaviour.first_byte_delay())
+        if random.random() < behaviour.error_rate:
+            self.server.count("errors")
+            return self._send_json(
+                behaviour.error_status,
+                {"error": {"message": f"injected error {behaviour.error_status}"}},
+                {"Retry-After": "1"} if behaviour.error_status in (429, 503) else None,
+            )
+
+        tokens = _reply_tokens(behaviour.reply_tokens)
+        usage = (prompt, len(tokens), cached)
+        if stream:
+            self._stream(tokens, usage, gemini)
+        else:
+            time.sleep(behaviour.generation_time(len(tokens)))
+            self._send_json(200, _gemini_body("".join(tokens), usage) if gemini else _openai_body("".join(tokens), usage))
+
+    def _upload(self, raw):
+        """multipart/form-data with a ``file`` part, as sent to ``/files``."""
+        head = f"Content-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode()
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(head + raw)
+        for part in message.iter_parts() if message.is_multipart() else ():
+            if part.get_param("name", header="content-disposition") == "file":
+                return self._send_json(200, self.server.store_file(part.get_payload(decode=True)))
+        self._send_json(400, {"error": {"message": "missing file"}})
+
+    def _stream(self, tokens, usage, gemini):
+        behaviour = self.server.behaviour
+        # Batch tokens so each write is at least ~20ms apart at high token rates
+        per_chunk = max(1, math.ceil(behaviour.tokens_per_sec * 0.02)) if behaviour.tokens_per_sec > 0 else len(tokens)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for i in range(0, len(tokens), per_chunk):
+                chunk = tokens[i:i + per_chunk]
+                time.sleep(behaviour.generation_time(len(chunk)))
+                last = i + per_chunk >= len(tokens)
+                if gemini:
+                    data = _gemini_body("".join(chunk), usage if last else None)
+                else:
+                    data = {"choices": [{"index": 0, "delta": {"content": "".join(chunk)}}]}
+                self.wfile.write(f"data: {json.dumps(data)}\n\n".encode())
+                self.wfile.flush()
+            if not gemini:
+                final = {"choices": [], "usage": _openai_usage(usage)}
+                self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count("disconnects")
+        self.close_connection = True
+
+    def _send_json(self, status, data, headers=None):
+        raw = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+
+def _openai_usage(usage):
+    prompt, completion, cached = usage
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "prompt_tokens_details": {"cached_tokens": cached}}
+
+def _openai_body(text, usage):
+    return {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": _openai_usage(usage),
+    }
+
+def _gemini_body(text, usage=None):
+    body = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+    if usage:
+        body["usageMetadata"] = {"promptTokenCount": usage[0], "candidatesTokenCount": usage[1]}
+        if usage[2] is not None:
+            body["usageMetadata"]["cachedContentTokenCount"] = usage[2]
+    return body
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+    max_prefixes = 100_000
+
+    def __init__(self, address, behaviour=None):
+        super().__init__(address, MockHandler)
+        self.behaviour = behaviour or Behaviour()
+        self._counts = {"requests": 0, "errors": 0, "disconnects": 0, "cached_tokens": 0}
+        self._prefixes = {}  # digest of a message prefix -> its prompt tokens
+        self._cached_contents = {}  # name -> prompt tokens
+        self._files = {}  # id -> bytes (Batch API input and output)
+        self._batches = {}  # id -> batch object
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def seen_prefix_tokens(self, messages) -> int:
+        """Tokens of the longest prefix of ``messages`` sent before; remembers this one."""
+        digest, tokens, cached = hashlib.sha256(), 0, 0
+        with self._lock:
+            for m in messages:
+                digest.update(json.dumps(m, sort_keys=True).encode())
+                tokens += _prompt_tokens([m])
+                key = digest.hexdigest()
+                if key in self._prefixes:
+                    cached = tokens
+                elif len(self._prefixes) < self.max_prefixes:
+                    self._prefixes[key] = tokens
+            self._counts["cached_tokens"] += cached
+        return cached
+
+    def store_cached_content(self, tokens) -> str:
+        with self._lock:
+            name = f"cachedContents/mock-{len(self._cached_contents) + 1}"
+            self._cached_contents[name] = tokens
+        return name
+
+    def cached_content_tokens(self, name):
+        if not name:
+            return None
+        with self._lock:
+            tokens = self._cached_contents.get(name, 0)
+            self._counts["cached_tokens"] += tokens
+        return tokens
+
+    def store_file(self, raw) -> dict:
+        with self._lock:
+            file_id = f"file-mock-{len(self._files) + 1}"
+            self._files[file_id] = raw
+        return {"id": file_id, "object": "file", "bytes": len(raw), "purpose": "batch"}
+
+    def file_content(self, file_id):
+        with self._lock:
+            return self._files.get(file_id)
+
+    def create_batch(self, input_file_id):
+        raw = self.file_content(input_file_id)
+        if raw is None:
+            return None
+        lines = [json.loads(line) for line in raw.decode("utf-8").splitlines() if line.strip()]
+        with self._lock:
+            batch_id = f"batch-mock-{len(self._batches) + 1}"
+            self._batches[batch_id] = {
+                "id": batch_id, "object": "batch", "status": "in_progress", "input_file_id": input_file_id,
+                "output_file_id": None, "error_file_id": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+                "ready_at": time.monotonic() + self.behaviour.latency, "lines": lines,
+            }
+        return self.batch(batch_id)
+
+    def batch(self, batch_id):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            if batch["status"] == "in_progress" and time.monotonic() >= batch["ready_at"]:
+                self._finish_batch(batch)
+            return {k: v for k, v in batch.items() if k not in ("ready_at", "lines")}
+
+    def _finish_batch(self, batch):
+        out = []
+        for line in batch["lines"]:
+            messages = (line.get("body") or {}).get("messages") or []
+            usage = (_prompt_tokens(messages), self.behaviour.reply_tokens, 0)
+            body = _openai_body("".join(_reply_tokens(self.behaviour.reply_tokens)), usage)
+            out.append({"id": f"req-{len(out) + 1}", "custom_id": line.get("custom_id"),
+                        "response": {"status_code": 200, "body": body}, "error": None})
+        output_id = f"file-mock-{len(self._files) + 1}"
+        self._files[output_id] = "".join(json.dumps(o) + "\n" for o in out).encode()
+        self._counts["requests"] += len(out)
+        batch.update(status="completed", output_file_id=output_id)
+        batch["request_counts"]["completed"] = len(out)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+def start(host="127.0.0.1", port=0, behaviour=None) -> MockServer:
+    """Serve in a daemon thread; the bound port is ``server.server_port``."""
+    server = MockServer((host, port), behaviour)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
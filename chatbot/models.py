@@ -1,3 +1,117 @@
-from django.db import models
+import uuid
 
-# Create your models here.
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .context import count_tokens
+
+DEFAULT_TITLE = "New conversation"
+
+
+def new_conversation_id() -> str:
+    return uuid.uuid4().hex
+
+
+class Conversation(models.Model):
+    # Hex id kept from the session era so existing /c/<id>/ links keep working
+    id = models.CharField(primary_key=True, max_length=32, default=new_conversation_id, editable=False)
+    # "user:<pk>" for authenticated users, otherwise an anonymous token kept in the session
+    owner = models.CharField(max_length=64)
+    title = models.CharField(max_length=200, default=DEFAULT_TITLE)
+    message_count = models.PositiveIntegerField(default=0)
+    # Rolling summary of messages with seq < summary_seq (see chatbot/summary.py)
+    summary = models.TextField(blank=True, default="")
+    summary_seq = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["owner", "updated_at"], name="chatbot_convo_owner_updated")]
+
+    def __str__(self):
+        return self.title
+
+    def append(self, role: str, content: str) -> "Message":
+        """Append one message; cost does not depend on the conversation length."""
+        now = timezone.now()
+        with transaction.atomic():
+            # The UPDATE takes the row lock first, so concurrent appends get distinct seqs
+            Conversation.objects.filter(pk=self.pk).update(message_count=F("message_count") + 1, updated_at=now)
+            self.message_count = Conversation.objects.values_list("message_count", flat=True).get(pk=self.pk)
+            self.updated_at = now
+            return Message.objects.create(
+                conversation=self,
+                seq=self.message_count - 1,
+                role=role,
+                content=content,
+                token_count=count_tokens(content),
+            )
+
+    def messages_newest_first(self, batch: int = 32):
+        """Yield role/content/token_count dicts from the newest message back,
+        fetching ``batch`` rows per query so callers can stop early."""
+        rows = self.messages.order_by("-seq").values("seq", "role", "content", "token_count")
+        before = None
+        while True:
+            page = list((rows.filter(seq__lt=before) if before is not None else rows)[:batch])
+            yield from page
+            if len(page) < batch:
+                return
+            before = page[-1]["seq"]
+
+
+class Message(models.Model):
+    # content is full-text indexed by triggers (SQLite) or a generated column (Postgres)
+    # from migration 0005; a table remake drops the triggers, and `migrate` recreates
+    # them afterwards (chatbot.search.repair_index)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
+    seq = models.PositiveIntegerField()
+    role = models.CharField(max_length=16)
+    content = models.TextField()
+    # Computed once on write (chatbot.context.count_tokens) for context packing
+    token_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["seq"]
+        constraints = [
+            models.UniqueConstraint(fields=["conversation", "seq"], name="chatbot_message_convo_seq"),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:60]}"
+
+
+class Job(models.Model):
+    """One queued generation (LLM_JOB_QUEUE); run by ``manage.py llm_worker``."""
+
+    QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+    STATUS_CHOICES = [(s, s) for s in (QUEUED, RUNNING, DONE, FAILED)]
+
+    id = models.CharField(primary_key=True, max_length=32, default=new_conversation_id, editable=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="jobs")
+    # First provider of the chain; the per-provider concurrency limit applies to it
+    provider = models.CharField(max_length=32)
+    # The upstream call prepared by the web tier: chain, packed messages, cache/flight keys
+    turn = models.JSONField(default=dict)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=64, blank=True, default="")
+    # A running job whose lease has expired is requeued (its worker died)
+    lease_until = models.DateTimeField(null=True, blank=True)
+    reply = models.TextField(blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "provider", "created_at"], name="chatbot_job_status_provider")]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
@@ -0,0 +1,267 @@
+"""Opt-in profiles of single requests, stored on disk as flame graphs.
+
+With PROFILING on, ProfilingMiddleware (chatbot/middleware.py) profiles:
+
+- requests that ask for it with ``?profile=1`` or an ``X-Profile: 1``
+  header, from a signed-in staff user or with an ``X-Profile-Token`` header
+  matching PROFILE_TOKEN
+- a random PROFILE_SAMPLE_RATE share of all other requests
+
+At most PROFILE_MAX_PER_MINUTE requests are profiled per minute (counted in
+the default cache); any beyond that are served without a profile.
+
+A profile is made by a sampling thread: every PROFILE_INTERVAL seconds it
+reads the Python stack of the request thread, and of the threads that run a
+metrics.timed stage for it, such as provider attempts (sys._current_frames).
+The cost stays small and does not depend on how many calls the view makes,
+unlike cProfile. It works for streamed replies too. Under ASGI the view's
+work is spread over the event loop and sync_to_async threads, so all busy
+threads are sampled and concurrent requests show up as well.
+
+Each profile also keeps the spans timed by metrics.timed (session
+load/save, build_payload, retrieve, pack_context, render, ...) and one span
+per upstream call. It is saved as one JSON file in PROFILE_DIR, and only the
+newest PROFILE_MAX_FILES are kept. They are listed at ``/admin/profiles/``.
+"""
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from importlib import import_module
+from pathlib import Path
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib import auth
+from django.core.cache import cache
+
+from . import metrics, sessions
+
+# Top frames of threads that are waiting rather than working; these are not sampled,
+# except on the request's own thread, where waiting is part of its time
+IDLE_FRAMES = {"wait", "select", "poll", "accept", "_worker"}
+# Frames narrower than this share of the samples are left out of the flame graph
+MIN_WIDTH = 0.002
+_ID_RE = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9]{3}-[0-9a-f]{6}$")
+
+
+def enabled() -> bool:
+    return getattr(settings, "PROFILING", False)
+
+def profile_dir() -> Path:
+    return Path(getattr(settings, "PROFILE_DIR", None) or Path(settings.BASE_DIR) / ".cache" / "profiles")
+
+def trigger(request) -> str | None:
+    """Why ``request`` should be profiled ("flag" or "sample"), or None.
+
+    Cheap enough for every request; ``allowed`` then decides whether a
+    picked request is really profiled.
+    """
+    if not enabled() or request.path.startswith(settings.STATIC_URL) or request.path.startswith("/admin/profiles"):
+        return None
+    if request.GET.get("profile") == "1" or request.headers.get("x-profile") == "1":
+        return "flag"
+    if random.random() < getattr(settings, "PROFILE_SAMPLE_RATE", 0.0):
+        return "sample"
+    return None
+
+def allowed(request, reason: str) -> bool:
+    """Whether to profile a request picked by ``trigger``: a "flag" needs the
+    profile token or a staff session, and every profile needs a free slot this
+    minute. Before the sampler starts, so nobody else can make it run."""
+    if reason == "flag" and not (_has_token(request) or _is_staff(request)):
+        return False
+    return _take_slot()
+
+def _has_token(request) -> bool:
+    token = getattr(settings, "PROFILE_TOKEN", "")
+    return bool(token) and hmac.compare_digest(request.headers.get("x-profile-token", ""), token)
+
+def _is_staff(request) -> bool:
+    # SessionMiddleware has not run yet, so read the session here; its store then
+    # reuses this one rather than loading the session again
+    key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not key:
+        return False
+    store = import_module(settings.SESSION_ENGINE).SessionStore(key)
+    user = auth.get_user(SimpleNamespace(session=store))
+    sessions.share(store)
+    return user.is_active and user.is_staff
+
+def _take_slot() -> bool:
+    limit = getattr(settings, "PROFILE_MAX_PER_MINUTE", 30)
+    key = f"profiles:{int(time.time() // 60)}"
+    cache.add(key, 0, timeout=120)
+    try:
+        return cache.incr(key) <= limit
+    except ValueError:
+        return False  # expired in between; skip this one
+
+
+# --------- Sampling ----------
+# Longest first, so a site-packages path is shortened past the stdlib prefix
+_ROOTS = sorted({str(p) for p in sys.path if p} | {str(settings.BASE_DIR)}, key=len, reverse=True)
+
+def _label(code) -> str:
+    path = code.co_filename
+    for root in _ROOTS:
+        if path.startswith(root):
+            path = path[len(root):].lstrip(os.sep)
+            break
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+def _stack(frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Profile:
+    """One profiled request: stack samples taken by a background thread, plus spans."""
+
+    def __init__(self, request, reason: str, all_threads: bool = False):
+        self.request = request
+        self.reason = reason
+        self.interval = getattr(settings, "PROFILE_INTERVAL", 0.005)
+        self.samples = Counter()
+        self.spans = []
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self._origin = threading.get_ident()
+        # None samples every thread
+        self._threads = None if all_threads else {self._origin}
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="leetai-profiler", daemon=True)
+
+    def begin(self):
+        metrics.set_profile(self)
+        self._sampler.start()
+
+    def watch_thread(self):
+        """Sample the calling thread too (metrics.timed calls this for each stage)."""
+        if self._threads is not None:
+            self._threads.add(threading.get_ident())
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            threads = None if self._threads is None else set(self._threads)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (threads is not None and thread_id not in threads):
+                    continue
+                if thread_id != self._origin and frame.f_code.co_name in IDLE_FRAMES:
+                    continue
+                self.samples[_stack(frame)] += 1
+
+    def end(self, response) -> str:
+        """Stop sampling and save the profile (``response`` is None when the view
+        raised); returns its id."""
+        self.seconds = time.perf_counter() - self.start
+        self._stop.set()
+        self._sampler.join()
+        metrics.set_profile(None)
+        return save(self._record(response))
+
+    def _record(self, response) -> dict:
+        match = getattr(self.request, "resolver_match", None)
+        return {
+            # Sorts by time, which rotation and the list rely on
+            "id": "{}-{:03d}-{}".format(
+                time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started)),
+                int(self.started * 1000) % 1000, uuid.uuid4().hex[:6],
+            ),
+            "started": self.started,
+            "seconds": self.seconds,
+            "method": self.request.method,
+            "path": self.request.get_full_path(),
+            "view": (match.view_name if match else None) or "unmatched",
+            "status": response.status_code if response is not None else 500,
+            "reason": self.reason,
+            "interval": self.interval,
+            "spans": [
+                {"name": name, "start": start - self.start, "seconds": seconds}
+                for name, start, seconds in sorted(self.spans, key=lambda span: span[1])
+            ],
+            "samples": dict(self.samples),
+        }
+
+
+# --------- Storage ----------
+def save(record: dict) -> str:
+    """Write ``record`` and drop the oldest profiles beyond PROFILE_MAX_FILES."""
+    folder = profile_dir()
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f"{record['id']}.json"
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(record))
+    os.replace(tmp, path)
+    keep = getattr(settings, "PROFILE_MAX_FILES", 200)
+    for old in sorted(folder.glob("*.json"), reverse=True)[keep:]:
+        old.unlink(missing_ok=True)
+    return record["id"]
+
+def recent(limit: int = 100) -> list[dict]:
+    """Summaries of the newest profiles, without their samples."""
+    found = []
+    for path in sorted(profile_dir().glob("*.json"), reverse=True)[:limit]:
+        try:
+            record = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue  # rotated away or half-written
+        record["sample_count"] = sum(record.pop("samples").values())
+        found.append(record)
+    return found
+
+def load(profile_id: str) -> dict | None:
+    if not _ID_RE.match(profile_id):
+        return None
+    try:
+        return json.loads((profile_dir() / f"{profile_id}.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+# --------- Flame graph ----------
+def flame(samples: dict) -> tuple[list[dict], int]:
+    """Boxes of a flame graph of collapsed ``samples`` (root at the top), and its depth.
+
+    Each box has its label, sample count, depth, and left offset and width
+    as percentages of all samples.
+    """
+    total = sum(samples.values())
+    if not total:
+        return [], 0
+    tree = {}
+    for stack, count in samples.items():
+        node = tree
+        for label in stack.split(";"):
+            entry = node.setdefault(label, [0, {}])
+            entry[0] += count
+            node = entry[1]
+
+    boxes = []
+
+    def place(children, depth, left):
+        for label, (count, grandchildren) in sorted(children.items()):
+            if count / total >= MIN_WIDTH:
+                boxes.append({
+                    "label": label, "samples": count, "depth": depth,
+                    "left": 100.0 * left / total, "width": 100.0 * count / total,
+                    # One colour per file, stable across processes
+                    "hue": 10 + zlib.crc32(label.rsplit(" (", 1)[-1].split(":", 1)[0].encode()) % 50,
+                })
+                place(grandchildren, depth + 1, left)
+            left += count
+
+    place(tree, 0, 0)
+    return boxes, 1 + max(box["depth"] for box in boxes) if boxes else 0
@@ -0,0 +1,120 @@
+"""Provider-side prompt caching.
+
+Providers keep the processed prefix of recent prompts and serve a request that
+starts with the same tokens faster and cheaper (OpenAI, DeepSeek, Groq and
+Gemini do so automatically). Prompts are therefore built prefix-first and
+byte-stable: mentor prompt, summary, then the transcript in order, and
+pack_messages moves the window start only every LLM_CONTEXT_ALIGN messages.
+
+On top of that:
+
+- OpenAI gets a ``prompt_cache_key`` derived from the conversation's opening,
+  so all turns of a conversation are routed to the same cache.
+- Gemini explicit context caching (LLM_GEMINI_CONTEXT_CACHE): once a
+  conversation's prefix has grown by LLM_GEMINI_CACHE_MIN_TOKENS, a background
+  thread stores it as a ``cachedContents`` resource and later turns send only
+  what follows it. Resource names live in the default cache for slightly less
+  than their TTL.
+
+Cached-token counts from each provider's ``usage`` are recorded as
+``leetai_upstream_tokens{kind="cached"}``.
+"""
+import hashlib
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .clients import get_client
+from .context import count_tokens
+
+logger = logging.getLogger(__name__)
+
+_LOCK_TIMEOUT = 60
+# Prefix lengths (in Gemini contents) checked for an existing cache entry
+MAX_LOOKBACK = 64
+
+
+def stable_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, sort_keys=True)
+
+def _digest(value) -> str:
+    return hashlib.sha256(stable_json(value).encode("utf-8")).hexdigest()
+
+
+# --------- OpenAI ----------
+def openai_cache_key(messages) -> str:
+    """Same for every turn of a conversation: system messages and first user message."""
+    opening = []
+    for m in messages:
+        opening.append([m.get("role"), m.get("content", "")])
+        if m.get("role") != "system":
+            break
+    return "leetai-" + _digest(opening)[:32]
+
+
+# --------- Gemini cached contents ----------
+def gemini_enabled() -> bool:
+    return getattr(settings, "LLM_GEMINI_CONTEXT_CACHE", False)
+
+def _min_tokens() -> int:
+    return getattr(settings, "LLM_GEMINI_CACHE_MIN_TOKENS", 4096)
+
+def _ttl() -> int:
+    return getattr(settings, "LLM_GEMINI_CACHE_TTL", 600)
+
+def _prefix_key(model, system_instruction, contents) -> str:
+    return "gemini-cache:" + _digest([model, system_instruction, contents])
+
+def _tokens(contents) -> int:
+    return sum(count_tokens(part.get("text", "")) for c in contents for part in c["parts"])
+
+def gemini_lookup(model, system_instruction, contents):
+    """(cached content name, contents after it) for the longest cached prefix,
+    or (None, contents). At least the newest message is always left to send."""
+    if not gemini_enabled() or len(contents) < 2:
+        return None, contents
+    lengths = range(len(contents) - 1, max(0, len(contents) - 1 - MAX_LOOKBACK), -1)
+    keys = {n: _prefix_key(model, system_instruction, contents[:n]) for n in lengths}
+    found = cache.get_many(list(keys.values()))
+    for n in lengths:
+        name = found.get(keys[n])
+        if name:
+            return name, contents[n:]
+    return None, contents
+
+def gemini_maybe_store(url, model, system_instruction, contents, remaining):
+    """Cache everything but the newest message in the background, once the
+    part not yet covered by a cached prefix (``remaining``) is worth it."""
+    if not gemini_enabled() or len(contents) < 2 or _tokens(remaining[:-1]) < _min_tokens():
+        return
+    prefix = contents[:-1]
+    key = _prefix_key(model, system_instruction, prefix)
+    if not cache.add(f"{key}:lock", 1, timeout=_LOCK_TIMEOUT):
+        return
+    threading.Thread(
+        target=_store, args=(url, key, model, system_instruction, prefix), name="gemini-cache", daemon=True
+    ).start()
+
+def _store(url, key, model, system_instruction, prefix):
+    body = {"model": f"models/{model}", "contents": prefix, "ttl": f"{_ttl()}s"}
+    if system_instruction:
+        body["systemInstruction"] = system_instruction
+    try:
+        r = get_client("gemini").post(url, json=body)
+        if r.status_code >= 400:
+            logger.warning("gemini cachedContents failed: %s %s", r.status_code, r.text[:300])
+            return
+        name = r.json().get("name")
+        if name:
+            # Expire our handle well before the provider drops the resource
+            cache.set(key, name, timeout=max(1, _ttl() - 60))
+            logger.info("gemini cached %d contents as %s", len(prefix), name)
+    except Exception:
+        logger.exception("gemini cachedContents failed")
+    finally:
+        cache.delete(f"{key}:lock")
+        close_old_connections()
@@ -0,0 +1,558 @@
+"""Upstream LLM provider client.
+
+The provider catalog plus everything needed to call one (provider, model)
+pair, sync or async, whole or streamed: request building (prompt caching,
+Gemini adapters), pooled httpx clients, error mapping to UpstreamError,
+per-call metrics and provider-side admission control. ``complete`` and
+``open_stream`` walk a chain of pairs with routing's failover and hedging.
+A deadlines.Budget passed to a call sizes its timeout and ``max_tokens``
+and lets a stopped request end the upstream call between deltas.
+
+Used by the chat views, the job worker and ``manage.py llm_eval``.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics, prompt_cache, ratelimit, routing
+from .clients import get_async_client, get_client
+from .context import message_tokens
+from .routing import Cancelled, Throttled, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# --------- Provider catalog (OpenAI-compatible /chat/completions) ----------
+# cost_per_mtok: approximate USD per 1M output tokens for the default model (adaptive routing)
+# rpm/tpm: published requests/tokens per minute for the default model at the entry paid
+# tier (None: no fixed limit); admission control (chatbot/ratelimit.py) stays under them
+# prompt_cache_key: accepts OpenAI's prompt_cache_key routing hint (chatbot/prompt_cache.py)
+# batch: offers OpenAI's Batch API (/files + /batches) next to /chat/completions (llm_eval --batch)
+PROVIDERS = {
+    "deepseek": {
+        "url": "https://api.deepseek.com/chat/completions",
+        "key_env": "DEEPSEEK_API_KEY",
+        "default_model": "deepseek-chat",
+        "cost_per_mtok": 1.1,
+        "rpm": None,
+        "tpm": None,
+        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
+    },
+    "groq": {
+        "url": "https://api.groq.com/openai/v1/chat/completions",
+        "key_env": "GROQ_API_KEY",
+        "default_model": "llama-3.1-70b-versatile",
+        "cost_per_mtok": 0.79,
+        "rpm": 30,
+        "tpm": 6000,
+        "batch": True,
+        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
+    },
+    "together": {
+        "url": "https://api.together.xyz/v1/chat/completions",
+        "key_env": "TOGETHER_API_KEY",
+        "default_model": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
+        "cost_per_mtok": 0.88,
+        "rpm": 600,
+        "tpm": 180000,
+        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
+    },
+    "openrouter": {
+        "url": "https://openrouter.ai/api/v1/chat/completions",
+        "key_env": "OPENROUTER_API_KEY",
+        "default_model": "openai/gpt-4o-mini",
+        "cost_per_mtok": 0.6,
+        "rpm": None,
+        "tpm": None,
+        "headers": lambda key, req: {
+            "Authorization": f"Bearer {key}",
+            "HTTP-Referer": (req.build_absolute_uri("/") if req else getattr(settings, "SITE_URL", "")),
+            "X-Title": "LeetAI",
+        },
+    },
+    "openai": {
+        "url": "https://api.openai.com/v1/chat/completions",
+        "key_env": "OPENAI_API_KEY",
+        "default_model": "gpt-4o-mini",
+        "cost_per_mtok": 0.6,
+        "rpm": 500,
+        "tpm": 200000,
+        "prompt_cache_key": True,
+        "batch": True,
+        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
+    },
+    "gemini": {
+        "url": "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent",
+        "stream_url": "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse",
+        "cache_url": "https://generativelanguage.googleapis.com/v1beta/cachedContents",
+        "key_env": "GEMINI_API_KEY",
+        "default_model": "gemini-1.5-flash",
+        "cost_per_mtok": 0.3,
+        "rpm": 2000,
+        "tpm": 4000000,
+        "headers": lambda key, _req: {"Content-Type": "application/json"},
+    },
+}
+
+# --------- Gemini adapters ----------
+def _to_gemini_request(messages):
+    """(systemInstruction or None, contents) for a Gemini call.
+
+    Leading system messages become the systemInstruction, so every turn starts
+    with the same prefix; a later system message is folded into the next user turn.
+    """
+    lead = 0
+    while lead < len(messages) and messages[lead].get("role") == "system":
+        lead += 1
+    system_instruction = None
+    if lead:
+        system_instruction = {"parts": [{"text": "\n".join(m.get("content", "") for m in messages[:lead])}]}
+    contents = []
+    sys_prefix = ""
+    for m in messages[lead:]:
+        role = m.get("role")
+        if role == "system":
+            sys_prefix += m.get("content", "") + "\n"
+            continue
+        if role not in ("user", "assistant"):
+            continue
+        text = m.get("content", "")
+        if role == "user" and sys_prefix:
+            text = sys_prefix + text
+            sys_prefix = ""
+        contents.append({"role": "user" if role == "user" else "model", "parts": [{"text": text}]})
+    return system_instruction, contents
+
+def _parse_gemini_reply(resp_json):
+    try:
+        cands = resp_json.get("candidates") or []
+        if not cands:
+            return ""
+        parts = ((cands[0].get("content") or {}).get("parts") or [])
+        for p in parts:
+            if "text" in p:
+                return p["text"]
+        return ""
+    except Exception:
+        return ""
+
+# --------- Provider selection ----------
+def select_provider() -> str:
+    name = os.environ.get("LLM_PROVIDER", "openai").lower()
+    return name if name in PROVIDERS else "openai"
+
+def get_api_key(var_name: str) -> str:
+    raw = os.environ.get(var_name) or getattr(settings, var_name, None) or ""
+    return str(raw).strip().strip('"').strip("'")
+
+def provider_chain():
+    """(provider, model) pairs to try in order: LLM_PROVIDER, then LLM_FALLBACK_PROVIDERS.
+
+    Providers without an API key are left out. With LLM_ROUTING=adaptive the
+    pairs are re-ordered by live latency/error/cost statistics.
+    """
+    primary = select_provider()
+    chain = [(primary, (os.environ.get("LLM_MODEL") or PROVIDERS[primary]["default_model"]).strip())]
+    for name in getattr(settings, "LLM_FALLBACK_PROVIDERS", []):
+        if name in PROVIDERS and name not in {n for n, _ in chain}:
+            chain.append((name, PROVIDERS[name]["default_model"]))
+    chain = [(n, m) for n, m in chain if get_api_key(PROVIDERS[n]["key_env"])]
+    if getattr(settings, "LLM_ROUTING", "static") == "adaptive":
+        chain = routing.order_chain(chain, provider_costs())
+    return chain
+
+def provider_costs():
+    return {name: p.get("cost_per_mtok", 0.0) for name, p in PROVIDERS.items()}
+
+# --------- Upstream calls ----------
+def build_request(provider_name, model, messages_payload, request=None, stream=False, max_tokens=None):
+    """Return (url, headers, payload) for one chat completion call."""
+    with metrics.timed("build_payload"):
+        return _upstream_request(provider_name, model, messages_payload, request, stream, max_tokens)
+
+async def abuild_request(provider_name, model, messages_payload, request=None, stream=False, max_tokens=None):
+    if provider_name == "gemini" and prompt_cache.gemini_enabled():
+        # Cached-prefix lookups may hit the database cache
+        return await sync_to_async(build_request, thread_sensitive=False)(
+            provider_name, model, messages_payload, request, stream, max_tokens
+        )
+    return build_request(provider_name, model, messages_payload, request, stream, max_tokens)
+
+def provider_url(p, which="url") -> str:
+    """Catalog URL, moved to LLM_UPSTREAM_ORIGIN when that is set."""
+    url = p[which]
+    origin = getattr(settings, "LLM_UPSTREAM_ORIGIN", "")
+    if origin:
+        parts = urlsplit(url)
+        url = origin + url[len(f"{parts.scheme}://{parts.netloc}"):]
+    return url
+
+def _upstream_request(provider_name, model, messages_payload, request, stream, max_tokens=None):
+    p = PROVIDERS[provider_name]
+    if provider_name == "gemini":
+        key = get_api_key(p["key_env"])
+        base = provider_url(p, "stream_url" if stream else "url").format(model=model)
+        sep = "&" if "?" in base else "?"
+        url = f"{base}{sep}key={key}"
+        headers = {"Content-Type": "application/json"}
+        system_instruction, contents = _to_gemini_request(messages_payload)
+        cached, remaining = prompt_cache.gemini_lookup(model, system_instruction, contents)
+        payload = {"contents": remaining}
+        if cached:
+            payload["cachedContent"] = cached  # holds the systemInstruction too
+        elif system_instruction:
+            payload["systemInstruction"] = system_instruction
+        prompt_cache.gemini_maybe_store(
+            f"{provider_url(p, 'cache_url')}?key={key}", model, system_instruction, contents, remaining
+        )
+        if max_tokens:
+            payload["generationConfig"] = {"maxOutputTokens": max_tokens}
+    else:
+        url = provider_url(p)
+        headers = p["headers"](get_api_key(p["key_env"]), request)
+        headers["Content-Type"] = "application/json"
+        payload = {"model": model, "messages": messages_payload}
+        if p.get("prompt_cache_key"):
+            payload["prompt_cache_key"] = prompt_cache.openai_cache_key(messages_payload)
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}  # final chunk carries token usage
+    return url, headers, payload
+
+def _error_reply(provider_name, r) -> str:
+    if r.status_code in (401, 403):
+        return f"{provider_name} rejected the key (HTTP {r.status_code}). Verify the key and referer/domain settings."
+    if r.status_code == 402:
+        return f"{provider_name} returned 402 (billing required)."
+    body = r.text[:1200]
+    logger.error("%s error %s: %s", provider_name, r.status_code, body)
+    try:
+        j = r.json()
+        msg = (j.get("error") or {}).get("message") or j.get("message") or body
+    except Exception:
+        msg = body
+    return f"Upstream error {r.status_code}: {msg}"
+
+def _http_error(provider_name, r) -> UpstreamError:
+    retriable = r.status_code == 429 or r.status_code >= 500
+    if r.status_code == 429 or (r.status_code == 503 and "retry-after" in r.headers):
+        # Honour the provider's Retry-After for every worker instead of hammering it
+        seconds = ratelimit.retry_after_seconds(r.headers.get("retry-after"))
+        ratelimit.block(provider_name, seconds)
+        if r.status_code == 429:
+            logger.warning("%s rate-limited us; holding calls for %.1fs", provider_name, seconds)
+            reply = ratelimit.PROVIDER_REPLY.format(provider=provider_name, seconds=max(1, round(seconds)))
+            return UpstreamError(reply, status=429, retriable=True)
+    return UpstreamError(_error_reply(provider_name, r), status=r.status_code, retriable=retriable)
+
+def parse_reply(provider_name, data) -> str:
+    if provider_name == "gemini":
+        return _parse_gemini_reply(data)
+    choice0 = (data.get("choices") or [{}])[0]
+    return (choice0.get("message") or {}).get("content") or choice0.get("text") or ""
+
+def _hit_token_limit(provider_name, data) -> bool:
+    """Whether a reply (or stream chunk) ended because it reached max_tokens."""
+    if provider_name == "gemini":
+        return any(c.get("finishReason") == "MAX_TOKENS" for c in data.get("candidates") or [])
+    return any(c.get("finish_reason") == "length" for c in data.get("choices") or [])
+
+def _limits(provider_name, model, budget, messages):
+    """(max_tokens, httpx timeout) for one call of ``messages`` under ``budget``;
+    raises UpstreamError when too little time is left to start it."""
+    if budget is None:
+        return None, httpx.USE_CLIENT_DEFAULT
+    max_tokens = budget.max_tokens(provider_name, model, prompt_tokens(messages))
+    seconds = budget.call_timeout()
+    return max_tokens, httpx.Timeout(seconds, connect=min(seconds, getattr(settings, "LLM_CONNECT_TIMEOUT", 10.0)))
+
+async def _alimits(provider_name, model, budget, messages):
+    if budget is None:
+        return None, httpx.USE_CLIENT_DEFAULT
+    # Observed speeds live in the default cache, which may be the database
+    return await sync_to_async(_limits, thread_sensitive=False)(provider_name, model, budget, messages)
+
+TIMEOUT_REPLY = "The model request timed out. Please try again."
+CONNECT_ERROR_REPLY = "Unexpected error contacting model. Please try again."
+EMPTY_REPLY = "The model returned an empty reply."
+
+def _error_status(exc) -> str:
+    """Metrics label for a failed upstream call."""
+    if isinstance(exc, UpstreamError) and exc.status:
+        return str(exc.status)
+    if isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    return "connect"
+
+def call_provider(provider_name, model, messages_payload, request=None, call=None, budget=None, cancel=None) -> str:
+    """One non-streaming completion. Pass a metrics.UpstreamCall as ``call`` to
+    read its timings and token usage afterwards.
+
+    With a ``budget`` or a ``cancel`` event (set by routing when a hedged
+    attempt loses) the reply is streamed upstream and assembled here: a
+    blocked read cannot be interrupted, but a stream can be closed between
+    deltas, so the provider stops generating (and billing) the reply."""
+    if budget is not None or cancel is not None:
+        reply = "".join(stream_provider(provider_name, model, messages_payload, request, budget, cancel))
+        return reply.strip() or EMPTY_REPLY
+    url, headers, payload = build_request(provider_name, model, messages_payload, request)
+    call = call or metrics.UpstreamCall(provider_name, model)
+    try:
+        with get_client(provider_name).stream(
+            "POST", url, headers=headers, json=payload, extensions={"trace": call.trace}
+        ) as r:
+            call.headers()
+            r.read()
+        if r.status_code >= 400:
+            raise _http_error(provider_name, r)
+        data = r.json()
+    except httpx.TimeoutException as e:
+        call.finish(_error_status(e))
+        raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+    except httpx.HTTPError as e:
+        call.finish(_error_status(e))
+        logger.exception("upstream request failed (provider=%s)", provider_name)
+        raise UpstreamError(CONNECT_ERROR_REPLY, retriable=True)
+    except UpstreamError as e:
+        call.finish(_error_status(e))
+        raise
+    call.record_usage(metrics.usage_tokens(provider_name, data))
+    call.finish()
+    return parse_reply(provider_name, data).strip() or EMPTY_REPLY
+
+async def acall_provider(provider_name, model, messages_payload, request=None, call=None, budget=None) -> str:
+    """Async call_provider; a stopped request cancels the task awaiting it,
+    which closes the upstream request."""
+    max_tokens, timeout = await _alimits(provider_name, model, budget, messages_payload)
+    url, headers, payload = await abuild_request(provider_name, model, messages_payload, request, max_tokens=max_tokens)
+    call = call or metrics.UpstreamCall(provider_name, model)
+    try:
+        async with get_async_client(provider_name).stream(
+            "POST", url, headers=headers, json=payload, timeout=timeout, extensions={"trace": call.atrace}
+        ) as r:
+            call.headers()
+            await r.aread()
+        if r.status_code >= 400:
+            raise _http_error(provider_name, r)
+        data = r.json()
+    except httpx.TimeoutException as e:
+        call.finish(_error_status(e))
+        raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+    except httpx.HTTPError as e:
+        call.finish(_error_status(e))
+        logger.exception("upstream request failed (provider=%s)", provider_name)
+        raise UpstreamError(CONNECT_ERROR_REPLY, retriable=True)
+    except UpstreamError as e:
+        call.finish(_error_status(e))
+        raise
+    call.record_usage(metrics.usage_tokens(provider_name, data))
+    call.finish()
+    if budget is not None and _hit_token_limit(provider_name, data):
+        budget.truncated = True
+    return parse_reply(provider_name, data).strip() or EMPTY_REPLY
+
+def _stream_line_text(provider_name, line, call=None, budget=None):
+    """Text delta carried by one SSE line (OpenAI-style or Gemini alt=sse); None ends the stream.
+
+    Token usage found in the chunk is handed to ``call`` (a metrics.UpstreamCall),
+    and a reply cut off by max_tokens marks ``budget`` as truncated.
+    """
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return None
+    try:
+        chunk = json.loads(data)
+    except ValueError:
+        return ""
+    if call is not None:
+        call.record_usage(metrics.usage_tokens(provider_name, chunk))
+    if budget is not None and _hit_token_limit(provider_name, chunk):
+        budget.truncated = True
+    if provider_name == "gemini":
+        return _parse_gemini_reply(chunk)
+    choice0 = (chunk.get("choices") or [{}])[0]
+    return (choice0.get("delta") or {}).get("content") or choice0.get("text") or ""
+
+def stream_provider(provider_name, model, messages_payload, request=None, budget=None, cancel=None):
+    """Generator of reply deltas; raises UpstreamError on failure.
+
+    Raises Cancelled once the request is stopped (``budget``) or the attempt is
+    no longer wanted (``cancel``, a threading.Event), and ends early (marking
+    the budget truncated) when the deadline passes."""
+    max_tokens, timeout = _limits(provider_name, model, budget, messages_payload)
+    url, headers, payload = build_request(
+        provider_name, model, messages_payload, request, stream=True, max_tokens=max_tokens
+    )
+    call = metrics.UpstreamCall(provider_name, model)
+    error_status = None
+    try:
+        with get_client(provider_name).stream(
+            "POST", url, headers=headers, json=payload, timeout=timeout, extensions={"trace": call.trace}
+        ) as r:
+            call.headers()
+            if r.status_code >= 400:
+                r.read()
+                raise _http_error(provider_name, r)
+            for line in r.iter_lines():
+                if (budget is not None and budget.cancelled()) or (cancel is not None and cancel.is_set()):
+                    raise Cancelled()
+                if budget is not None and budget.expired():
+                    budget.truncated = True
+                    return
+                text = _stream_line_text(provider_name, line, call, budget)
+                if text is None:
+                    return
+                if text:
+                    yield text
+    except httpx.TimeoutException as e:
+        error_status = _error_status(e)
+        raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+    except httpx.HTTPError as e:
+        error_status = _error_status(e)
+        logger.exception("upstream stream failed (provider=%s)", provider_name)
+        raise UpstreamError(CONNECT_ERROR_REPLY, retriable=True)
+    except Cancelled:
+        raise  # closed on purpose; not an upstream error
+    except UpstreamError as e:
+        error_status = _error_status(e)
+        raise
+    finally:
+        call.finish(error_status)
+
+async def astream_provider(provider_name, model, messages_payload, request=None, budget=None):
+    max_tokens, timeout = await _alimits(provider_name, model, budget, messages_payload)
+    url, headers, payload = await abuild_request(
+        provider_name, model, messages_payload, request, stream=True, max_tokens=max_tokens
+    )
+    call = metrics.UpstreamCall(provider_name, model)
+    error_status = None
+    try:
+        async with get_async_client(provider_name).stream(
+            "POST", url, headers=headers, json=payload, timeout=timeout, extensions={"trace": call.atrace}
+        ) as r:
+            call.headers()
+            if r.status_code >= 400:
+                await r.aread()
+                raise _http_error(provider_name, r)
+            async for line in r.aiter_lines():
+                if budget is not None and await budget.acancelled():
+                    raise Cancelled()
+                if budget is not None and budget.expired():
+                    budget.truncated = True
+                    return
+                text = _stream_line_text(provider_name, line, call, budget)
+                if text is None:
+                    return
+                if text:
+                    yield text
+    except httpx.TimeoutException as e:
+        error_status = _error_status(e)
+        raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+    except httpx.HTTPError as e:
+        error_status = _error_status(e)
+        logger.exception("upstream stream failed (provider=%s)", provider_name)
+        raise UpstreamError(CONNECT_ERROR_REPLY, retriable=True)
+    except Cancelled:
+        raise  # closed on purpose; not an upstream error
+    except UpstreamError as e:
+        error_status = _error_status(e)
+        raise
+    finally:
+        call.finish(error_status)
+
+# --------- Admission control ----------
+def prompt_tokens(messages) -> int:
+    return sum(message_tokens(m.get("content", "")) for m in messages)
+
+def admission(name, messages):
+    """Seconds to wait before calling the provider, per its rate-limit buckets;
+    raises Throttled when it is over its limits so failover moves on."""
+    limits = ratelimit.provider_limits(name, PROVIDERS[name])
+    admitted, wait = ratelimit.reserve_provider(name, limits, prompt_tokens(messages))
+    if not admitted:
+        reply = ratelimit.PROVIDER_REPLY.format(provider=name, seconds=max(1, round(wait)))
+        raise Throttled(reply)
+    return wait
+
+def admitted(name, messages, start, cancel=None):
+    """Run ``start()`` once the provider admits the call; after an upstream 429
+    (whose Retry-After now holds the provider) wait it out and try once more.
+    Raises Cancelled instead when ``cancel`` is set while it waits."""
+    for retry in (False, True):
+        delay = admission(name, messages)
+        if cancel is None:
+            time.sleep(delay)
+        elif cancel.wait(delay):
+            raise Cancelled()
+        try:
+            return start()
+        except UpstreamError as e:
+            if e.status != 429 or retry:
+                raise
+
+async def aadmitted(name, messages, start):
+    for retry in (False, True):
+        await asyncio.sleep(await sync_to_async(admission)(name, messages))
+        try:
+            return await start()
+        except UpstreamError as e:
+            if e.status != 429 or retry:
+                raise
+
+# --------- Provider chains ----------
+def complete(chain, messages, request=None, budget=None) -> str:
+    """Non-streaming completion over a provider chain (failover/hedging)."""
+    _name, reply = routing.call_with_failover(
+        chain,
+        lambda name, model, cancel: admitted(
+            name, messages,
+            lambda: call_provider(name, model, messages, request, budget=budget, cancel=cancel),
+            cancel,
+        ),
+        budget,
+    )
+    return reply
+
+def open_stream(chain, messages, request=None, budget=None):
+    """Start streaming over a provider chain; returns a stream of deltas."""
+    _name, stream = routing.call_with_failover(
+        chain,
+        lambda name, model, cancel: admitted(
+            name, messages,
+            lambda: routing.prime(stream_provider(name, model, messages, request, budget, cancel), name, model),
+            cancel,
+        ),
+        budget,
+    )
+    return stream
+
+async def acomplete(chain, messages, request=None, budget=None) -> str:
+    _name, reply = await routing.acall_with_failover(
+        chain,
+        lambda name, model: aadmitted(
+            name, messages, lambda: acall_provider(name, model, messages, request, budget=budget)
+        ),
+        budget,
+    )
+    return reply
+
+async def aopen_stream(chain, messages, request=None, budget=None):
+    _name, stream = await routing.acall_with_failover(
+        chain,
+        lambda name, model: aadmitted(
+            name, messages,
+            lambda: routing.aprime(astream_provider(name, model, messages, request, budget), name, model),
+        ),
+        budget,
+    )
+    return stream
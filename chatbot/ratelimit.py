@@ -0,0 +1,139 @@
+"""Token-bucket admission control in front of the model call (LLM_RATE_LIMIT).
+
+Each user and each provider has a requests/min and a tokens/min bucket in
+the default cache, refilled continuously. A request that does not fit waits
+(LLM_RATE_LIMIT_MODE=wait) or is rejected; an upstream Retry-After blocks
+that provider for as long as it asks.
+"""
+import time
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+LOCK_TIMEOUT = 2
+LOCK_SPIN = 0.005
+# Reply tokens reserved against a provider's tokens/min before the reply is known
+OUTPUT_ESTIMATE = 256
+USER_REPLY = "You're sending messages too quickly. Please wait {seconds}s and try again."
+PROVIDER_REPLY = "{provider} is rate-limiting requests right now. Please try again in {seconds}s."
+
+
+def enabled() -> bool:
+    return getattr(settings, "LLM_RATE_LIMIT", True)
+
+def _max_wait() -> float:
+    if getattr(settings, "LLM_RATE_LIMIT_MODE", "wait") == "reject":
+        return 0.0
+    return getattr(settings, "LLM_RATE_LIMIT_MAX_WAIT", 10.0)
+
+
+# --------- Buckets ----------
+def _acquire_lock(key) -> bool:
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not cache.add(key, 1, timeout=LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            return False  # fail open rather than stall the request
+        time.sleep(LOCK_SPIN)
+    return True
+
+def _level(state, capacity, now):
+    if state is None:
+        return float(capacity)
+    refilled = state["level"] + (now - state["at"]) * capacity / 60.0
+    return min(float(capacity), refilled)
+
+def reserve(subject: str, limits: dict, amounts: dict, max_wait: float, blocked_until: float = 0.0):
+    """Take ``amounts`` from the subject's buckets if they refill within ``max_wait``.
+
+    ``limits`` and ``amounts`` map bucket names ("rpm", "tpm") to per-minute
+    capacities and costs; a None capacity is unlimited. Returns (admitted,
+    wait): when admitted the caller sleeps ``wait`` seconds before going
+    ahead (the buckets run into debt meanwhile); otherwise ``wait`` is the
+    suggested Retry-After.
+    """
+    limits = {name: cap for name, cap in limits.items() if cap}
+    now = time.time()
+    blocked = max(0.0, blocked_until - now)
+    if not limits:
+        return blocked <= max_wait, blocked
+
+    lock_key = f"ratelimit-lock:{subject}"
+    locked = _acquire_lock(lock_key)
+    try:
+        keys = {name: f"ratelimit:{subject}:{name}" for name in limits}
+        states = cache.get_many(list(keys.values()))
+        levels, wait = {}, blocked
+        for name, capacity in limits.items():
+            # A single request larger than the bucket is admitted once the bucket is full
+            cost = min(float(amounts.get(name, 0)), float(capacity))
+            levels[name] = _level(states.get(keys[name]), capacity, now) - cost
+            if levels[name] < 0:
+                wait = max(wait, -levels[name] * 60.0 / capacity)
+        if wait > max_wait:
+            return False, wait
+        cache.set_many({keys[name]: {"level": level, "at": now} for name, level in levels.items()}, timeout=120)
+        return True, wait
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+# --------- Users ----------
+def user_limits() -> dict:
+    return {"rpm": getattr(settings, "LLM_USER_RPM", 20), "tpm": getattr(settings, "LLM_USER_TPM", 20000)}
+
+def reserve_user(owner: str, tokens: int):
+    """(admitted, wait) for one message of ``tokens`` tokens from ``owner``."""
+    if not enabled():
+        return True, 0.0
+    admitted, wait = reserve(f"user:{owner}", user_limits(), {"rpm": 1, "tpm": tokens}, _max_wait())
+    if not admitted:
+        metrics.record_rate_limited("user")
+    return admitted, wait
+
+
+# --------- Providers ----------
+def provider_limits(provider_name: str, catalog_entry: dict) -> dict:
+    """Requests/tokens per minute: LLM_PROVIDER_LIMITS overrides the catalog's published limits."""
+    override = getattr(settings, "LLM_PROVIDER_LIMITS", {}).get(provider_name)
+    if override:
+        return {"rpm": override[0], "tpm": override[1]}
+    return {"rpm": catalog_entry.get("rpm"), "tpm": catalog_entry.get("tpm")}
+
+def _blocked_key(provider_name):
+    return f"ratelimit-blocked:{provider_name}"
+
+def reserve_provider(provider_name: str, limits: dict, prompt_tokens: int):
+    """(admitted, wait) for one call to the provider."""
+    if not enabled():
+        return True, 0.0
+    admitted, wait = reserve(
+        f"provider:{provider_name}", limits,
+        {"rpm": 1, "tpm": prompt_tokens + OUTPUT_ESTIMATE}, _max_wait(),
+        blocked_until=cache.get(_blocked_key(provider_name)) or 0.0,
+    )
+    if not admitted:
+        metrics.record_rate_limited(f"provider:{provider_name}")
+    return admitted, wait
+
+def block(provider_name: str, seconds: float):
+    """Hold calls to the provider for ``seconds`` (from an upstream Retry-After)."""
+    until = time.time() + seconds
+    if until > (cache.get(_blocked_key(provider_name)) or 0.0):
+        cache.set(_blocked_key(provider_name), until, timeout=int(seconds) + 1)
+
+def retry_after_seconds(value, default: float = 1.0) -> float:
+    """Parse a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
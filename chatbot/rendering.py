@@ -0,0 +1,102 @@
+"""Markdown rendering of assistant replies (markdown-it + Pygments).
+
+Raw HTML in replies is escaped rather than passed through, and markdown-it
+refuses javascript:/data: links, so the output is safe to insert as-is.
+Rendered HTML is kept in the ``rendered`` cache alias keyed by a hash of the
+text, so each reply is rendered once however often the conversation is shown.
+
+While a reply streams, StreamRenderer renders only top-level blocks that can
+no longer change (everything before the block still being written); the page
+shows the unfinished tail as plain text until the final HTML arrives.
+"""
+import hashlib
+
+from django.core.cache import caches
+from django.utils.html import escape
+from markdown_it import MarkdownIt
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+
+CACHE_ALIAS = "rendered"
+# Bump when the output changes so stale cached HTML is not served
+RENDER_VERSION = 1
+_FORMATTER = HtmlFormatter(nowrap=True)
+
+
+def _highlight(code, lang, _attrs):
+    """Pygments HTML for fenced blocks with a known language; "" lets markdown-it
+    emit the escaped code as is (guessing a lexer costs far more than rendering)."""
+    try:
+        lexer = get_lexer_by_name(lang) if lang else None
+    except ClassNotFound:
+        lexer = None
+    if lexer is None:
+        return ""
+    return (
+        f'<pre class="highlight"><code class="language-{escape(lang)}">'
+        f"{highlight(code, lexer, _FORMATTER)}</code></pre>"
+    )
+
+_md = MarkdownIt("commonmark", {"html": False, "breaks": True, "highlight": _highlight}).enable(
+    ["table", "strikethrough"]
+)
+
+
+def render_markdown(text: str) -> str:
+    return _md.render(text or "")
+
+def _key(text: str) -> str:
+    return f"md:{RENDER_VERSION}:" + hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+def render_cached(text: str) -> str:
+    cache = caches[CACHE_ALIAS]
+    key = _key(text)
+    html = cache.get(key)
+    if html is None:
+        html = render_markdown(text)
+        cache.set(key, html)
+    return html
+
+def render_many(texts) -> list[str]:
+    """Rendered HTML for each text, with one cache round trip for all of them."""
+    cache = caches[CACHE_ALIAS]
+    keys = [_key(t) for t in texts]
+    found = cache.get_many(keys)
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = render_markdown(text)
+    if missing:
+        cache.set_many(missing)
+    # A cached render may be "" (empty message), so test membership, not truthiness
+    return [found[key] if key in found else missing[key] for key in keys]
+
+
+class StreamRenderer:
+    """Incremental rendering of a streamed reply.
+
+    ``feed(delta)`` returns (html, upto): HTML for blocks completed by this
+    delta (empty if none) and how many characters of the reply are now
+    covered by HTML sent so far. Work per delta is bounded by the size of the
+    block being written, not the reply so far.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.upto = 0  # characters already rendered and sent
+
+    def feed(self, delta: str) -> tuple[str, int]:
+        self.text += delta
+        if "\n" not in delta:
+            return "", self.upto  # blocks only end at line breaks
+        # Only complete lines of the unrendered tail; the last top-level block may still grow
+        tail = self.text[self.upto:self.text.rfind("\n") + 1]
+        starts = [t.map[0] for t in _md.parse(tail) if t.level == 0 and t.nesting in (0, 1) and t.map]
+        if len(starts) < 2:
+            return "", self.upto
+        lines = tail.splitlines(keepends=True)
+        done = "".join(lines[:starts[-1]])
+        self.upto += len(done)
+        return render_markdown(done), self.upto
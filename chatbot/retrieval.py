@@ -0,0 +1,375 @@
+"""Retrieval over a local corpus of problems and editorials.
+
+``manage.py llm_index`` splits the corpus into snippets and embeds each as
+a hashed n-gram vector: word unigrams, bigrams and character trigrams are
+hashed into DIM buckets, weighted by log term frequency times the bucket's
+IDF, and L2-normalized. No model or network is needed. The index directory
+holds:
+
+  vectors.npy    float32 (n, dim) matrix, opened with mmap_mode="r"
+  idf.npy        float32 (dim,) bucket weights applied to queries too
+  records.bin    UTF-8 JSON records (title, source, text), one after another
+  offsets.npy    int64 (n + 1,) byte offsets into records.bin
+  centroids.npy  float32 (lists, dim) IVF centroids (large corpora only)
+  lists.npy      int64 (lists + 1,) row offsets of each IVF list
+  meta.json      dim, count, version
+
+Everything is read through mmap, so gunicorn workers share one copy of the
+index in the page cache. Each worker opens the index lazily on first use,
+and reopens it when a rebuild bumps meta.json. Search is a blocked
+matrix product of the query batch against the matrix with argpartition
+top-k. With IVF lists, only the ``LLM_RAG_NPROBE`` lists nearest each query
+are scanned.
+
+The best snippets go in a system message just before the user's message,
+so the mentor can build on them instead of deriving known solutions again.
+Placing them there leaves the cached prompt prefix alone (see
+prompt_cache.py).
+"""
+import functools
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from django.conf import settings
+
+from .context import count_tokens, message_tokens
+
+# Optional: retrieval is off unless numpy is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DIM = 1024
+INDEX_VERSION = 1
+CHUNK_TOKENS = 250
+# Rows per block of the brute-force scan (bounds the temporary score matrix)
+BLOCK_ROWS = 65536
+# Corpora at least this large get IVF lists (llm_index --ivf auto)
+IVF_MIN_ROWS = 50_000
+KMEANS_SAMPLE = 50_000
+KMEANS_ITERATIONS = 10
+RELOAD_CHECK_SECONDS = 30
+CORPUS_SUFFIXES = (".md", ".markdown", ".txt", ".jsonl")
+CONTEXT_HEADER = (
+    "Reference notes from the problem library that may match the user's question. "
+    "Build on them and keep the answer short; do not restate them at length or "
+    "mention that they were provided."
+)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+
+
+def enabled() -> bool:
+    return np is not None and getattr(settings, "LLM_RAG", True)
+
+def index_dir() -> Path:
+    return Path(getattr(settings, "LLM_RAG_INDEX_DIR", Path(settings.BASE_DIR) / ".cache" / "rag"))
+
+
+# --------- Embedding ----------
+@functools.lru_cache(maxsize=1 << 18)
+def _word_hashes(word: str) -> tuple[int, ...]:
+    """Hash of the word, then of its character trigrams (for words over 4 letters)."""
+    hashes = [zlib.crc32(word.encode("utf-8"))]
+    if len(word) > 4:
+        padded = f"<{word}>"
+        hashes.extend(zlib.crc32(("#" + padded[i:i + 3]).encode("utf-8")) for i in range(len(padded) - 2))
+    return tuple(hashes)
+
+def _term_vector(text: str, dim: int):
+    """Signed hashed feature counts of ``text`` (words, word bigrams, character
+    trigrams), log-scaled."""
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return np.zeros(dim, dtype=np.float32)
+    word_hashes = [_word_hashes(w) for w in words]
+    firsts = np.fromiter((h[0] for h in word_hashes), dtype=np.uint64, count=len(words))
+    bigrams = (firsts[:-1] * np.uint64(0x9E3779B1) + firsts[1:]) & np.uint64(0xFFFFFFFF)
+    hashes = np.concatenate([np.fromiter(itertools.chain.from_iterable(word_hashes), dtype=np.uint64), bigrams])
+    signs = np.where(hashes & np.uint64(0x80000000), -1.0, 1.0)
+    vector = np.bincount((hashes % np.uint64(dim)).astype(np.int64), weights=signs, minlength=dim)
+    return (np.sign(vector) * np.log1p(np.abs(vector))).astype(np.float32)
+
+def _term_matrix(texts, dim):
+    if not texts:
+        return np.zeros((0, dim), np.float32)
+    return np.stack([_term_vector(t, dim) for t in texts])
+
+def _normalize(matrix):
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix
+
+def embed(texts, idf):
+    """Unit-length float32 rows, one per text (zero rows for texts without words)."""
+    return _normalize(_term_matrix(list(texts), len(idf)) * idf)
+
+
+# --------- Corpus ----------
+def _chunks(text: str, max_tokens: int = CHUNK_TOKENS):
+    """Paragraph-aligned pieces of about ``max_tokens`` tokens."""
+    piece, used = [], 0
+    for paragraph in filter(None, (p.strip() for p in _PARAGRAPH_RE.split(text))):
+        tokens = count_tokens(paragraph)
+        if piece and used + tokens > max_tokens:
+            yield "\n\n".join(piece)
+            piece, used = [], 0
+        piece.append(paragraph)
+        used += tokens
+    if piece:
+        yield "\n\n".join(piece)
+
+def _documents(path: Path):
+    """(title, source, text) for every document in a file or directory.
+
+    JSONL lines carry ``text``, ``body``, ``content`` or ``solution`` plus an
+    optional ``title`` and ``url``; other files are one document each, titled
+    by their first line.
+    """
+    files = sorted(p for p in path.rglob("*") if p.suffix in CORPUS_SUFFIXES) if path.is_dir() else [path]
+    for file in files:
+        if file.suffix == ".jsonl":
+            with open(file, encoding="utf-8") as f:
+                for lineno, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    text = "\n\n".join(str(row[k]) for k in ("text", "body", "content", "solution") if row.get(k))
+                    title = str(row.get("title") or row.get("id") or f"{file.name}:{lineno}")
+                    yield title, row.get("url") or f"{file}:{lineno}", text
+        else:
+            text = file.read_text(encoding="utf-8", errors="replace")
+            first = text.strip().splitlines()[0] if text.strip() else file.stem
+            yield first.lstrip("# ").strip()[:200] or file.stem, str(file), text
+
+def load_corpus(paths) -> list[dict]:
+    records = []
+    for path in paths:
+        for title, source, text in _documents(Path(path)):
+            for chunk in _chunks(text):
+                records.append({"title": title, "source": source, "text": chunk})
+    return records
+
+
+# --------- Building ----------
+def _idf(matrix):
+    df = np.count_nonzero(matrix, axis=0)
+    return (np.log((1 + len(matrix)) / (1 + df)) + 1.0).astype(np.float32)
+
+def _kmeans(matrix, lists, seed=0):
+    """Spherical k-means centroids of a sample of the (unit-length) rows."""
+    rng = np.random.default_rng(seed)
+    sample = matrix[rng.choice(len(matrix), min(len(matrix), KMEANS_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(lists):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+def _assign(matrix, centroids):
+    return np.concatenate([
+        np.argmax(matrix[i:i + BLOCK_ROWS] @ centroids.T, axis=1) for i in range(0, len(matrix), BLOCK_ROWS)
+    ]) if len(matrix) else np.zeros(0, dtype=np.int64)
+
+def build(paths, out=None, dim=DIM, ivf="auto", lists=None) -> dict:
+    """Embed the corpus under ``paths`` into a fresh index directory; returns its meta."""
+    out = Path(out or index_dir())
+    records = load_corpus(paths)
+    if not records:
+        raise ValueError("the corpus has no text")
+    matrix = _term_matrix([f"{r['title']}\n{r['text']}" for r in records], dim)
+    idf = _idf(matrix)
+    matrix *= idf
+    _normalize(matrix)
+
+    use_ivf = ivf == "on" or (ivf == "auto" and len(records) >= IVF_MIN_ROWS)
+    centroids = list_offsets = None
+    if use_ivf:
+        lists = min(len(records), lists or max(1, round(math.sqrt(len(records)))))
+        centroids = _kmeans(matrix, lists)
+        assign = _assign(matrix, centroids)
+        order = np.argsort(assign, kind="stable")  # each list becomes a contiguous run of rows
+        matrix, records = matrix[order], [records[i] for i in order]
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=lists))]).astype(np.int64)
+
+    tmp = out.with_name(out.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    np.save(tmp / "vectors.npy", matrix)
+    np.save(tmp / "idf.npy", idf)
+    offsets = [0]
+    with open(tmp / "records.bin", "wb") as f:
+        for r in records:
+            raw = json.dumps(r, ensure_ascii=False).encode("utf-8")
+            f.write(raw)
+            offsets.append(offsets[-1] + len(raw))
+    np.save(tmp / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    if use_ivf:
+        np.save(tmp / "centroids.npy", centroids)
+        np.save(tmp / "lists.npy", list_offsets)
+    meta = {"version": INDEX_VERSION, "dim": dim, "count": len(records), "ivf_lists": len(centroids) if use_ivf else 0,
+            "built": time.time()}
+    (tmp / "meta.json").write_text(json.dumps(meta))
+    # Swap directories; workers still reading the old files keep their open mappings
+    old = out.with_name(out.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if out.exists():
+        os.replace(out, old)
+    os.replace(tmp, out)
+    shutil.rmtree(old, ignore_errors=True)
+    return meta
+
+
+# --------- Searching ----------
+def _merge_top(scores, ids, new_scores, new_ids, k):
+    scores, ids = np.concatenate([scores, new_scores], axis=1), np.concatenate([ids, new_ids], axis=1)
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, ids = np.take_along_axis(scores, keep, 1), np.take_along_axis(ids, keep, 1)
+    return scores, ids
+
+def _scan(matrix, queries, k, start=0, stop=None):
+    """Top-k (scores, row ids) of rows [start, stop) for each query, block by block."""
+    stop = len(matrix) if stop is None else stop
+    scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    ids = np.zeros((len(queries), 0), dtype=np.int64)
+    for lo in range(start, stop, BLOCK_ROWS):
+        hi = min(stop, lo + BLOCK_ROWS)
+        block = queries @ np.asarray(matrix[lo:hi]).T
+        scores, ids = _merge_top(scores, ids, block, np.broadcast_to(np.arange(lo, hi), block.shape), k)
+    return scores, ids
+
+
+class Index:
+    """A built index opened read-only through mmap."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.meta = json.loads((path / "meta.json").read_text())
+        self.matrix = np.load(path / "vectors.npy", mmap_mode="r")
+        self.idf = np.load(path / "idf.npy")
+        self.offsets = np.load(path / "offsets.npy", mmap_mode="r")
+        with open(path / "records.bin", "rb") as f:
+            self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.meta["count"] else b""
+        self.centroids = self.lists = None
+        if self.meta.get("ivf_lists"):
+            self.centroids = np.load(path / "centroids.npy")
+            self.lists = np.load(path / "lists.npy")
+
+    def record(self, row: int) -> dict:
+        return json.loads(self._records[int(self.offsets[row]):int(self.offsets[row + 1])].decode("utf-8"))
+
+    def search_many(self, texts, k=3, nprobe=8) -> list[list[dict]]:
+        """Best ``k`` records for each text, with their cosine ``score``."""
+        if not len(texts) or not self.meta["count"]:
+            return [[] for _ in texts]
+        queries = embed(list(texts), self.idf)
+        if self.centroids is None:
+            scores, ids = _scan(self.matrix, queries, k)
+        else:
+            scores, ids = self._search_ivf(queries, k, nprobe)
+        results = []
+        for row_scores, row_ids in zip(scores, ids):
+            order = np.argsort(-row_scores)
+            results.append([
+                {**self.record(row_ids[i]), "score": float(row_scores[i])}
+                for i in order if np.isfinite(row_scores[i])
+            ])
+        return results
+
+    def _search_ivf(self, queries, k, nprobe):
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.zeros((len(queries), k), dtype=np.int64)
+        for q, lists in enumerate(probes):
+            for c in lists:
+                s, i = _scan(self.matrix, queries[q:q + 1], k, int(self.lists[c]), int(self.lists[c + 1]))
+                best = _merge_top(scores[q:q + 1], ids[q:q + 1], s, i, k)
+                scores[q], ids[q] = best[0][0], best[1][0]
+        return scores, ids
+
+
+_lock = threading.Lock()
+_index = None
+_checked = 0.0  # monotonic time of the last meta.json check
+
+
+def get_index():
+    """The index for this process, opened on first use; None when there is none.
+    Reopened when a rebuild replaces meta.json."""
+    global _index, _checked
+    now = time.monotonic()
+    if _index is not None and now - _checked < RELOAD_CHECK_SECONDS:
+        return _index
+    with _lock:
+        if _index is not None and now - _checked < RELOAD_CHECK_SECONDS:
+            return _index
+        _checked = now
+        path = index_dir()
+        try:
+            built = json.loads((path / "meta.json").read_text()).get("built")
+        except (OSError, ValueError):
+            _index = None
+            return None
+        if _index is None or _index.meta.get("built") != built:
+            try:
+                _index = Index(path)
+                logger.info("retrieval index %s: %d snippets, %d IVF lists",
+                            path, _index.meta["count"], _index.meta.get("ivf_lists", 0))
+            except (OSError, ValueError, KeyError):
+                logger.exception("could not open the retrieval index at %s", path)
+                _index = None
+        return _index
+
+def search(text: str, k: int | None = None) -> list[dict]:
+    index = get_index() if enabled() else None
+    if index is None:
+        return []
+    k = k or getattr(settings, "LLM_RAG_TOP_K", 3)
+    min_score = getattr(settings, "LLM_RAG_MIN_SCORE", 0.15)
+    hits = index.search_many([text], k, getattr(settings, "LLM_RAG_NPROBE", 8))[0]
+    return [h for h in hits if h["score"] >= min_score]
+
+def context_message(text: str):
+    """System message with the snippets best matching ``text`` (within
+    LLM_RAG_MAX_TOKENS), or None when nothing matches well enough."""
+    hits = search(text)
+    if not hits:
+        return None
+    budget = getattr(settings, "LLM_RAG_MAX_TOKENS", 600)
+    parts = [CONTEXT_HEADER]
+    used = message_tokens(CONTEXT_HEADER)
+    for n, hit in enumerate(hits, 1):
+        snippet = f"[{n}] {hit['title']}\n{hit['text']}"
+        cost = count_tokens(snippet)
+        if used + cost > budget:
+            break
+        parts.append(snippet)
+        used += cost
+    if len(parts) == 1:
+        return None
+    return {"role": "system", "content": "\n\n".join(parts)}
+
+def info() -> dict:
+    index = get_index() if enabled() else None
+    if index is None:
+        return {"enabled": enabled(), "snippets": 0}
+    return {"enabled": True, "snippets": index.meta["count"], "ivf_lists": index.meta.get("ivf_lists", 0)}
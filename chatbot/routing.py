@@ -0,0 +1,480 @@
+"""Provider failover, hedged requests and circuit breakers.
+
+A request walks an ordered chain of (provider, model) pairs. Retriable
+failures (timeouts, connection errors, 429 and 5xx) move on to the next
+provider; with hedging on, a second provider is raced once the primary has
+not answered within its recent p95 latency, and the loser is cancelled.
+Each provider has an in-process circuit breaker so a degraded one is
+skipped until a half-open probe succeeds. With LLM_ROUTING=adaptive the
+chain is ordered by live latency/error/cost statistics shared via the cache.
+"""
+import asyncio
+import collections
+import contextvars
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .context import count_tokens
+
+logger = logging.getLogger(__name__)
+
+NO_PROVIDER_REPLY = "No model provider is available right now. Please try again shortly."
+ERROR_REPLY = "Unexpected error contacting model. Please try again."
+STOPPED_REPLY = "Stopped."
+# While a request with a budget (deadlines.Budget) waits, it checks for cancellation this often
+CANCEL_POLL = 0.25
+
+
+class UpstreamError(Exception):
+    """Upstream call failed; the message is safe to show to the user.
+
+    ``retriable`` marks failures worth trying on another provider
+    (timeouts, connection errors, 429, 5xx).
+    """
+
+    def __init__(self, message, status=None, retriable=False):
+        super().__init__(message)
+        self.status = status
+        self.retriable = retriable
+
+
+class Throttled(UpstreamError):
+    """Our own rate limiter refused the call (see ratelimit.py): worth trying
+    the next provider, but says nothing about this one's health."""
+
+    def __init__(self, message, status=429):
+        super().__init__(message, status=status, retriable=True)
+
+
+class Cancelled(UpstreamError):
+    """The user stopped the request or went away (see deadlines.py); says
+    nothing about the provider's health and is not worth retrying."""
+
+    def __init__(self, message=STOPPED_REPLY):
+        super().__init__(message)
+
+
+# --------- Circuit breakers ----------
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True if a request may go out; in half-open state only one probe at a time."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        """Give back a half-open probe slot without a verdict (e.g. cancelled hedge)."""
+        with self._lock:
+            self._probing = False
+
+
+_breakers = {}
+_latencies = collections.defaultdict(lambda: collections.deque(maxlen=200))
+_registry_lock = threading.Lock()
+
+
+def breaker(provider_name: str) -> CircuitBreaker:
+    with _registry_lock:
+        b = _breakers.get(provider_name)
+        if b is None:
+            b = _breakers[provider_name] = CircuitBreaker(
+                getattr(settings, "LLM_BREAKER_FAILURES", 3),
+                getattr(settings, "LLM_BREAKER_RESET", 30.0),
+            )
+        return b
+
+def record_latency(provider_name: str, seconds: float):
+    _latencies[provider_name].append(seconds)
+
+def hedge_delay(provider_name: str) -> float:
+    """Recent p95 latency (time to first token when streaming) of the provider."""
+    samples = sorted(_latencies[provider_name])
+    if len(samples) < 20:
+        delay = getattr(settings, "LLM_HEDGE_DEFAULT_DELAY", 5.0)
+    else:
+        delay = samples[int(0.95 * (len(samples) - 1))]
+    return max(delay, getattr(settings, "LLM_HEDGE_MIN_DELAY", 1.0))
+
+def snapshot() -> dict:
+    return {
+        name: {"state": b.state, "failures": b.failures, "hedge_delay": round(hedge_delay(name), 3)}
+        for name, b in sorted(_breakers.items())
+    }
+
+
+# --------- Live provider statistics ----------
+# EWMA latency, time to first token, error rate and tokens/sec per provider and
+# model, in the default cache. Updates are last-writer-wins.
+_STATS_PREFIX = "route-stats:"
+
+
+def _stats_key(provider_name, model):
+    return f"{_STATS_PREFIX}{provider_name}:{model}"
+
+def _ewma(old, new):
+    if old is None:
+        return new
+    alpha = getattr(settings, "LLM_ROUTING_ALPHA", 0.2)
+    return old + alpha * (new - old)
+
+def provider_stats(provider_name, model) -> dict:
+    return cache.get(_stats_key(provider_name, model)) or {
+        "samples": 0, "latency": None, "ttft": None, "error_rate": 0.0, "tokens_per_sec": None,
+    }
+
+def record_stats(provider_name, model, *, latency=None, ttft=None, tokens=None, error=False):
+    """Fold one observation in. A finished request passes latency (and tokens)
+    or error=True; a stream reports ttft separately when its first delta arrives."""
+    stats = provider_stats(provider_name, model)
+    if ttft is not None:
+        stats["ttft"] = _ewma(stats["ttft"], ttft)
+    if latency is not None or error:
+        stats["samples"] += 1
+        stats["error_rate"] = _ewma(stats["error_rate"], 1.0 if error else 0.0)
+    if latency is not None:
+        stats["latency"] = _ewma(stats["latency"], latency)
+        generating = latency - (ttft or 0.0)
+        if tokens and generating > 0:
+            stats["tokens_per_sec"] = _ewma(stats["tokens_per_sec"], tokens / generating)
+    stats["updated"] = time.time()
+    cache.set(_stats_key(provider_name, model), stats, timeout=None)
+
+def route_score(stats: dict, cost: float) -> float:
+    """Lower is better: expected latency inflated by the error rate, plus the
+    cost weight times the provider's price per million output tokens."""
+    latency = stats["latency"]
+    if latency is None:
+        latency = getattr(settings, "LLM_ROUTING_PRIOR_LATENCY", 3.0)
+    weight = getattr(settings, "LLM_ROUTING_COST_WEIGHT", 0.0)
+    return latency * (1 + 2 * stats["error_rate"]) + weight * cost
+
+def routing_table(chain, costs) -> list:
+    rows = []
+    for name, model in chain:
+        stats = provider_stats(name, model)
+        row = {"provider": name, "model": model, "score": round(route_score(stats, costs.get(name, 0.0)), 3)}
+        row.update({k: (round(v, 3) if isinstance(v, float) else v) for k, v in stats.items() if k != "updated"})
+        rows.append(row)
+    return sorted(rows, key=lambda r: r["score"])
+
+def order_chain(chain, costs):
+    """Chain sorted by route_score; the order also serves as the failover order.
+
+    With probability LLM_ROUTING_EXPLORE another provider is tried first, so
+    statistics of providers that are not currently winning stay fresh.
+    """
+    ordered = sorted(chain, key=lambda pair: route_score(provider_stats(*pair), costs.get(pair[0], 0.0)))
+    if len(ordered) > 1 and random.random() < getattr(settings, "LLM_ROUTING_EXPLORE", 0.05):
+        ordered.insert(0, ordered.pop(random.randrange(1, len(ordered))))
+    return ordered
+
+
+# --------- Started streams ----------
+class PrimedStream:
+    """A delta stream whose first delta has already arrived.
+
+    Iterating it to the end records latency, time to first token and
+    tokens/sec for the provider; a mid-stream UpstreamError counts as an error.
+    """
+
+    def __init__(self, first, rest, provider_name, model, started):
+        self.first = first
+        self.rest = rest
+        self.provider_name = provider_name
+        self.model = model
+        self.started = started
+        self.ttft = time.monotonic() - started
+
+    def __iter__(self):
+        parts = [self.first]
+        try:
+            if self.first:
+                yield self.first
+            for delta in self.rest:
+                parts.append(delta)
+                yield delta
+        except Cancelled:
+            raise
+        except UpstreamError:
+            record_stats(self.provider_name, self.model, error=True)
+            raise
+        self._finished(parts)
+
+    def _finished(self, parts):
+        record_stats(
+            self.provider_name, self.model,
+            latency=time.monotonic() - self.started, ttft=self.ttft, tokens=count_tokens("".join(parts)),
+        )
+
+    def close(self):
+        self.rest.close()
+
+
+class APrimedStream(PrimedStream):
+    async def __aiter__(self):
+        parts = [self.first]
+        try:
+            if self.first:
+                yield self.first
+            async for delta in self.rest:
+                parts.append(delta)
+                yield delta
+        except Cancelled:
+            raise
+        except UpstreamError:
+            await sync_to_async(record_stats)(self.provider_name, self.model, error=True)
+            raise
+        await sync_to_async(self._finished)(parts)
+
+    async def aclose(self):
+        await self.rest.aclose()
+
+
+def prime(gen, provider_name, model) -> PrimedStream:
+    """Wait for the first delta so a stream attempt counts as answered."""
+    started = time.monotonic()
+    return PrimedStream(next(gen, ""), gen, provider_name, model, started)
+
+async def aprime(agen, provider_name, model) -> APrimedStream:
+    started = time.monotonic()
+    return APrimedStream(await anext(agen, ""), agen, provider_name, model, started)
+
+
+# --------- Orchestration ----------
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-attempt")
+
+
+def _hedging() -> bool:
+    return getattr(settings, "LLM_HEDGE", False)
+
+def _settle(name, error=None):
+    if error is None:
+        breaker(name).record_success()
+    elif error.retriable and not isinstance(error, Throttled):
+        breaker(name).record_failure()
+    else:
+        breaker(name).release()
+
+def call_with_failover(chain, attempt, budget=None):
+    """Run ``attempt(provider_name, model, cancel_event)`` over the chain.
+
+    Returns (provider_name, result) from the first attempt that succeeds.
+    ``attempt`` should stop early once ``cancel_event`` is set; for streams it
+    returns after the first delta so hedging races on time to first token.
+    With a ``budget`` (deadlines.Budget), raises Cancelled as soon as it is
+    cancelled, and abandons the attempts still running.
+    """
+    remaining = iter(chain)
+    pending = {}
+    last_error = None
+    hedged = False
+    launched_at = 0.0
+
+    def launch() -> bool:
+        nonlocal launched_at
+        for name, model in remaining:
+            if breaker(name).allow():
+                cancel = threading.Event()
+                # In a copy of the caller's context, so a profiled request's spans include the call
+                future = _executor.submit(contextvars.copy_context().run, _timed, attempt, name, model, cancel)
+                pending[future] = (name, cancel)
+                launched_at = time.monotonic()
+                return True
+            logger.warning("skipping %s: circuit %s", name, breaker(name).state)
+        return False
+
+    if not launch():
+        raise UpstreamError(NO_PROVIDER_REPLY)
+    while pending:
+        timeout = hedge_at = None
+        if _hedging() and not hedged and len(pending) == 1:
+            hedge_at = launched_at + hedge_delay(next(iter(pending.values()))[0])
+            timeout = max(0.0, hedge_at - time.monotonic())
+        if budget is not None:
+            timeout = CANCEL_POLL if timeout is None else min(timeout, CANCEL_POLL)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            if budget is not None and budget.cancelled():
+                _abandon(pending)
+                raise Cancelled()
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                hedged = True
+                if launch():
+                    logger.info("hedging: racing a second provider")
+            continue
+        for future in done:
+            name, _cancel = pending.pop(future)
+            try:
+                result = future.result()
+            except UpstreamError as e:
+                _settle(name, e)
+                last_error = e
+                logger.warning("provider %s failed: %s", name, e)
+                if not pending and (not e.retriable or not launch()):
+                    raise
+                continue
+            _settle(name)
+            _abandon(pending)
+            return name, result
+    raise last_error or UpstreamError(NO_PROVIDER_REPLY)
+
+def _abandon(pending):
+    """Cancel attempts that are no longer wanted; their results are closed when they arrive."""
+    for future, (name, cancel) in pending.items():
+        cancel.set()
+        breaker(name).release()
+        future.add_done_callback(_discard)
+
+def _discard(future):
+    """Close the result of an attempt that lost the race (e.g. an open stream)."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if close is not None:
+        close()
+
+def _timed(attempt, name, model, cancel):
+    started = time.monotonic()
+    try:
+        try:
+            result = attempt(name, model, cancel)
+        except UpstreamError as e:
+            if e.retriable and not isinstance(e, Throttled):
+                record_stats(name, model, error=True)
+            raise
+        except Exception:
+            logger.exception("provider %s attempt crashed", name)
+            record_stats(name, model, error=True)
+            raise UpstreamError(ERROR_REPLY, retriable=True)
+        if not cancel.is_set():
+            _observe(name, model, result, time.monotonic() - started)
+        return result
+    finally:
+        # Pool threads outlive requests; don't keep the db cache's connection open
+        close_old_connections()
+
+def _observe(name, model, result, elapsed):
+    record_latency(name, elapsed)
+    # Streams record their own statistics once they finish (see PrimedStream)
+    if isinstance(result, str):
+        record_stats(name, model, latency=elapsed, tokens=count_tokens(result))
+
+async def acall_with_failover(chain, attempt, budget=None):
+    """Async counterpart of call_with_failover; ``attempt(provider_name, model)``
+    is a coroutine function and losing attempts are cancelled outright."""
+    remaining = iter(chain)
+    pending = {}
+    last_error = None
+    hedged = False
+    launched_at = 0.0
+
+    def launch() -> bool:
+        nonlocal launched_at
+        for name, model in remaining:
+            if breaker(name).allow():
+                pending[asyncio.ensure_future(_atimed(attempt, name, model))] = name
+                launched_at = time.monotonic()
+                return True
+            logger.warning("skipping %s: circuit %s", name, breaker(name).state)
+        return False
+
+    if not launch():
+        raise UpstreamError(NO_PROVIDER_REPLY)
+    try:
+        while pending:
+            timeout = hedge_at = None
+            if _hedging() and not hedged and len(pending) == 1:
+                hedge_at = launched_at + hedge_delay(next(iter(pending.values())))
+                timeout = max(0.0, hedge_at - time.monotonic())
+            if budget is not None:
+                timeout = CANCEL_POLL if timeout is None else min(timeout, CANCEL_POLL)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if budget is not None and await budget.acancelled():
+                    raise Cancelled()
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedged = True
+                    if launch():
+                        logger.info("hedging: racing a second provider")
+                continue
+            for task in done:
+                name = pending.pop(task)
+                try:
+                    result = task.result()
+                except UpstreamError as e:
+                    _settle(name, e)
+                    last_error = e
+                    logger.warning("provider %s failed: %s", name, e)
+                    if not pending and (not e.retriable or not launch()):
+                        raise
+                    continue
+                _settle(name)
+                return name, result
+        raise last_error or UpstreamError(NO_PROVIDER_REPLY)
+    finally:
+        for task, name in pending.items():
+            task.cancel()
+            task.add_done_callback(_adiscard)
+            breaker(name).release()
+
+def _adiscard(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    aclose = getattr(task.result(), "aclose", None)
+    if aclose is not None:
+        asyncio.ensure_future(aclose())
+
+async def _atimed(attempt, name, model):
+    started = time.monotonic()
+    try:
+        result = await attempt(name, model)
+    except UpstreamError as e:
+        if e.retriable and not isinstance(e, Throttled):
+            await sync_to_async(record_stats)(name, model, error=True)
+        raise
+    except Exception:
+        logger.exception("provider %s attempt crashed", name)
+        await sync_to_async(record_stats)(name, model, error=True)
+        raise UpstreamError(ERROR_REPLY, retriable=True)
+    await sync_to_async(_observe)(name, model, result, time.monotonic() - started)
+    return result
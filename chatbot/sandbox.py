@@ -0,0 +1,594 @@
+"""Sandboxed runs of user solutions for empirical complexity (LLM_SANDBOX).
+
+A user's Python function (a LeetCode-style ``class Solution`` method or a
+plain function) is run on generated inputs of doubling size. Inputs are
+generated from the parameter annotations: int, float, bool, str, and lists
+of those (``list[list[int]]`` as pairs, ``list[list[str]]`` as a 0/1 grid).
+Each size records the best time per call and the peak memory allocated
+during one call (tracemalloc, inputs excluded). Least-squares fits against
+O(1) ... O(2^n) then give the empirical complexity classes.
+
+The traced call can be ten or more times slower than a plain one, so each size's
+wall time covers both. A run stops before a size (or its traced call) that
+would not finish within the time budget, projecting at least quadratic
+growth. Each size's sample is sent to the parent as soon as it is measured,
+so a run killed at the timeout still reports the sizes it finished.
+
+Runs happen in a pool of long-lived worker processes started through a
+forkserver, so a run pays no interpreter startup. Each worker:
+
+- clears its environment and drops root privileges when it has them
+- joins a private network namespace when the kernel allows it
+- applies rlimits: address space, no file writes, no core dumps
+
+and forks a fresh child for every run, so nothing one solution changes
+(the recursion limit, patched modules or builtins) reaches the next. Before
+the solution runs, the child limits its CPU seconds, forbids child processes
+and installs an audit hook that refuses sockets, subprocesses, exec/fork,
+file changes, ctypes and reads outside the standard library.
+
+The parent kills any worker (with its run) that exceeds the wall-clock
+timeout or dies, and starts a replacement; workers are also recycled after
+LLM_SANDBOX_MAX_JOBS runs. This is defence in depth for honest mistakes
+(infinite loops, huge allocations), not a boundary for hostile code,
+which is why the feature is opt-in.
+"""
+import atexit
+import builtins
+import inspect
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import random
+import re
+import signal
+import string
+import sys
+import sysconfig
+import threading
+import time
+import tracemalloc
+import typing
+
+from django.conf import settings
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+FIRST_SIZE = 8
+# Aim for at least this long per timed batch so small inputs are not all noise
+MIN_TIMING = 0.005
+MAX_LOOPS = 200
+REPEATS = 3
+MAX_ERROR_CHARS = 500
+STOPPED_REPLY = "the run was stopped (CPU or memory limit exceeded)"
+# Growth assumed from one size to the next when the measured one is smaller (n -> 2n, quadratic)
+MIN_GROWTH = 4.0
+# Traced call time over plain call time, until one size has measured it
+TRACE_SLOWDOWN = 15.0
+BUSY_REPLY = "All solution runners are busy right now. Please try again in a few seconds."
+_CODE_BLOCK_RE = re.compile(r"```(?:python|py|python3)?[ \t]*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+class SandboxBusy(Exception):
+    """Every worker stayed busy for LLM_SANDBOX_QUEUE_WAIT seconds."""
+
+
+def enabled() -> bool:
+    return getattr(settings, "LLM_SANDBOX", False)
+
+def extract_code(text: str) -> str:
+    """The first fenced Python block of a chat message, else the whole text."""
+    match = _CODE_BLOCK_RE.search(text or "")
+    return (match.group(1) if match else text or "").strip()
+
+
+# --------- Worker process ----------
+# Imported before the audit hook is installed; solutions usually rely on these
+PRELOAD = ("bisect", "collections", "functools", "heapq", "itertools", "math", "operator", "string", "typing")
+PRELOAD_NAMES = {
+    "bisect": ("bisect_left", "bisect_right"),
+    "collections": ("Counter", "OrderedDict", "defaultdict", "deque"),
+    "functools": ("cache", "lru_cache", "reduce"),
+    "heapq": ("heapify", "heappop", "heappush", "heappushpop", "heapreplace", "nlargest", "nsmallest"),
+    "itertools": ("accumulate", "combinations", "permutations", "product"),
+    "typing": ("Dict", "List", "Optional", "Set", "Tuple"),
+}
+_BLOCKED_EVENTS = (
+    "socket.", "subprocess.", "os.system", "os.exec", "os.posix_spawn", "os.spawn", "os.fork", "os.forkpty",
+    "os.kill", "os.killpg", "os.remove", "os.rename", "os.rmdir", "os.mkdir", "os.chmod", "os.chown", "os.link",
+    "os.symlink", "os.truncate", "os.putenv", "os.unsetenv", "os.chdir", "pty.", "ctypes.", "shutil.",
+    "resource.setrlimit", "resource.prlimit", "urllib.", "http.", "ftplib.", "smtplib.", "webbrowser.",
+)
+_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC
+
+
+def _readable_roots():
+    paths = sysconfig.get_paths()
+    return tuple({os.path.realpath(paths[k]) + os.sep for k in ("stdlib", "platstdlib") if paths.get(k)})
+
+def _audit_hook(readable):
+    def hook(event, args):
+        if event == "open":
+            path, mode, flags = args
+            writing = any(c in mode for c in "wax+") if mode else bool(flags & _WRITE_FLAGS)
+            if writing or not isinstance(path, (str, bytes)) or not os.path.realpath(os.fsdecode(path)).startswith(readable):
+                raise PermissionError(f"opening {path!r} is not allowed in the sandbox")
+        elif event.startswith(_BLOCKED_EVENTS):
+            raise PermissionError(f"{event} is not allowed in the sandbox")
+    return hook
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def _isolate(limits):
+    """Set up the worker once; returns the paths a run may read."""
+    # Before dropping privileges: the interpreter may live somewhere ``nobody`` cannot read
+    for name in PRELOAD:
+        __import__(name)
+    readable = _readable_roots()
+    os.environ.clear()
+    unshare = getattr(os, "unshare", None)
+    if unshare is not None:
+        try:
+            unshare(os.CLONE_NEWNET)
+        except OSError:
+            pass  # needs CAP_SYS_ADMIN; the audit hook still refuses sockets
+    _set_limits((("RLIMIT_AS", _rss_bytes() + limits["memory_mb"] * 1024 * 1024),
+                 ("RLIMIT_FSIZE", 0), ("RLIMIT_CORE", 0)))
+    if hasattr(os, "getuid") and os.getuid() == 0:
+        try:
+            os.setgroups([])
+            os.setgid(65534)
+            os.setuid(65534)  # nobody
+        except OSError:
+            pass
+    return readable
+
+def _set_limits(limits):
+    if resource is None:
+        return
+    for name, value in limits:
+        if hasattr(resource, name):
+            try:
+                resource.setrlimit(getattr(resource, name), (value, value))
+            except (OSError, ValueError):
+                logger.warning("sandbox could not set %s", name)
+
+def _confine(limits, readable):
+    """In the forked child, just before the solution runs."""
+    # Per run the wall-clock timeout applies; this stops a run that escapes it
+    _set_limits((("RLIMIT_CPU", limits["cpu_seconds"] + 1), ("RLIMIT_NPROC", 0)))
+    sys.addaudithook(_audit_hook(readable))
+
+def _worker_main(conn, limits):
+    # Its own process group, so the pool can kill a worker together with its run
+    os.setpgrp()
+    readable = _isolate(limits)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                _confine(limits, readable)
+                conn.send(("result", _run_job(job, lambda kind, payload: conn.send((kind, payload)))))
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            conn.send(("stopped", STOPPED_REPLY))
+
+
+# --------- Running a solution (inside the worker) ----------
+def _namespace() -> dict:
+    """Globals for the solution: the modules and names LeetCode's Python has in scope."""
+    namespace = {"__name__": "solution", "__builtins__": builtins, "inf": math.inf}
+    for name in PRELOAD:
+        namespace[name] = sys.modules[name]
+    for module, names in PRELOAD_NAMES.items():
+        namespace.update({name: getattr(sys.modules[module], name) for name in names})
+    return namespace
+
+def _load(code: str, function: str | None):
+    """(callable, type hints) of the function to measure."""
+    namespace = _namespace()
+    exec(compile(code, "<solution>", "exec"), namespace)
+    cls = namespace.get("Solution")
+    if function:
+        if cls is not None and hasattr(cls, function):
+            fn = getattr(cls(), function)
+        elif callable(namespace.get(function)):
+            fn = namespace[function]
+        else:
+            raise ValueError(f"no function named {function!r}")
+    elif cls is not None:
+        methods = [name for name, v in vars(cls).items() if callable(v) and not name.startswith("_")]
+        if not methods:
+            raise ValueError("class Solution has no public method")
+        fn = getattr(cls(), methods[0])
+    else:
+        functions = [v for name, v in namespace.items()
+                     if inspect.isfunction(v) and v.__module__ == "solution" and not name.startswith("_")]
+        if not functions:
+            raise ValueError("no function to run; define one or a class Solution")
+        fn = functions[0]
+    try:
+        hints = typing.get_type_hints(fn, globalns=namespace)
+    except Exception as e:
+        raise ValueError(f"cannot read the parameter annotations: {e}")
+    return fn, hints
+
+def _unwrap(hint):
+    if typing.get_origin(hint) is typing.Union:
+        args = [a for a in typing.get_args(hint) if a is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return hint
+
+def _is_list(hint):
+    return typing.get_origin(hint) in (list, typing.List) or hint is list
+
+def _scalar(hint, n, rng, sized):
+    if hint is bool:
+        return rng.random() < 0.5
+    if hint is int:
+        return rng.randint(0, n) if sized else n
+    if hint is float:
+        return rng.uniform(-n, n)
+    if hint is str:
+        return "".join(rng.choices(string.ascii_lowercase, k=n))
+    raise TypeError
+
+def _generator(name, hint, sized):
+    """f(n, rng) producing one argument of size n."""
+    hint = _unwrap(hint)
+    if hint in (bool, int, float, str):
+        return lambda n, rng: _scalar(hint, n, rng, sized)
+    if _is_list(hint):
+        (item,) = typing.get_args(hint) or (int,)
+        item = _unwrap(item)
+        if item is int:
+            return lambda n, rng: [rng.randint(-n, n) for _ in range(n)]
+        if item is float:
+            return lambda n, rng: [rng.uniform(-n, n) for _ in range(n)]
+        if item is str:
+            return lambda n, rng: ["".join(rng.choices(string.ascii_lowercase, k=5)) for _ in range(n)]
+        if _is_list(item) and _unwrap((typing.get_args(item) or (int,))[0]) is int:
+            return lambda n, rng: [sorted((rng.randrange(n), rng.randrange(n))) for _ in range(n)]
+        if _is_list(item) and _unwrap((typing.get_args(item) or (str,))[0]) is str:
+            def grid(n, rng):
+                side = max(1, math.isqrt(n))
+                return [[rng.choice("01") for _ in range(side)] for _ in range(side)]
+            return grid
+    raise ValueError(
+        f"cannot generate inputs for parameter {name!r} ({getattr(hint, '__name__', hint)}); "
+        "annotate it as int, float, bool, str or a list of those"
+    )
+
+def _generators(fn, hints):
+    params = [p for p in inspect.signature(fn).parameters.values()
+              if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    if not params:
+        raise ValueError("the function takes no input to scale")
+    missing = [p.name for p in params if p.name not in hints]
+    if missing:
+        raise ValueError(f"annotate the parameter types ({', '.join(missing)}) so inputs can be generated")
+    sized = any(_unwrap(hints[p.name]) is str or _is_list(_unwrap(hints[p.name])) for p in params)
+    return [_generator(p.name, hints[p.name], sized) for p in params]
+
+def _clone(value):
+    """Copy of a generated input (lists of scalars or of lists), much faster than deepcopy."""
+    if isinstance(value, list):
+        return [_clone(v) for v in value] if value and isinstance(value[0], list) else list(value)
+    return value
+
+def _time_call(fn, args):
+    """Best seconds per call over REPEATS batches; each call gets fresh copies of the inputs."""
+    first_args = _clone(args)
+    start = time.perf_counter()
+    fn(*first_args)
+    best = time.perf_counter() - start
+    loops = min(MAX_LOOPS, max(1, int(MIN_TIMING / max(best, 1e-7))))
+    for _ in range(REPEATS - 1):
+        batch = [_clone(args) for _ in range(loops)]
+        start = time.perf_counter()
+        for call_args in batch:
+            fn(*call_args)
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best
+
+def _peak_bytes(fn, args):
+    call_args = _clone(args)
+    tracemalloc.start()
+    try:
+        fn(*call_args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _describe(e) -> str:
+    return f"{type(e).__name__}: {e}"[:MAX_ERROR_CHARS]
+
+def _run_job(job, report=None) -> dict:
+    """Measure the solution at doubling sizes. ``report(kind, payload)`` gets the
+    function name ("function") and each size's sample ("sample") as they come."""
+    report = report or (lambda kind, payload: None)
+    result = {"function": None, "samples": [], "stopped": None, "error": None}
+    try:
+        fn, hints = _load(job["code"], job.get("function"))
+        result["function"] = getattr(fn, "__name__", None)
+        generators = _generators(fn, hints)
+    except Exception as e:
+        result["error"] = _describe(e)
+        return result
+    report("function", result["function"])
+    rng = random.Random(job["seed"])
+    deadline = time.perf_counter() + job["time_budget"]
+    slowdown = TRACE_SLOWDOWN
+    cost = None  # wall seconds the previous size took, timed and traced runs together
+    n = FIRST_SIZE
+    while n <= job["max_n"]:
+        started = time.perf_counter()
+        try:
+            args = [g(n, rng) for g in generators]
+            seconds = _time_call(fn, args)
+            # The traced call is the slow one; skip it rather than overrun the budget
+            if time.perf_counter() + seconds * slowdown > deadline:
+                result["stopped"] = f"time budget (before the memory run at n={n})"
+                break
+            traced = time.perf_counter()
+            peak = _peak_bytes(fn, args)
+            slowdown = max(1.0, (time.perf_counter() - traced) / max(seconds, 1e-7))
+        except MemoryError:
+            result["stopped"] = f"memory limit at n={n}"
+            break
+        except RecursionError:
+            result["stopped"] = f"recursion limit at n={n}"
+            break
+        except Exception as e:
+            result["error"] = f"at n={n}: {_describe(e)}"
+            break
+        sample = {"n": n, "seconds": seconds, "peak_bytes": peak}
+        result["samples"].append(sample)
+        report("sample", sample)
+        previous, cost = cost, time.perf_counter() - started
+        # Worst case for the next size: the growth just measured, and at least quadratic
+        growth = max(MIN_GROWTH, cost / previous if previous else 0.0)
+        if seconds > job["max_call_seconds"] or time.perf_counter() + cost * growth > deadline:
+            result["stopped"] = "time budget"
+            break
+        n *= 2
+    return result
+
+
+# --------- Pool (web process side) ----------
+class Worker:
+    def __init__(self, ctx, limits):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child, limits), name="sandbox", daemon=True)
+        self.process.start()
+        child.close()
+        self.jobs = 0
+
+    def stop(self):
+        self.conn.close()
+        if self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)  # the worker and its run
+            except OSError:
+                self.process.kill()
+        self.process.join(1)
+
+
+class Pool:
+    """Long-lived sandbox workers; ``run`` borrows one for a job."""
+
+    def __init__(self, size, limits):
+        self.limits = limits
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.ctx = multiprocessing.get_context(method)
+        if method == "forkserver":
+            self.ctx.set_forkserver_preload([__name__])
+        self._idle = queue.Queue()
+        self._workers = []
+        for _ in range(size):
+            self._add()
+
+    def _add(self):
+        worker = Worker(self.ctx, self.limits)
+        self._workers.append(worker)
+        self._idle.put(worker)
+
+    def _replace(self, worker):
+        worker.stop()
+        self._workers.remove(worker)
+        self._add()
+
+    def run(self, job, timeout, wait):
+        """The job's result; when the worker times out or dies, the samples it sent so far."""
+        try:
+            worker = self._idle.get(timeout=wait)
+        except queue.Empty:
+            raise SandboxBusy(BUSY_REPLY)
+        healthy = False
+        partial = {"function": None, "samples": [], "stopped": None, "error": None}
+        deadline = time.monotonic() + timeout
+        try:
+            worker.conn.send(job)
+            while True:
+                if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                    partial["stopped"] = f"timed out after {timeout:g}s"
+                    return partial
+                kind, payload = worker.conn.recv()
+                if kind == "function":
+                    partial["function"] = payload
+                elif kind == "sample":
+                    partial["samples"].append(payload)
+                elif kind == "stopped":
+                    healthy = True  # only the run died; the worker is still clean
+                    partial["error"] = payload
+                    return partial
+                else:
+                    healthy = True
+                    return payload
+        except (EOFError, OSError):
+            partial["error"] = STOPPED_REPLY
+            return partial
+        finally:
+            worker.jobs += 1
+            if healthy and worker.jobs < self.limits["max_jobs"]:
+                self._idle.put(worker)
+            else:
+                self._replace(worker)
+
+    def close(self):
+        for worker in list(self._workers):
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Pool:
+    """This process's pool, started on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = Pool(getattr(settings, "LLM_SANDBOX_WORKERS", 2), {
+                    "memory_mb": getattr(settings, "LLM_SANDBOX_MEMORY_MB", 256),
+                    "cpu_seconds": math.ceil(getattr(settings, "LLM_SANDBOX_TIMEOUT", 10.0)),
+                    "max_jobs": getattr(settings, "LLM_SANDBOX_MAX_JOBS", 50),
+                })
+    return _pool
+
+@atexit.register
+def _close_pool():
+    if _pool is not None:
+        _pool.close()
+
+
+# --------- Complexity fits ----------
+COMPLEXITY_CLASSES = (
+    ("O(1)", lambda n: 1.0),
+    ("O(log n)", lambda n: math.log2(n)),
+    ("O(n)", lambda n: float(n)),
+    ("O(n log n)", lambda n: n * math.log2(n)),
+    ("O(n^2)", lambda n: float(n) ** 2),
+    ("O(n^3)", lambda n: float(n) ** 3),
+    ("O(2^n)", lambda n: 2.0 ** n),
+)
+# A simpler class wins unless a more complex one fits this much better
+SIMPLER_MARGIN = 1.5
+
+
+def _relative_fit(xs, ys):
+    """Residual of y ~ a*x + b (a >= 0) with relative errors, so small and large n weigh alike."""
+    w = [1 / (y * y) for y in ys]
+    sw = sum(w)
+    sx = sum(wi * x for wi, x in zip(w, xs))
+    sy = sum(wi * y for wi, y in zip(w, ys))
+    sxx = sum(wi * x * x for wi, x in zip(w, xs))
+    sxy = sum(wi * x * y for wi, x, y in zip(w, xs, ys))
+    det = sw * sxx - sx * sx
+    a = (sw * sxy - sx * sy) / det if det > 1e-300 else 0.0
+    if a < 0:
+        a = 0.0
+    b = (sy - a * sx) / sw
+    return sum(wi * (a * x + b - y) ** 2 for wi, x, y in zip(w, xs, ys))
+
+def fit_complexity(ns, ys):
+    """Best-fitting class name for measurements ``ys`` at sizes ``ns`` (None with under 4 points)."""
+    points = [(n, y) for n, y in zip(ns, ys) if y > 0]
+    if len(points) < 4:
+        return None
+    ns, ys = [n for n, _ in points], [y for _, y in points]
+    residuals = []
+    for name, f in COMPLEXITY_CLASSES:
+        if name == "O(2^n)" and max(ns) > 256:
+            continue
+        residuals.append((name, _relative_fit([f(n) for n in ns], ys)))
+    best = min(r for _, r in residuals)
+    for name, residual in residuals:
+        if residual <= best * SIMPLER_MARGIN + 1e-12:
+            return name
+
+def growth_exponent(ns, ys):
+    """Slope of log y over log n between the two largest sizes (k in n^k)."""
+    points = [(n, y) for n, y in zip(ns, ys) if y > 0]
+    if len(points) < 2:
+        return None
+    (n1, y1), (n2, y2) = points[-2], points[-1]
+    return round(math.log(y2 / y1) / math.log(n2 / n1), 2)
+
+def _memory_ys(samples):
+    """Peak bytes above the smallest run, so the interpreter's fixed overhead does not flatten the fit."""
+    base = min(s["peak_bytes"] for s in samples)
+    return [s["peak_bytes"] - base + 1024 for s in samples]
+
+
+def analyze(code: str, function: str | None = None) -> dict:
+    """Run ``code`` in the pool and fit its runtime and memory curves."""
+    timeout = getattr(settings, "LLM_SANDBOX_TIMEOUT", 10.0)
+    job = {
+        "code": code, "function": function or None, "seed": 0,
+        "time_budget": timeout * 0.7,
+        "max_call_seconds": getattr(settings, "LLM_SANDBOX_MAX_CALL_SECONDS", 1.0),
+        "max_n": getattr(settings, "LLM_SANDBOX_MAX_N", 1 << 17),
+    }
+    result = get_pool().run(job, timeout, getattr(settings, "LLM_SANDBOX_QUEUE_WAIT", 5.0))
+    samples = result.get("samples") or []
+    ns = [s["n"] for s in samples]
+    if samples:
+        seconds = [s["seconds"] for s in samples]
+        memory = _memory_ys(samples)
+        result["time"] = {"class": fit_complexity(ns, seconds), "exponent": growth_exponent(ns, seconds)}
+        result["memory"] = {"class": fit_complexity(ns, memory), "exponent": growth_exponent(ns, memory)}
+    return result
+
+def _size(num_bytes) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GiB"
+
+def report_markdown(result) -> str:
+    """The measurements as a note for the conversation (and the mentor)."""
+    name = f"`{result['function']}`" if result.get("function") else "the solution"
+    lines = [f"**Measured run of {name}** (sandboxed, generated inputs of doubling size)"]
+    samples = result.get("samples") or []
+    if samples:
+        time_fit, memory_fit = result["time"], result["memory"]
+        lines.append("")
+        lines.append(
+            f"- Runtime: **{time_fit['class'] or 'not enough data'}**"
+            + (f" (growth exponent {time_fit['exponent']})" if time_fit["exponent"] is not None else "")
+        )
+        lines.append(
+            f"- Extra memory: **{memory_fit['class'] or 'not enough data'}**"
+            + (f" (peak {_size(samples[-1]['peak_bytes'])} at n={samples[-1]['n']})")
+        )
+        lines += ["", "| n | time per call | peak memory |", "|---:|---:|---:|"]
+        lines += [f"| {s['n']} | {s['seconds'] * 1000:.3f} ms | {_size(s['peak_bytes'])} |" for s in samples]
+    if result.get("stopped"):
+        lines += ["", f"Stopped early: {result['stopped']}."]
+    if result.get("error"):
+        lines += ["", f"Error: `{result['error']}`"]
+    return "\n".join(lines)
@@ -0,0 +1,185 @@
+"""Full-text search over a user's messages.
+
+The index is maintained by the database on every insert (see migration
+0005_message_search): an FTS5 table on SQLite, a generated tsvector column
+with a GIN index on Postgres. Other databases fall back to a substring scan.
+Results are ranked by bm25 / ts_rank_cd and carry an HTML snippet with the
+matched terms in <mark>.
+
+On SQLite, a later migration that remakes chatbot_message (AlterField and
+most other changes copy the table) drops the sync triggers without any
+error, and the index silently goes stale. ``repair_index`` recreates
+whatever is missing and rebuilds the FTS table. It runs after every
+``migrate`` (see apps.py) and from ``manage.py llm_search_index``.
+"""
+import logging
+import re
+
+from django.db import DatabaseError, connection, connections
+from django.db.migrations.recorder import MigrationRecorder
+from django.utils.html import escape
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 20
+MAX_QUERY_TERMS = 8
+# Snippet markers that cannot occur in escaped text; replaced after escaping
+_START, _END = "\x02", "\x03"
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+_SQLITE_SQL = f"""
+    SELECT m.conversation_id, c.title, m.seq, m.role,
+           snippet(chatbot_message_fts, 0, '{_START}', '{_END}', '…', 16)
+    FROM chatbot_message_fts
+    JOIN chatbot_message m ON m.id = chatbot_message_fts.rowid
+    JOIN chatbot_conversation c ON c.id = m.conversation_id
+    WHERE chatbot_message_fts MATCH %s AND c.owner = %s
+    ORDER BY bm25(chatbot_message_fts)
+    LIMIT %s
+"""
+_POSTGRES_SQL = f"""
+    SELECT m.conversation_id, c.title, m.seq, m.role,
+           ts_headline('english', m.content, q,
+                       'StartSel={_START}, StopSel={_END}, MaxWords=24, MinWords=8, MaxFragments=1')
+    FROM chatbot_message m
+    JOIN chatbot_conversation c ON c.id = m.conversation_id,
+         websearch_to_tsquery('english', %s) q
+    WHERE m.search_vector @@ q AND c.owner = %s
+    ORDER BY ts_rank_cd(m.search_vector, q) DESC
+    LIMIT %s
+"""
+
+
+def _terms(query: str) -> list[str]:
+    return _TERM_RE.findall(query)[:MAX_QUERY_TERMS]
+
+def _fts5_query(terms) -> str:
+    """Every term must match; the last one as a prefix, since users search as they type."""
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def _snippet_html(snippet: str) -> str:
+    return escape(snippet).replace(_START, "<mark>").replace(_END, "</mark>")
+
+def _scan_snippet(content: str, terms) -> str:
+    lowered = content.lower()
+    at = min((i for i in (lowered.find(t.lower()) for t in terms) if i >= 0), default=0)
+    start = max(0, at - 60)
+    text = ("…" if start else "") + content[start:start + 160] + ("…" if start + 160 < len(content) else "")
+    for t in terms:
+        text = re.sub(f"({re.escape(t)})", f"{_START}\\1{_END}", text, flags=re.IGNORECASE)
+    return text
+
+def _scan(owner, terms, limit):
+    """Substring fallback for databases without a full-text index."""
+    rows = Message.objects.filter(conversation__owner=owner)
+    for t in terms:
+        rows = rows.filter(content__icontains=t)
+    rows = rows.order_by("-conversation__updated_at", "-seq").values_list(
+        "conversation_id", "conversation__title", "seq", "role", "content"
+    )[:limit]
+    return [(cid, title, seq, role, _scan_snippet(content, terms)) for cid, title, seq, role, content in rows]
+
+def search(owner: str, query: str, limit: int = MAX_RESULTS) -> list[dict]:
+    """Best matches for ``query`` among the owner's messages."""
+    terms = _terms(query)
+    if not terms:
+        return []
+    rows = None
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute(_SQLITE_SQL, [_fts5_query(terms), owner, limit])
+                rows = cursor.fetchall()
+            elif connection.vendor == "postgresql":
+                cursor.execute(_POSTGRES_SQL, [query, owner, limit])
+                rows = cursor.fetchall()
+    except DatabaseError:
+        logger.exception("full-text search failed; falling back to a scan")
+    if rows is None:
+        rows = _scan(owner, terms, limit)
+    return [
+        {"conversation_id": cid, "title": title, "seq": seq, "role": role, "snippet_html": _snippet_html(snippet)}
+        for cid, title, seq, role, snippet in rows
+    ]
+
+
+# --------- Index maintenance ----------
+# The objects migration 0005_message_search creates, by name (same statements)
+MIGRATION = ("chatbot", "0005_message_search")
+SQLITE_OBJECTS = {
+    "chatbot_message_fts": (
+        "CREATE VIRTUAL TABLE chatbot_message_fts USING fts5("
+        "content, content='chatbot_message', content_rowid='id', tokenize='porter unicode61')"
+    ),
+    "chatbot_message_fts_ai": (
+        "CREATE TRIGGER chatbot_message_fts_ai AFTER INSERT ON chatbot_message BEGIN "
+        "INSERT INTO chatbot_message_fts(rowid, content) VALUES (new.id, new.content); END"
+    ),
+    "chatbot_message_fts_ad": (
+        "CREATE TRIGGER chatbot_message_fts_ad AFTER DELETE ON chatbot_message BEGIN "
+        "INSERT INTO chatbot_message_fts(chatbot_message_fts, rowid, content) "
+        "VALUES ('delete', old.id, old.content); END"
+    ),
+    "chatbot_message_fts_au": (
+        "CREATE TRIGGER chatbot_message_fts_au AFTER UPDATE OF content ON chatbot_message BEGIN "
+        "INSERT INTO chatbot_message_fts(chatbot_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO chatbot_message_fts(rowid, content) VALUES (new.id, new.content); END"
+    ),
+}
+POSTGRES_OBJECTS = {
+    "search_vector": (
+        "ALTER TABLE chatbot_message ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED"
+    ),
+    "chatbot_message_search": "CREATE INDEX chatbot_message_search ON chatbot_message USING GIN (search_vector)",
+}
+
+
+def _existing(cursor, vendor) -> set[str]:
+    if vendor == "sqlite":
+        names = list(SQLITE_OBJECTS)
+        cursor.execute(f"SELECT name FROM sqlite_master WHERE name IN ({', '.join(['%s'] * len(names))})", names)
+    else:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = 'chatbot_message' AND column_name = 'search_vector' "
+            "UNION SELECT indexname FROM pg_indexes WHERE tablename = 'chatbot_message'"
+        )
+    return {row[0] for row in cursor.fetchall()}
+
+def _objects(conn) -> dict:
+    """The index objects ``conn`` should have: none before migration 0005 or on other databases."""
+    objects = {"sqlite": SQLITE_OBJECTS, "postgresql": POSTGRES_OBJECTS}.get(conn.vendor)
+    if not objects or MIGRATION not in MigrationRecorder(conn).applied_migrations():
+        return {}
+    return objects
+
+def missing_index(using: str = "default") -> list[str]:
+    """Names of search index objects that should exist but do not."""
+    conn = connections[using]
+    objects = _objects(conn)
+    if not objects:
+        return []
+    with conn.cursor() as cursor:
+        existing = _existing(cursor, conn.vendor)
+    return [name for name in objects if name not in existing]
+
+def repair_index(using: str = "default", rebuild: bool = False) -> list[str]:
+    """Recreate missing index objects; returns their names. On SQLite the FTS
+    table is then rebuilt from chatbot_message, since rows written while a
+    trigger was missing are not in it."""
+    conn = connections[using]
+    objects = _objects(conn)
+    missing = missing_index(using)
+    if missing:
+        logger.warning("search index: recreating %s", ", ".join(missing))
+    with conn.cursor() as cursor:
+        for name in missing:
+            cursor.execute(objects[name])
+        if conn.vendor == "sqlite" and objects and (missing or rebuild):
+            cursor.execute("INSERT INTO chatbot_message_fts(chatbot_message_fts) VALUES ('rebuild')")
+    return missing
@@ -0,0 +1,30 @@
+"""Database session store that reports load/save time to chatbot.metrics.
+
+Enabled with SESSION_ENGINE = "chatbot.sessions".
+"""
+from contextvars import ContextVar
+
+from django.contrib.sessions.backends.db import SessionStore as DBSessionStore
+
+from . import metrics
+
+# A store already loaded for this request, before SessionMiddleware (see profiling.allowed)
+_loaded = ContextVar("loaded_session", default=None)
+
+
+def share(store):
+    """Let this request's SessionMiddleware store read ``store`` instead of the database."""
+    _loaded.set(store)
+
+
+class SessionStore(DBSessionStore):
+    def load(self):
+        loaded = _loaded.get()
+        if loaded is not None and loaded is not self and loaded.session_key == self.session_key:
+            return dict(loaded.items())
+        with metrics.timed("session_load"):
+            return super().load()
+
+    def save(self, must_create=False):
+        with metrics.timed("session_save"):
+            return super().save(must_create=must_create)
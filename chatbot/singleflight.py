@@ -0,0 +1,370 @@
+"""Single-flight coalescing of identical in-flight prompts (see ``make_key``).
+
+The first request runs the upstream call in a thread (or task) of its own
+and every request with the same prompt, the first included, reads its deltas
+as they arrive. Each reader stops on its own Budget; the call is stopped
+only once no reader is left. Across workers, a lock in the default cache
+elects one leader and the others poll for the result it publishes.
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .deadlines import Budget
+from .routing import CANCEL_POLL, ERROR_REPLY, Cancelled, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1
+RESULT_TTL = 30
+INTERRUPTED_REPLY = "The shared model request was interrupted. Please try again."
+TIMEOUT_REPLY = "The model request timed out. Please try again."
+
+
+# Cache calls are thread-safe and must not queue behind the request's own sync thread
+_to_async = partial(sync_to_async, thread_sensitive=False)
+
+
+def enabled() -> bool:
+    return getattr(settings, "LLM_SINGLE_FLIGHT", True)
+
+def _timeout() -> float:
+    return getattr(settings, "LLM_TIMEOUT", 60.0) + 5
+
+def make_key(provider_name: str, model: str, messages) -> str:
+    """Exact prompt identity. Unlike the completion-cache key, which only
+    covers the last LLM_CACHE_WINDOW messages, two conversations with
+    different histories never share a flight."""
+    raw = json.dumps([provider_name, model, messages], separators=(",", ":"), ensure_ascii=False, sort_keys=True)
+    return "flight:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _deadline(budget) -> float:
+    """When a follower gives up: the flight timeout, or the end of its budget if sooner."""
+    seconds = _timeout() if budget is None else min(_timeout(), budget.remaining())
+    return time.monotonic() + seconds
+
+def _slice(deadline, budget) -> float:
+    """Seconds to wait before looking at ``budget`` (and the deadline) again."""
+    remaining = deadline - time.monotonic()
+    return remaining if budget is None else min(remaining, CANCEL_POLL)
+
+def _shared_budget(budget):
+    """The shared call's budget: the first reader's time left, but none of its
+    cancellation, which is for that reader alone."""
+    return None if budget is None else Budget(budget.remaining())
+
+def _lock_key(key):
+    return f"flight-lock:{key}"
+
+def _result_key(key):
+    return f"flight-result:{key}"
+
+
+class Flight:
+    """Deltas of one upstream call, readable by any number of readers."""
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.truncated = False
+        self.readers = 0
+        # Stops the upstream call; called when the last reader leaves before it is done
+        self.abandon = None
+        self.abandoned = False
+        self._cond = threading.Condition()
+
+    def join(self) -> bool:
+        """Count one more reader; False once the flight has been abandoned."""
+        with self._cond:
+            if self.abandoned:
+                return False
+            self.readers += 1
+            return True
+
+    def leave(self):
+        with self._cond:
+            self.readers -= 1
+            self.abandoned = self.readers == 0 and not self.done
+            abandon = self.abandon if self.abandoned else None
+        if abandon is not None:
+            abandon()
+
+    def push(self, delta):
+        with self._cond:
+            self.parts.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error=None, truncated=False):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self.truncated = truncated
+            self._cond.notify_all()
+
+    def _end(self, budget, seen):
+        """At the reader's deadline: keep what arrived, as a truncated reply."""
+        if not seen:
+            raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+        if budget is not None:
+            budget.truncated = True
+
+    def _close(self, budget, error):
+        if error:
+            raise UpstreamError(error)
+        if self.truncated and budget is not None:
+            budget.truncated = True
+
+    def follow(self, budget=None):
+        """Deltas for one reader (already counted by ``join``), until the call
+        ends or ``budget`` is cancelled or runs out."""
+        deadline = _deadline(budget)
+        seen = 0
+        try:
+            while True:
+                with self._cond:
+                    while seen >= len(self.parts) and not self.done:
+                        if budget is not None and budget.cancelled():
+                            raise Cancelled()
+                        if deadline - time.monotonic() <= 0:
+                            return self._end(budget, seen)
+                        self._cond.wait(_slice(deadline, budget))
+                    new, done, error = self.parts[seen:], self.done, self.error
+                seen += len(new)
+                yield from new
+                if done:
+                    return self._close(budget, error)
+        finally:
+            self.leave()
+
+    async def afollow(self, budget=None):
+        deadline = _deadline(budget)
+        seen = 0
+        try:
+            while True:
+                new, done, error = self.parts[seen:], self.done, self.error
+                seen += len(new)
+                for delta in new:
+                    yield delta
+                if done:
+                    if seen < len(self.parts):
+                        continue
+                    self._close(budget, error)
+                    return
+                if budget is not None and await budget.acancelled():
+                    raise Cancelled()
+                if time.monotonic() > deadline:
+                    self._end(budget, seen)
+                    return
+                await asyncio.sleep(POLL_INTERVAL / 2)
+        finally:
+            self.leave()
+
+
+_flights = {}
+_lock = threading.Lock()
+
+
+def _lead_or_follow(key):
+    """The flight for key, joined as a reader, and whether this caller started it."""
+    with _lock:
+        flight = _flights.get(key)
+        if flight is not None and flight.join():
+            return flight, False
+        flight = _flights[key] = Flight()
+        flight.join()
+        return flight, True
+
+def _land(key, flight, reply=None, error=None, publish=True, truncated=False):
+    flight.finish(error, truncated)
+    with _lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+    if publish:
+        cache.set(_result_key(key), {"reply": reply, "error": error}, timeout=RESULT_TTL)
+        cache.delete(_lock_key(key))
+
+def _claim(key) -> bool:
+    """Become the cross-worker leader for key."""
+    if cache.add(_lock_key(key), 1, timeout=int(_timeout())):
+        cache.delete(_result_key(key))
+        return True
+    return False
+
+def _remote_result(key):
+    """(done, reply) published by another worker's leader, or (False, None) while it runs.
+
+    A lock that disappeared without a result means the leader died; callers
+    then go upstream themselves.
+    """
+    result = cache.get(_result_key(key))
+    if result is None and cache.get(_lock_key(key)) is None:
+        result = cache.get(_result_key(key))
+        if result is None:
+            return True, None
+    if result is None:
+        return False, None
+    if result["error"]:
+        raise UpstreamError(result["error"])
+    return True, result["reply"]
+
+def _wait_remote(key, budget=None):
+    deadline = _deadline(budget)
+    while time.monotonic() < deadline:
+        done, reply = _remote_result(key)
+        if done:
+            return reply
+        if budget is not None and budget.cancelled():
+            raise Cancelled()
+        time.sleep(POLL_INTERVAL)
+    raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+
+async def _await_remote(key, budget=None):
+    deadline = _deadline(budget)
+    while time.monotonic() < deadline:
+        done, reply = await _to_async(_remote_result)(key)
+        if done:
+            return reply
+        if budget is not None and await budget.acancelled():
+            raise Cancelled()
+        await asyncio.sleep(POLL_INTERVAL)
+    raise UpstreamError(TIMEOUT_REPLY, retriable=True)
+
+
+# --------- Sync API ----------
+def stream(key, open_stream, budget=None):
+    """Yield the deltas of ``open_stream(shared_budget)``, shared by all concurrent
+    callers with ``key``. ``budget`` (a deadlines.Budget) bounds how long this
+    caller reads; the call itself runs until it is done or nobody reads it."""
+    flight, leader = _lead_or_follow(key)
+    if leader:
+        shared = _shared_budget(budget)
+        flight.abandon = shared.cancel if shared is not None else None
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(_drive, key, flight, open_stream, shared),
+            name="chat-flight", daemon=True,
+        ).start()
+    yield from flight.follow(budget)
+
+def _drive(key, flight, open_stream, budget):
+    claimed = False
+    try:
+        if not _claim(key):
+            reply = _wait_remote(key, budget)
+            if reply is not None:
+                flight.push(reply)
+                _land(key, flight, publish=False)
+                return
+            _claim(key)
+        claimed = True
+        parts = []
+        upstream = open_stream(budget)
+        try:
+            for delta in upstream:
+                parts.append(delta)
+                flight.push(delta)
+        finally:
+            upstream.close()
+    except Cancelled:
+        # Nobody reads it any more; other workers waiting on the lock go upstream themselves
+        _land(key, flight, error=INTERRUPTED_REPLY, publish=False)
+        if claimed:
+            cache.delete(_lock_key(key))
+    except UpstreamError as e:
+        _land(key, flight, error=str(e), publish=claimed)
+    except Exception:
+        logger.exception("shared model call failed")
+        _land(key, flight, error=ERROR_REPLY, publish=claimed)
+    else:
+        _land(key, flight, reply="".join(parts), truncated=budget is not None and budget.truncated)
+    finally:
+        close_old_connections()
+
+def run(key, compute, budget=None) -> str:
+    """Return ``compute(shared_budget)``, shared by all concurrent callers with ``key``."""
+    return "".join(stream(key, lambda shared: _Single(compute(shared)), budget))
+
+
+class _Single:
+    """A complete reply presented as a one-delta stream."""
+
+    def __init__(self, reply):
+        self.reply = reply
+
+    def __iter__(self):
+        yield self.reply
+
+    async def __aiter__(self):
+        yield self.reply
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+# --------- Async API ----------
+async def astream(key, aopen_stream, budget=None):
+    flight, leader = _lead_or_follow(key)
+    if leader:
+        shared = _shared_budget(budget)
+        loop = asyncio.get_running_loop()
+        # Kept on the flight, so the task is not garbage-collected while it runs
+        flight.task = asyncio.ensure_future(_adrive(key, flight, aopen_stream, shared))
+        flight.abandon = lambda: loop.call_soon_threadsafe(flight.task.cancel)
+    follower = flight.afollow(budget)
+    try:
+        async for delta in follower:
+            yield delta
+    finally:
+        await follower.aclose()
+
+async def _adrive(key, flight, aopen_stream, budget):
+    claimed = False
+    try:
+        if not await _to_async(_claim)(key):
+            reply = await _await_remote(key, budget)
+            if reply is not None:
+                flight.push(reply)
+                await _to_async(_land)(key, flight, publish=False)
+                return
+            await _to_async(_claim)(key)
+        claimed = True
+        parts = []
+        upstream = await aopen_stream(budget)
+        try:
+            async for delta in upstream:
+                parts.append(delta)
+                flight.push(delta)
+        finally:
+            await upstream.aclose()
+    except (Cancelled, asyncio.CancelledError):
+        await asyncio.shield(_to_async(_land)(key, flight, error=INTERRUPTED_REPLY, publish=False))
+        if claimed:
+            await asyncio.shield(cache.adelete(_lock_key(key)))
+    except UpstreamError as e:
+        await _to_async(_land)(key, flight, error=str(e), publish=claimed)
+    except Exception:
+        logger.exception("shared model call failed")
+        await _to_async(_land)(key, flight, error=ERROR_REPLY, publish=claimed)
+    else:
+        await _to_async(_land)(
+            key, flight, reply="".join(parts), truncated=budget is not None and budget.truncated
+        )
+
+async def arun(key, acompute, budget=None) -> str:
+    async def aopen(shared):
+        return _Single(await acompute(shared))
+
+    return "".join([delta async for delta in astream(key, aopen, budget)])
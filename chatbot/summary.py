@@ -0,0 +1,87 @@
+"""Incremental rolling summaries of long conversations.
+
+When packing the prompt leaves older messages out of the window, a
+background thread folds just those messages (from ``summary_seq`` up to the
+oldest packed one) into ``Conversation.summary``. The summary is sent as a
+system message right after the mentor prompt, so prompt size stays bounded
+while the gist of the early conversation is kept.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .models import Conversation
+from .providers import EMPTY_REPLY
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a tutoring chat between a user and a coding mentor. "
+    "Update the summary with the new messages. Keep the problems discussed, the user's code "
+    "and constraints, approaches and complexities already explained, and open questions. "
+    "Reply with the updated summary only, at most 200 words."
+)
+MAX_MESSAGE_CHARS = 2000
+MAX_SUMMARY_CHARS = 4000
+_LOCK_TIMEOUT = 120
+
+
+def enabled() -> bool:
+    return getattr(settings, "LLM_SUMMARY_ENABLED", False)
+
+def summary_messages(convo) -> list:
+    if not enabled() or not convo.summary:
+        return []
+    return [{"role": "system", "content": f"Summary of the earlier conversation:\n{convo.summary}"}]
+
+def summarized_upto(convo) -> int:
+    return convo.summary_seq if enabled() else 0
+
+def maybe_schedule(convo, first_packed_seq: int, complete):
+    """Start a background update when enough messages fell out of the window.
+
+    ``complete(messages) -> str`` performs the upstream call.
+    """
+    if not enabled():
+        return
+    if first_packed_seq - convo.summary_seq < getattr(settings, "LLM_SUMMARY_BATCH", 4):
+        return
+    if not cache.add(f"summary-lock:{convo.pk}", 1, timeout=_LOCK_TIMEOUT):
+        return
+    threading.Thread(
+        target=_run, args=(convo.pk, first_packed_seq, complete), name="chat-summary", daemon=True
+    ).start()
+
+def _run(convo_id, upto_seq, complete):
+    try:
+        update_summary(convo_id, upto_seq, complete)
+    except Exception:
+        logger.exception("summary update failed (conversation=%s)", convo_id)
+    finally:
+        cache.delete(f"summary-lock:{convo_id}")
+        close_old_connections()
+
+def update_summary(convo_id, upto_seq, complete):
+    convo = Conversation.objects.only("summary", "summary_seq").get(pk=convo_id)
+    if convo.summary_seq >= upto_seq:
+        return
+    new = convo.messages.filter(seq__gte=convo.summary_seq, seq__lt=upto_seq).values_list("role", "content")
+    lines = [f"{role.capitalize()}: {content[:MAX_MESSAGE_CHARS]}" for role, content in new]
+    prompt = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": f"Current summary:\n{convo.summary or '(none)'}\n\nNew messages:\n" + "\n\n".join(lines)},
+    ]
+    text = complete(prompt).strip()
+    if not text or text == EMPTY_REPLY:
+        # Keep summary_seq where it is, so the next turn folds these messages in again
+        logger.warning("summary conversation=%s upto=%d: empty reply, not stored", convo_id, upto_seq)
+        return
+    text = text[:MAX_SUMMARY_CHARS]
+    # Only advance from the state we summarized, in case another worker got there first
+    updated = Conversation.objects.filter(pk=convo_id, summary_seq=convo.summary_seq).update(
+        summary=text, summary_seq=upto_seq
+    )
+    logger.info("summary conversation=%s upto=%d updated=%s", convo_id, upto_seq, bool(updated))
@@ -0,0 +1,33 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from chatbot.deadlines import Budget
+from chatbot.routing import UpstreamError
+
+MODEL = "unknown-model"  # DEFAULT_CONTEXT_LIMIT, 8192 tokens
+
+
+@override_settings(
+    LLM_MAX_OUTPUT_TOKENS=2048, LLM_MIN_TOKENS=64, LLM_DEADLINE_MARGIN=2.0,
+    LLM_DEADLINE_PRIOR_TTFT=1.0, LLM_DEADLINE_PRIOR_TOKENS_PER_SEC=40.0,
+)
+class MaxTokensTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sized_by_time_left(self):
+        # (23s - 2s margin - 1s ttft) at 40 tokens/s
+        self.assertAlmostEqual(Budget(23.0).max_tokens("groq", MODEL), 800, delta=5)
+
+    @override_settings(LLM_DEADLINE_PRIOR_TOKENS_PER_SEC=1000.0)
+    def test_capped_by_max_output_tokens(self):
+        self.assertEqual(Budget(23.0).max_tokens("groq", MODEL, prompt_tokens=100), 2048)
+
+    @override_settings(LLM_DEADLINE_PRIOR_TOKENS_PER_SEC=1000.0)
+    def test_capped_by_what_the_prompt_leaves(self):
+        self.assertEqual(Budget(23.0).max_tokens("groq", MODEL, prompt_tokens=7000), 1192)
+
+    @override_settings(LLM_DEADLINE_PRIOR_TOKENS_PER_SEC=1000.0)
+    def test_full_window_starts_no_call(self):
+        with self.assertRaises(UpstreamError):
+            Budget(23.0).max_tokens("groq", MODEL, prompt_tokens=8150)
@@ -0,0 +1,43 @@
+import json
+import tempfile
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+from chatbot import evaluation
+
+PROMPT = {"id": "1", "messages": [{"role": "user", "content": "two sum"}]}
+
+
+class SameProviderTwoModelsTests(SimpleTestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.output = Path(folder.name) / "out.jsonl"
+
+    def test_rerun_skips_only_the_model_that_finished(self):
+        writer = evaluation.ResultWriter(self.output)
+        writer.write(evaluation._result(PROMPT, "openai", "gpt-4o", "direct", reply="ok", latency=1.0))
+        writer.write(evaluation._result(PROMPT, "openai", "gpt-4o-mini", "direct", error="HTTP 500"))
+        writer.close()
+        self.assertEqual(evaluation.completed_pairs(self.output), {("1", "openai", "gpt-4o")})
+
+    def test_summary_rows_are_per_model(self):
+        rows = [
+            evaluation._result(PROMPT, "openai", "gpt-4o", "direct", reply="ok", latency=2.0),
+            evaluation._result(PROMPT, "openai", "gpt-4o-mini", "direct", reply="ok", latency=0.5),
+        ]
+        big = evaluation.summarize("openai", "gpt-4o", False, rows, 2.0)
+        mini = evaluation.summarize("openai", "gpt-4o-mini", False, rows, 0.5)
+        self.assertEqual((big["requests"], big["p50_ms"]), (1, 2000.0))
+        self.assertEqual((mini["requests"], mini["p50_ms"]), (1, 500.0))
+
+    def test_batch_state_is_per_model(self):
+        state = evaluation.BatchState(self.output)
+        state.set("openai", "gpt-4o", {"batch_id": "b1", "model": "gpt-4o"})
+        state.set("openai", "gpt-4o-mini", {"batch_id": "b2", "model": "gpt-4o-mini"})
+        reloaded = evaluation.BatchState(self.output)
+        self.assertEqual(reloaded.get("openai", "gpt-4o")["batch_id"], "b1")
+        self.assertEqual(reloaded.get("openai", "gpt-4o-mini")["batch_id"], "b2")
+        reloaded.set("openai", "gpt-4o", None)
+        self.assertEqual(list(json.loads(Path(f"{self.output}.batches.json").read_text())), ["openai:gpt-4o-mini"])
@@ -0,0 +1,77 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from chatbot import jobs
+from chatbot.models import Conversation, Job
+from chatbot.singleflight import _Single
+
+TURN = {
+    "provider": "openai", "chain": [("openai", "gpt-4o-mini")],
+    "messages": [{"role": "user", "content": "explain two sum"}], "cache_key": None, "flight_key": None,
+}
+
+
+@override_settings(LLM_JOB_QUEUE=True, LLM_CACHE_ENABLED=False)
+class RunJobTests(TestCase):
+    def setUp(self):
+        self.convo = Conversation.objects.create(owner="tester")
+        self.convo.append("user", "explain two sum")
+        jobs.enqueue(self.convo, TURN)
+        patcher = mock.patch.object(jobs, "_generate_stream", return_value=_Single("Use a hash map."))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _assistant_replies(self):
+        return list(self.convo.messages.filter(role="assistant").values_list("content", flat=True))
+
+    def _expire(self, job):
+        Job.objects.filter(pk=job.pk).update(lease_until=timezone.now() - timedelta(seconds=1))
+
+    def test_reply_is_appended_once(self):
+        job = jobs.claim("w1")
+        jobs.run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(self._assistant_replies(), ["Use a hash map."])
+
+    def test_late_worker_after_requeue_adds_nothing(self):
+        stale = jobs.claim("w1")
+        self._expire(stale)
+        self.assertEqual(jobs.requeue_expired(), 1)
+        # The job's first worker finishes after its lease ran out and the job was requeued
+        jobs.run_job(stale)
+        self.assertEqual(self._assistant_replies(), [])
+        jobs.run_job(jobs.claim("w2"))
+        self.assertEqual(self._assistant_replies(), ["Use a hash map."])
+
+    @override_settings(LLM_JOB_MAX_ATTEMPTS=1)
+    def test_late_worker_after_give_up_adds_nothing(self):
+        stale = jobs.claim("w1")
+        self._expire(stale)
+        jobs.requeue_expired()
+        jobs.run_job(stale)
+        self.assertEqual(self._assistant_replies(), [jobs.INTERRUPTED_REPLY])
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+
+    @override_settings(LLM_JOB_MAX_ATTEMPTS=1)
+    def test_requeue_counts_only_jobs_it_finished(self):
+        self._expire(jobs.claim("w1"))
+        # Another worker finished the job between the lookup and the update
+        with mock.patch.object(jobs, "finish", return_value=False):
+            self.assertEqual(jobs.requeue_expired(), 0)
+        self.assertEqual(self._assistant_replies(), [])
+
+
+@override_settings(LLM_JOB_QUEUE=True, LLM_JOB_WAIT=0.5)
+class JobEventsTests(TestCase):
+    def test_stream_ends_with_pending_within_job_wait(self):
+        self.client.get(reverse("chatbot:chatbot_home"))
+        convo = Conversation.objects.get()
+        job = jobs.enqueue(convo, TURN)
+        response = self.client.get(reverse("chatbot:chatbot_job_events", args=[job.pk]))
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn("event: pending", body)
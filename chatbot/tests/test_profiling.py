@@ -0,0 +1,71 @@
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from chatbot import profiling
+
+
+class ProfilingAccessTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+        settings = override_settings(
+            PROFILING=True, PROFILE_DIR=self.folder, PROFILE_SAMPLE_RATE=0.0,
+            PROFILE_MAX_PER_MINUTE=30, PROFILE_TOKEN="secret",
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.url = reverse("chatbot:chatbot_conversations") + "?profile=1"
+
+    def _saved(self):
+        return list(self.folder.glob("*.json"))
+
+    def test_anonymous_flag_starts_no_sampler(self):
+        with mock.patch.object(profiling.Profile, "begin") as begin:
+            response = self.client.get(self.url)
+        begin.assert_not_called()
+        self.assertNotIn("X-Profile-Id", response)
+        self.assertEqual(self._saved(), [])
+
+    def test_wrong_token_is_refused(self):
+        response = self.client.get(self.url, headers={"X-Profile-Token": "guess"})
+        self.assertNotIn("X-Profile-Id", response)
+
+    def test_token_is_profiled(self):
+        response = self.client.get(self.url, headers={"X-Profile-Token": "secret"})
+        self.assertIsNotNone(profiling.load(response["X-Profile-Id"]))
+
+    def test_staff_is_profiled(self):
+        staff = get_user_model().objects.create_user("admin", password="pw", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(self.url)
+        self.assertEqual(len(self._saved()), 1)
+        self.assertIn("X-Profile-Id", response)
+
+    def test_staff_session_is_read_once(self):
+        staff = get_user_model().objects.create_user("admin", password="pw", is_staff=True)
+        self.client.force_login(staff)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        reads = [q for q in queries if q["sql"].startswith("SELECT") and "django_session" in q["sql"]]
+        self.assertEqual(len(reads), 1)
+
+    def test_non_staff_session_is_refused(self):
+        self.client.force_login(get_user_model().objects.create_user("user", password="pw"))
+        response = self.client.get(self.url)
+        self.assertNotIn("X-Profile-Id", response)
+
+    @override_settings(PROFILE_MAX_PER_MINUTE=2)
+    def test_profiles_per_minute_are_capped(self):
+        for _ in range(4):
+            self.client.get(self.url, headers={"X-Profile-Token": "secret"})
+        self.assertEqual(len(self._saved()), 2)
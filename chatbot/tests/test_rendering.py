@@ -0,0 +1,23 @@
+from django.core.cache import caches
+from django.test import SimpleTestCase
+
+from chatbot import rendering
+
+
+class RenderManyTests(SimpleTestCase):
+    def setUp(self):
+        caches[rendering.CACHE_ALIAS].clear()
+
+    def test_renders_and_caches(self):
+        first = rendering.render_many(["**bold**", "plain"])
+        self.assertIn("<strong>bold</strong>", first[0])
+        self.assertEqual(rendering.render_many(["**bold**", "plain"]), first)
+
+    def test_empty_cached_render_is_a_hit(self):
+        rendering.render_many([""])
+        # The second call finds "" in the cache; it must not be treated as a miss
+        self.assertEqual(rendering.render_many(["", "text"]), ["", rendering.render_markdown("text")])
+
+    def test_matches_render_cached(self):
+        texts = ["# Title", "", "`code`", "# Title"]
+        self.assertEqual(rendering.render_many(texts), [rendering.render_cached(t) for t in texts])
@@ -0,0 +1,77 @@
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from chatbot import mockllm, providers, routing
+
+MESSAGES = [{"role": "user", "content": "explain two sum"}]
+CHAIN = [("openai", "gpt-4o-mini"), ("groq", "llama-3.1-8b-instant")]
+
+
+@override_settings(LLM_UPSTREAM_ORIGIN="", LLM_RATE_LIMIT=False, LLM_ROUTING="static")
+class FailoverTests(SimpleTestCase):
+    """complete() over two mock providers: openai is the primary, groq the fallback."""
+
+    def setUp(self):
+        routing._breakers.clear()
+        routing._latencies.clear()
+        self.primary = mockllm.start(behaviour=mockllm.Behaviour(latency=0, tokens_per_sec=0, reply_tokens=5))
+        self.fallback = mockllm.start(behaviour=mockllm.Behaviour(latency=0, tokens_per_sec=0, reply_tokens=5))
+        for server in (self.primary, self.fallback):
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+        urls = {
+            name: f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+            for name, server in (("openai", self.primary), ("groq", self.fallback))
+        }
+        for name, url in urls.items():
+            patcher = mock.patch.dict(providers.PROVIDERS[name], url=url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict("os.environ", OPENAI_API_KEY="k", GROQ_API_KEY="k")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_primary_answers(self):
+        reply = providers.complete(CHAIN, MESSAGES)
+        self.assertTrue(reply.startswith("Use a hash map"))
+        self.assertEqual(self.fallback.snapshot()["requests"], 0)
+
+    def test_fails_over_on_5xx(self):
+        self.primary.behaviour.error_rate = 1.0
+        reply = providers.complete(CHAIN, MESSAGES)
+        self.assertTrue(reply.startswith("Use a hash map"))
+        self.assertEqual(self.primary.snapshot()["errors"], 1)
+        self.assertEqual(self.fallback.snapshot()["requests"], 1)
+
+    def test_client_error_is_not_retried(self):
+        self.primary.behaviour.error_rate = 1.0
+        self.primary.behaviour.error_status = 400
+        with self.assertRaises(routing.UpstreamError) as raised:
+            providers.complete(CHAIN, MESSAGES)
+        self.assertEqual(raised.exception.status, 400)
+        self.assertEqual(self.fallback.snapshot()["requests"], 0)
+
+    def test_open_breaker_skips_provider(self):
+        for _ in range(3):
+            routing.breaker("openai").record_failure()
+        providers.complete(CHAIN, MESSAGES)
+        self.assertEqual(self.primary.snapshot()["requests"], 0)
+
+    @override_settings(LLM_HEDGE=True, LLM_HEDGE_DEFAULT_DELAY=0.2, LLM_HEDGE_MIN_DELAY=0.1)
+    def test_hedge_wins_and_loser_is_closed(self):
+        # The primary is slow to start and then takes ~10s to generate its reply
+        self.primary.behaviour.latency = 0.5
+        self.primary.behaviour.tokens_per_sec = 20
+        self.primary.behaviour.reply_tokens = 200
+        started = time.monotonic()
+        reply = providers.complete(CHAIN, MESSAGES)
+        self.assertTrue(reply.startswith("Use a hash map"))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(self.fallback.snapshot()["requests"], 1)
+        # The losing attempt closes its upstream stream instead of reading it to the end
+        deadline = time.monotonic() + 3
+        while self.primary.snapshot()["disconnects"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.primary.snapshot()["disconnects"], 1)
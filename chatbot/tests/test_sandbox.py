@@ -0,0 +1,115 @@
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from chatbot import sandbox
+
+QUADRATIC = '''
+def count_pairs(nums: list[int]) -> int:
+    count = 0
+    for i in range(len(nums)):
+        for j in range(i + 1, len(nums)):
+            if nums[i] < nums[j]:
+                count += 1
+    return count
+'''
+
+
+def _job(time_budget):
+    return {"code": QUADRATIC, "function": None, "seed": 0, "time_budget": time_budget,
+            "max_call_seconds": 10.0, "max_n": 1 << 17}
+
+
+class RunJobTests(SimpleTestCase):
+    def test_quadratic_stays_within_budget(self):
+        sent = []
+        started = time.perf_counter()
+        result = sandbox._run_job(_job(1.5), lambda kind, payload: sent.append((kind, payload)))
+        elapsed = time.perf_counter() - started
+        self.assertIsNone(result["error"])
+        self.assertTrue(result["stopped"].startswith("time budget"))
+        # The traced runs count against the budget too
+        self.assertLess(elapsed, 1.5)
+        self.assertGreaterEqual(len(result["samples"]), 4)
+        self.assertEqual(sent[0], ("function", "count_pairs"))
+        self.assertEqual([p for kind, p in sent if kind == "sample"], result["samples"])
+        ns = [s["n"] for s in result["samples"]]
+        self.assertEqual(sandbox.fit_complexity(ns, [s["seconds"] for s in result["samples"]]), "O(n^2)")
+
+
+class PoolTests(SimpleTestCase):
+    def test_timeout_keeps_finished_samples(self):
+        pool = sandbox.Pool(1, {"memory_mb": 512, "cpu_seconds": 30, "max_jobs": 5})
+        try:
+            # The worker would keep going for 20s; the parent gives up after 1.5s
+            result = pool.run(_job(20.0), 1.5, 5.0)
+        finally:
+            pool.close()
+        self.assertEqual(result["function"], "count_pairs")
+        self.assertEqual(result["stopped"], "timed out after 1.5s")
+        self.assertGreaterEqual(len(result["samples"]), 4)
+
+
+@override_settings(LLM_SANDBOX=True, LLM_RATE_LIMIT=False)
+class AnalyzeViewTests(TestCase):
+    def setUp(self):
+        result = {"function": "count_pairs", "samples": [], "stopped": None, "error": None}
+        patcher = mock.patch.object(sandbox, "analyze", return_value=result)
+        self.analyze = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse("chatbot:chatbot_analyze")
+
+    def test_json_code(self):
+        response = self.client.post(
+            self.url, {"code": QUADRATIC, "function": "count_pairs"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.analyze.assert_called_once_with(QUADRATIC.strip(), "count_pairs")
+
+    def test_form_message_with_code_block(self):
+        response = self.client.post(self.url, {"message": f"```python\n{QUADRATIC}```"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("def count_pairs", self.analyze.call_args.args[0])
+
+
+class IsolationTests(SimpleTestCase):
+    def test_runs_do_not_share_process_state(self):
+        meddle = (
+            "import sys, heapq, builtins\n"
+            "def f(n: int) -> int:\n"
+            "    sys.setrecursionlimit(10**6)\n"
+            "    heapq.heappush = None\n"
+            "    builtins.sorted = None\n"
+            "    return n\n"
+        )
+        check = (
+            "import sys, builtins\n"
+            "def f(n: int) -> int:\n"
+            "    assert sys.getrecursionlimit() < 10**6, 'recursion limit leaked'\n"
+            "    assert callable(heappush) and callable(builtins.sorted), 'patch leaked'\n"
+            "    return n\n"
+        )
+        pool = sandbox.Pool(1, {"memory_mb": 512, "cpu_seconds": 10, "max_jobs": 5})
+        try:
+            results = [
+                pool.run({**_job(0.2), "code": code, "max_n": 16}, 10.0, 5.0) for code in (meddle, check)
+            ]
+        finally:
+            pool.close()
+        self.assertEqual([r["error"] for r in results], [None, None])
+        self.assertTrue(results[1]["samples"])
+
+    def test_killed_run_keeps_its_samples(self):
+        # The run's CPU limit (cpu_seconds + 1) stops it before the parent's timeout
+        spin = "def f(n: int) -> int:\n    while n > 64:\n        pass\n    return n\n"
+        pool = sandbox.Pool(1, {"memory_mb": 512, "cpu_seconds": 1, "max_jobs": 5})
+        try:
+            result = pool.run({**_job(30.0), "code": spin}, 10.0, 5.0)
+            after = pool.run({**_job(0.2), "max_n": 16}, 10.0, 5.0)
+        finally:
+            pool.close()
+        self.assertEqual(result["error"], sandbox.STOPPED_REPLY)
+        self.assertEqual([s["n"] for s in result["samples"]], [8, 16, 32, 64])
+        self.assertIsNone(after["error"])
@@ -0,0 +1,46 @@
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase
+
+from chatbot import search
+from chatbot.models import Conversation
+
+
+class SearchIndexTests(TestCase):
+    def setUp(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("the trigger repair is exercised on SQLite")
+        self.convo = Conversation.objects.create(owner="tester")
+
+    def _drop_triggers(self):
+        with connection.cursor() as cursor:
+            for name in ("chatbot_message_fts_ai", "chatbot_message_fts_ad", "chatbot_message_fts_au"):
+                cursor.execute(f"DROP TRIGGER {name}")
+
+    def test_index_is_complete_after_migrate(self):
+        self.assertEqual(search.missing_index(), [])
+        self.convo.append("user", "dijkstra with a binary heap")
+        self.assertEqual(len(search.search("tester", "dijkstra")), 1)
+
+    def test_repair_recreates_triggers_and_reindexes(self):
+        self._drop_triggers()
+        # Written while the triggers are gone, as after a table remake
+        self.convo.append("user", "bellman ford handles negative edges")
+        self.assertEqual(search.search("tester", "bellman"), [])
+        self.assertEqual(len(search.missing_index()), 3)
+        self.assertEqual(len(search.repair_index()), 3)
+        self.assertEqual(search.missing_index(), [])
+        self.assertEqual(len(search.search("tester", "bellman")), 1)
+        self.convo.append("user", "floyd warshall for all pairs")
+        self.assertEqual(len(search.search("tester", "warshall")), 1)
+
+    def test_command_check_reports_missing_triggers(self):
+        self._drop_triggers()
+        with self.assertRaises(CommandError):
+            call_command("llm_search_index", "--check", stdout=StringIO())
+        out = StringIO()
+        call_command("llm_search_index", stdout=out)
+        self.assertIn("Recreated", out.getvalue())
+        call_command("llm_search_index", "--check", stdout=StringIO())
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from chatbot import singleflight
+from chatbot.deadlines import Budget
+from chatbot.routing import Cancelled
+
+
+def _history(*older):
+    tail = [
+        {"role": "user", "content": "and the edge cases?"},
+        {"role": "assistant", "content": "Empty input and duplicates."},
+        {"role": "user", "content": "thanks, anything else?"},
+    ]
+    return [{"role": "system", "content": "mentor"}] + [{"role": "user", "content": text} for text in older] + tail
+
+
+class KeyTests(SimpleTestCase):
+    def test_same_prompt_same_key(self):
+        self.assertEqual(
+            singleflight.make_key("openai", "m", _history("two sum")),
+            singleflight.make_key("openai", "m", _history("two sum")),
+        )
+
+    def test_different_history_with_same_tail_differs(self):
+        self.assertNotEqual(
+            singleflight.make_key("openai", "m", _history("two sum")),
+            singleflight.make_key("openai", "m", _history("three sum")),
+        )
+
+    def test_provider_and_model_are_part_of_the_key(self):
+        messages = _history("two sum")
+        keys = {
+            singleflight.make_key("openai", "m", messages),
+            singleflight.make_key("groq", "m", messages),
+            singleflight.make_key("openai", "n", messages),
+        }
+        self.assertEqual(len(keys), 3)
+
+
+class FollowTests(SimpleTestCase):
+    def _lead(self, key, release, results):
+        def compute(shared):
+            release.wait(5)
+            return "shared reply"
+
+        thread = threading.Thread(target=lambda: results.append(singleflight.run(key, compute)))
+        thread.start()
+        deadline = time.monotonic() + 2
+        while key not in singleflight._flights and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return thread
+
+    def test_follower_gets_leader_reply(self):
+        key, release, results = "flight:test-share", threading.Event(), []
+        leader = self._lead(key, release, results)
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual(singleflight.run(key, lambda shared: "own reply", Budget(10)), "shared reply")
+        leader.join(5)
+        self.assertEqual(results, ["shared reply"])
+
+    def test_cancelled_follower_stops_waiting(self):
+        key, release, results = "flight:test-cancel", threading.Event(), []
+        leader = self._lead(key, release, results)
+        budget = Budget(10)
+        threading.Timer(0.1, budget.cancel).start()
+        started = time.monotonic()
+        with self.assertRaises(Cancelled):
+            singleflight.run(key, lambda shared: "own reply", budget)
+        self.assertLess(time.monotonic() - started, 1)
+        # The leader's call is not affected by the follower leaving
+        release.set()
+        leader.join(5)
+        self.assertEqual(results, ["shared reply"])
+
+    def test_leader_cancel_leaves_follower_the_reply(self):
+        key, release = "flight:test-leader-cancel", threading.Event()
+        leader_budget, errors = Budget(10), []
+
+        def compute(shared):
+            release.wait(5)
+            return "shared reply"
+
+        def lead():
+            try:
+                singleflight.run(key, compute, leader_budget)
+            except Cancelled as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        while key not in singleflight._flights:
+            time.sleep(0.01)
+        threading.Timer(0.1, leader_budget.cancel).start()
+        threading.Timer(0.3, release.set).start()
+        self.assertEqual(singleflight.run(key, lambda shared: "own reply", Budget(10)), "shared reply")
+        leader.join(5)
+        self.assertEqual(len(errors), 1)
+
+    def test_call_is_stopped_once_nobody_reads_it(self):
+        key, stopped = "flight:test-abandon", threading.Event()
+
+        def open_stream(shared):
+            def deltas():
+                while not shared.cancelled():
+                    time.sleep(0.01)
+                stopped.set()
+                raise Cancelled()
+                yield
+            return deltas()
+
+        budget = Budget(10)
+        threading.Timer(0.1, budget.cancel).start()
+        with self.assertRaises(Cancelled):
+            list(singleflight.stream(key, open_stream, budget))
+        self.assertTrue(stopped.wait(2))
+        self.assertNotIn(key, singleflight._flights)
+
+
+class AsyncFollowTests(SimpleTestCase):
+    def test_leader_cancel_leaves_follower_the_reply(self):
+        key = "flight:test-async-leader-cancel"
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def compute(shared):
+                await release.wait()
+                return "shared reply"
+
+            leader = asyncio.ensure_future(singleflight.arun(key, compute, Budget(10)))
+            await asyncio.sleep(0.05)
+            follower = asyncio.ensure_future(singleflight.arun(key, compute, Budget(10)))
+            await asyncio.sleep(0.05)
+            # Like a client disconnect under ASGI: the leader's view task is cancelled
+            leader.cancel()
+            await asyncio.sleep(0.05)
+            release.set()
+            return await asyncio.wait_for(follower, 5)
+
+        self.assertEqual(asyncio.run(scenario()), "shared reply")
@@ -0,0 +1,23 @@
+from django.test import TestCase
+
+from chatbot import summary
+from chatbot.models import Conversation
+from chatbot.providers import EMPTY_REPLY
+
+
+class UpdateSummaryTests(TestCase):
+    def setUp(self):
+        self.convo = Conversation.objects.create(owner="tester")
+        for i in range(6):
+            self.convo.append("user" if i % 2 == 0 else "assistant", f"message {i}")
+
+    def test_stores_the_summary(self):
+        summary.update_summary(self.convo.pk, 4, lambda prompt: "Two sum with a hash map.")
+        self.convo.refresh_from_db()
+        self.assertEqual((self.convo.summary, self.convo.summary_seq), ("Two sum with a hash map.", 4))
+
+    def test_empty_reply_is_not_stored(self):
+        for reply in ("", EMPTY_REPLY):
+            summary.update_summary(self.convo.pk, 4, lambda prompt: reply)
+            self.convo.refresh_from_db()
+            self.assertEqual((self.convo.summary, self.convo.summary_seq), ("", 0))
@@ -1,14 +1,29 @@
 # chatbot/urls.py
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = "chatbot"
 
+# Under ASGI (uvicorn workers) the async views keep upstream calls off the threadpool.
+if getattr(settings, "LLM_ASYNC_VIEWS", False):
+    ask_view, ask_stream_view = views.submit_chat_async, views.submit_chat_stream_async
+else:
+    ask_view, ask_stream_view = views.submit_chat, views.submit_chat_stream
+
 urlpatterns = [
     path("", views.chat_page, name="chatbot_home"),
     path("c/<slug:convo_id>/", views.chat_page, name="chatbot_chat"),  # open a specific conversation
-    path("ask/", views.submit_chat, name="chatbot_ask"),
+    path("c/<slug:convo_id>/messages/", views.messages_page, name="chatbot_messages"),  # older messages, by cursor
+    path("conversations/", views.conversations_page, name="chatbot_conversations"),  # sidebar, by cursor
+    path("search/", views.search_messages, name="chatbot_search"),
+    path("ask/", ask_view, name="chatbot_ask"),
+    path("ask/stream/", ask_stream_view, name="chatbot_ask_stream"),
+    path("ask/cancel/", views.cancel_chat, name="chatbot_ask_cancel"),  # Stop button
+    path("analyze/", views.analyze_solution, name="chatbot_analyze"),  # sandboxed complexity run (LLM_SANDBOX)
     path("new/", views.new_chat, name="chatbot_new"),
+    path("jobs/<slug:job_id>/", views.job_status, name="chatbot_job"),  # queued replies (LLM_JOB_QUEUE)
+    path("jobs/<slug:job_id>/events/", views.job_events, name="chatbot_job_events"),
     path("diag/", views.diag, name="diag"),
     path("ping/", views.ping, name="ping"),
 ]
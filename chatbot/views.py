@@ -1,200 +1,579 @@
 # chatbot/views.py
+import asyncio
+import hashlib
+import hmac
 import json
 import logging
 import os
+import time
 import uuid
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
 
-import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import HttpResponse, JsonResponse
+from django.contrib import admin
+from django.db import transaction
+from django.db.models import Q
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
-from django.utils.html import escape
+from django.template.defaultfilters import linebreaksbr
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+from . import (
+    completion_cache, deadlines, fragments, jobs, metrics, profiling, providers, ratelimit, rendering, retrieval,
+    routing, sandbox, search, singleflight, summary,
+)
+from .clients import pool_info
+from .context import count_tokens, message_tokens, pack_messages
+from .models import DEFAULT_TITLE, Conversation, Job, Message
+from .providers import CONNECT_ERROR_REPLY, EMPTY_REPLY, PROVIDERS
+from .routing import UpstreamError
 
 logger = logging.getLogger(__name__)
 
-# ----- Provider catalog (OpenAI-compatible /chat/completions) -----
-PROVIDERS = {
-    "deepseek": {
-        "url": "https://api.deepseek.com/chat/completions",
-        "key_env": "DEEPSEEK_API_KEY",
-        "default_model": "deepseek-chat",
-        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
-    },
-    "groq": {
-        "url": "https://api.groq.com/openai/v1/chat/completions",
-        "key_env": "GROQ_API_KEY",
-        "default_model": "llama-3.1-70b-versatile",
-        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
-    },
-    "together": {
-        "url": "https://api.together.xyz/v1/chat/completions",
-        "key_env": "TOGETHER_API_KEY",
-        "default_model": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
-        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
-    },
-    "openrouter": {
-        "url": "https://openrouter.ai/api/v1/chat/completions",
-        "key_env": "OPENROUTER_API_KEY",
-        "default_model": "openai/gpt-4o-mini",
-        "headers": lambda key, req: {
-            "Authorization": f"Bearer {key}",
-            "HTTP-Referer": (req.build_absolute_uri("/") if req else getattr(settings, "SITE_URL", "")),
-            "X-Title": "LeetAI",
-        },
-    },
-    "openai": {
-        "url": "https://api.openai.com/v1/chat/completions",
-        "key_env": "OPENAI_API_KEY",
-        "default_model": "gpt-4o-mini",
-        "headers": lambda key, _req: {"Authorization": f"Bearer {key}"},
-    },
-    "gemini": {
-        "url": "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent",
-        "key_env": "GEMINI_API_KEY",
-        "default_model": "gemini-1.5-flash",
-        "headers": lambda key, _req: {"Content-Type": "application/json"},
-    },
-}
-
-# --------- Gemini adapters ----------
-def _to_gemini_contents(messages):
-    contents = []
-    system_texts = [m["content"] for m in messages if m.get("role") == "system"]
-    sys_prefix = ("\n".join(system_texts) + "\n") if system_texts else ""
-    for m in messages:
-        role = m.get("role")
-        if role == "system":
-            continue
-        if role not in ("user", "assistant"):
-            continue
-        text = m.get("content", "")
-        if role == "user" and sys_prefix:
-            text = sys_prefix + text
-            sys_prefix = ""
-        contents.append({"role": "user" if role == "user" else "model", "parts": [{"text": text}]})
-    return contents
-
-def _parse_gemini_reply(resp_json):
-    try:
-        cands = resp_json.get("candidates") or []
-        if not cands:
-            return ""
-        parts = ((cands[0].get("content") or {}).get("parts") or [])
-        for p in parts:
-            if "text" in p:
-                return p["text"]
-        return ""
-    except Exception:
-        return ""
-
-# --------- Provider selection ----------
-def _select_provider() -> str:
-    name = os.environ.get("LLM_PROVIDER", "openai").lower()
-    return name if name in PROVIDERS else "openai"
-
-def _get_api_key(var_name: str) -> str:
-    raw = os.environ.get(var_name) or getattr(settings, var_name, None) or ""
-    return str(raw).strip().strip('"').strip("'")
-
-# --------- Conversation helpers (session) ----------
+# --------- Conversation helpers (database) ----------
+# The session only holds the anonymous owner token and the current conversation
+# id; conversations and messages live in chatbot.models.
+def _owner(request) -> str:
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    owner = request.session.get("owner_id")
+    if not owner:
+        owner = request.session["owner_id"] = uuid.uuid4().hex
+    return owner
+
+def _import_session_conversations(request, owner):
+    """One-time import of conversations kept in the session by older versions."""
+    convos = request.session.pop("conversations", None) or []
+    legacy = request.session.pop("messages", None) or []
+    if legacy and not convos:
+        convos = [{"id": uuid.uuid4().hex, "title": DEFAULT_TITLE, "messages": legacy}]
+    with transaction.atomic():
+        for c in convos:
+            messages = c.get("messages") or []
+            convo, created = Conversation.objects.get_or_create(
+                id=c.get("id") or uuid.uuid4().hex,
+                defaults={"owner": owner, "title": c.get("title") or DEFAULT_TITLE, "message_count": len(messages)},
+            )
+            if created:
+                Message.objects.bulk_create(
+                    Message(
+                        conversation=convo,
+                        seq=i,
+                        role=m.get("role", "user"),
+                        content=m.get("content", ""),
+                        token_count=count_tokens(m.get("content", "")),
+                    )
+                    for i, m in enumerate(messages)
+                )
+
 def _ensure_conversations(request):
-    """Ensure session has a conversations list and a current ID.
-       Migrate old 'messages' if present."""
-    convos = request.session.get("conversations")
-    if not convos:
-        convos = []
-        old = request.session.get("messages", [])
-        cid = uuid.uuid4().hex
-        convos.append({"id": cid, "title": "New conversation", "messages": old})
-        request.session["conversations"] = convos
-        request.session["current_convo_id"] = cid
-        request.session.modified = True
-    if not request.session.get("current_convo_id"):
-        request.session["current_convo_id"] = convos[0]["id"]
-        request.session.modified = True
+    """Owner's conversations queryset; imports legacy session data and
+    creates a first conversation when there is none."""
+    owner = _owner(request)
+    if "conversations" in request.session or "messages" in request.session:
+        _import_session_conversations(request, owner)
+    convos = Conversation.objects.filter(owner=owner)
+    if not request.session.get("current_convo_id") and not convos.exists():
+        request.session["current_convo_id"] = Conversation.objects.create(owner=owner).id
     return convos
 
-def _get_conversations_list(request):
-    return [{"id": c["id"], "title": c.get("title") or "New conversation"} for c in _ensure_conversations(request)]
+# Keyset cursors: "<updated_at in µs since the epoch>-<id>" for conversations, the seq for messages
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+def _conversation_cursor(row) -> str:
+    return f"{(row['updated_at'] - _EPOCH) // timedelta(microseconds=1)}-{row['id']}"
+
+def _parse_conversation_cursor(cursor):
+    try:
+        micros, convo_id = cursor.split("-", 1)
+        return _EPOCH + timedelta(microseconds=int(micros)), convo_id
+    except ValueError:
+        return None
+
+def _conversation_page(request, before=None, limit=None):
+    """(rows, next cursor) of the owner's conversations, most recently updated first."""
+    limit = limit or getattr(settings, "CHAT_SIDEBAR_PAGE_SIZE", 30)
+    rows = _ensure_conversations(request).order_by("-updated_at", "-id")
+    cursor = _parse_conversation_cursor(before) if before else None
+    if cursor:
+        updated_at, convo_id = cursor
+        rows = rows.filter(Q(updated_at__lt=updated_at) | Q(updated_at=updated_at, id__lt=convo_id))
+    page = list(rows.values("id", "title", "updated_at")[:limit + 1])
+    more = len(page) > limit
+    page = page[:limit]
+    return page, (_conversation_cursor(page[-1]) if more else None)
+
+def _message_page(convo, before=None, limit=None):
+    """(messages, next cursor) for the ``limit`` messages before seq ``before``
+    (the newest when None), oldest first, each with its ``html``."""
+    limit = limit or getattr(settings, "CHAT_PAGE_SIZE", 30)
+    rows = convo.messages.order_by("-seq")
+    if before is not None:
+        rows = rows.filter(seq__lt=before)
+    page = list(rows[:limit + 1])
+    more = len(page) > limit
+    page = page[:limit][::-1]
+    # Replies and sandbox reports (system notes) are Markdown; user text is shown as typed
+    replies = [m for m in page if m.role in ("assistant", "system")]
+    for m, html in zip(replies, rendering.render_many([m.content for m in replies])):
+        m.html = html
+    for m in page:
+        if m.role not in ("assistant", "system"):
+            m.html = linebreaksbr(m.content, autoescape=True)
+    return page, (page[0].seq if more else None)
 
 def _current_convo(request):
+    convo = getattr(request, "_chat_convo", None)
+    if convo is not None:
+        return convo
     convos = _ensure_conversations(request)
     cid = request.session.get("current_convo_id")
-    for c in convos:
-        if c["id"] == cid:
-            return c
-    request.session["current_convo_id"] = convos[0]["id"]
-    request.session.modified = True
-    return convos[0]
+    convo = convos.filter(id=cid).first() if cid else None
+    if convo is None:
+        convo = convos.order_by("-updated_at").first() or Conversation.objects.create(owner=_owner(request))
+        request.session["current_convo_id"] = convo.id
+    request._chat_convo = convo
+    return convo
 
 def _set_current_convo(request, convo_id: str):
-    convos = _ensure_conversations(request)
-    for c in convos:
-        if c["id"] == convo_id:
-            request.session["current_convo_id"] = convo_id
-            request.session.modified = True
-            return c
-    return _current_convo(request)
+    convo = _ensure_conversations(request).filter(id=convo_id).first()
+    if convo is None:
+        return _current_convo(request)
+    request.session["current_convo_id"] = convo.id
+    request._chat_convo = convo
+    return convo
 
 def _new_convo(request):
-    convos = _ensure_conversations(request)
-    cid = uuid.uuid4().hex
-    convo = {"id": cid, "title": "New conversation", "messages": []}
-    convos.append(convo)
-    request.session["current_convo_id"] = cid
-    request.session.modified = True
+    _ensure_conversations(request)
+    convo = Conversation.objects.create(owner=_owner(request))
+    request.session["current_convo_id"] = convo.id
+    request._chat_convo = convo
     return convo
 
 def _append_current_message(request, role: str, content: str):
-    convo = _current_convo(request)
-    convo["messages"].append({"role": role, "content": content})
-    request.session.modified = True
+    return _current_convo(request).append(role, content)
 
 def _maybe_set_title_from_first_user_msg(convo):
-    if convo.get("title") and convo["title"] != "New conversation":
+    if convo.title and convo.title != DEFAULT_TITLE:
         return
     # first non-empty user message -> title
-    for m in convo["messages"]:
-        if m.get("role") == "user":
-            text = " ".join(m.get("content", "").split())
-            if text:
-                title = text[:60]
-                convo["title"] = title
-                return
+    for content in convo.messages.filter(role="user").values_list("content", flat=True)[:5]:
+        text = " ".join(content.split())
+        if text:
+            convo.title = text[:60]
+            # Moving updated_at also moves the sidebar's fragment version
+            convo.updated_at = timezone.now()
+            Conversation.objects.filter(pk=convo.pk).update(title=convo.title, updated_at=convo.updated_at)
+            return
 
 # --------- Simple views ----------
 def ping(_request):
     return HttpResponse("chatbot pong")
 
+def metrics_endpoint(request):
+    """Prometheus scrape target; requires ``Authorization: Bearer $METRICS_TOKEN``,
+    and is not served at all without a token unless DEBUG is on."""
+    if not metrics.enabled():
+        return HttpResponse("metrics disabled (install prometheus_client)", status=404, content_type="text/plain")
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if not token:
+        if not settings.DEBUG:
+            raise Http404
+    elif not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=401)
+    body, content_type = metrics.render_latest()
+    return HttpResponse(body, content_type=content_type)
+
 def diag(request):
-    name = _select_provider()
+    name = providers.select_provider()
     p = PROVIDERS[name]
-    key_ok = bool(_get_api_key(p["key_env"]))
-    return JsonResponse({"provider": name, "model": os.environ.get("LLM_MODEL", p["default_model"]), "has_api_key": key_ok})
+    key_ok = bool(providers.get_api_key(p["key_env"]))
+    return JsonResponse({
+        "provider": name,
+        "model": os.environ.get("LLM_MODEL", p["default_model"]),
+        "has_api_key": key_ok,
+        "http": pool_info(),
+        "completion_cache": completion_cache.stats(),
+        "retrieval": retrieval.info(),
+        "fallbacks": [n for n, _ in providers.provider_chain()[1:]],
+        "breakers": routing.snapshot(),
+        "routing": {
+            "mode": getattr(settings, "LLM_ROUTING", "static"),
+            "table": routing.routing_table(providers.provider_chain(), providers.provider_costs()),
+        },
+    })
+
+# ---------- Request profiles (staff, see chatbot/profiling.py) ----------
+# Served under /admin/profiles/ through admin.site.admin_view, which requires a staff login
+FLAME_ROW_PX = 18
+
+def profile_list(request):
+    return render(request, "chatbot/profiles.html", {
+        **admin.site.each_context(request),
+        "title": "Request profiles",
+        "profiles": profiling.recent(),
+        "enabled": profiling.enabled(),
+    })
+
+def profile_detail(request, profile_id: str):
+    record = profiling.load(profile_id)
+    if record is None:
+        raise Http404("No such profile (it may have been rotated away).")
+    boxes, depth = profiling.flame(record["samples"])
+    for box in boxes:
+        box["top"] = box["depth"] * FLAME_ROW_PX
+    total = record["seconds"] or 1
+    for span in record["spans"]:
+        span["left"] = 100 * span["start"] / total
+        span["width"] = max(0.2, 100 * span["seconds"] / total)
+    return render(request, "chatbot/profile.html", {
+        **admin.site.each_context(request),
+        "title": f"{record['method']} {record['path']}",
+        "profile": record,
+        "boxes": boxes,
+        "height": depth * FLAME_ROW_PX,
+        "sample_count": sum(record["samples"].values()),
+    })
 
 # ---------- Pages ----------
+MAX_PAGE_SIZE = 100
+
 def chat_page(request, convo_id: str | None = None):
+    """The chat page, revalidated by ETag on every view.
+
+    The ETag is built from versions alone (see chatbot/fragments.py), so an
+    unchanged page is a 304 without reading a message; otherwise the sidebar
+    and message list usually come from the fragment cache.
+    """
     if convo_id:
         _set_current_convo(request, convo_id)
     convo = _current_convo(request)
-    return render(
-        request,
-        "chatbot/form.html",
-        {
-            "messages": convo["messages"],
-            "conversations": _get_conversations_list(request),
-            "current_id": convo["id"],
-        },
-    )
+    owner = _owner(request)
+    sidebar_version = fragments.sidebar_version(owner)
+    pending_job = jobs.pending_for(convo) if jobs.enabled() else None
+    etag = ":".join(str(part) for part in (
+        "chat", owner, convo.id, convo.message_count, sidebar_version, rendering.RENDER_VERSION,
+        pending_job.pk if pending_job else "", sandbox.enabled(), fragments.page_version(),
+        # The page embeds a CSRF token, so a new CSRF cookie needs a fresh page
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""),
+    ))
+
+    def build():
+        # Only the newest window of each list; the page fetches older ones on scroll
+        with metrics.timed("render"):
+            return render(
+                request,
+                "chatbot/form.html",
+                {
+                    "messages_html": _messages_fragment(convo) if convo.message_count else "",
+                    "sidebar_html": _sidebar_fragment(request, convo, sidebar_version),
+                    "current_id": convo.id,
+                    # A queued reply still being generated; the page keeps waiting for it
+                    "pending_job": pending_job,
+                    "sandbox": sandbox.enabled(),
+                },
+            )
+
+    return _conditional(request, etag, build)
+
+def _messages_fragment(convo) -> str:
+    limit = getattr(settings, "CHAT_PAGE_SIZE", 30)
+
+    def context():
+        messages, older = _message_page(convo, limit=limit)
+        return {"messages": messages, "older_cursor": older, "current_id": convo.id}
+
+    key = f"messages:{convo.id}:{convo.message_count}:{limit}:{rendering.RENDER_VERSION}"
+    return fragments.render(key, "chatbot/_messages.html", context)
+
+def _sidebar_fragment(request, convo, version) -> str:
+    limit = getattr(settings, "CHAT_SIDEBAR_PAGE_SIZE", 30)
+
+    def context():
+        conversations, more = _conversation_page(request, limit=limit)
+        return {"conversations": conversations, "more_cursor": more, "current_id": convo.id}
+
+    key = f"sidebar:{_owner(request)}:{convo.id}:{version}:{limit}"
+    return fragments.render(key, "chatbot/_sidebar.html", context)
+
+def _page_limit(request, setting, default) -> int:
+    try:
+        limit = int(request.GET.get("limit") or getattr(settings, setting, default))
+    except ValueError:
+        limit = getattr(settings, setting, default)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def _conditional(request, etag, build):
+    """304 when the client's If-None-Match matches ``etag``, else the response ``build()`` returns.
+    Clients must revalidate (no-cache) so new messages show up at once."""
+    etag = quote_etag(hashlib.sha256(etag.encode("utf-8")).hexdigest()[:32])
+    response = get_conditional_response(request, etag=etag) or build()
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def _conditional_json(request, etag, build):
+    return _conditional(request, etag, lambda: JsonResponse(build()))
+
+def messages_page(request, convo_id: str):
+    """Older messages of a conversation: ``?before=<seq>&limit=``, newest first by page.
+
+    A page below a cursor never changes and the newest one only changes with
+    the message count, so the ETag is known before any message is read.
+    """
+    convo = _ensure_conversations(request).filter(id=convo_id).only("id", "message_count").first()
+    if convo is None:
+        return JsonResponse({"error": "Unknown conversation."}, status=404)
+    try:
+        before = int(request.GET["before"]) if request.GET.get("before") else None
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor."}, status=400)
+    limit = _page_limit(request, "CHAT_PAGE_SIZE", 30)
+    version = convo.message_count if before is None else "fixed"
+    etag = f"messages:{convo.id}:{before}:{limit}:{version}:{rendering.RENDER_VERSION}"
+
+    def build():
+        page, older = _message_page(convo, before, limit)
+        url = reverse("chatbot:chatbot_messages", args=[convo.id])
+        return {
+            "messages": [{"seq": m.seq, "role": m.role, "html": m.html} for m in page],
+            "next": f"{url}?before={older}&limit={limit}" if older is not None else None,
+        }
+
+    return _conditional_json(request, etag, build)
+
+def conversations_page(request):
+    """The sidebar's conversations: ``?before=<cursor>&limit=``, most recent first."""
+    limit = _page_limit(request, "CHAT_SIDEBAR_PAGE_SIZE", 30)
+    page, more = _conversation_page(request, request.GET.get("before"), limit)
+    # The ETag covers the rows themselves (ids, titles, cursors) plus the next cursor
+    etag = "conversations:" + json.dumps([[r["id"], r["title"], _conversation_cursor(r)] for r in page] + [more])
+    url = reverse("chatbot:chatbot_conversations")
+    return _conditional_json(request, etag, lambda: {
+        "conversations": [
+            {"id": r["id"], "title": r["title"], "url": reverse("chatbot:chatbot_chat", args=[r["id"]])}
+            for r in page
+        ],
+        "next": f"{url}?before={more}&limit={limit}" if more else None,
+    })
+
+def search_messages(request):
+    """Ranked matches for ``?q=`` across the owner's conversations, with highlighted snippets."""
+    query = request.GET.get("q", "").strip()[:200]
+    with metrics.timed("search"):
+        results = search.search(_owner(request), query) if query else []
+    for r in results:
+        r["url"] = reverse("chatbot:chatbot_chat", args=[r["conversation_id"]])
+    return JsonResponse({"query": query, "results": results})
+
+def analyze_solution(request):
+    """Run the posted solution in the sandbox pool and attach the measurements
+    to the conversation as a system note, so the next reply can use them.
+
+    Body: JSON or form with ``code`` (or a ``message`` containing a python
+    code block) and an optional ``function`` name.
+    """
+    if not sandbox.enabled():
+        return JsonResponse({"error": "The solution sandbox is turned off."}, status=404)
+    if request.method != "POST":
+        return JsonResponse({"error": "POST a solution to measure."}, status=405)
+    payload = _read_chat_payload(request)
+    code = str(payload.get("code") or "").strip() or sandbox.extract_code(payload["message"])
+    if not code:
+        return JsonResponse({"error": "Paste a Python solution (a function or class Solution) to measure."}, status=400)
+
+    limited = _rate_limited(request, {"message": code})
+    if limited is not None:
+        return limited
+    try:
+        with metrics.timed("sandbox"):
+            result = sandbox.analyze(code, str(payload.get("function") or "").strip() or None)
+    except sandbox.SandboxBusy as e:
+        response = JsonResponse({"error": str(e)}, status=503)
+        response["Retry-After"] = "5"
+        return response
+
+    report = sandbox.report_markdown(result)
+    _append_current_message(request, "system", report)
+    return JsonResponse({"report": report, "html": _reply_html(report), "result": result})
 
 def new_chat(request):
     convo = _new_convo(request)
-    return redirect("chatbot:chatbot_chat", convo_id=convo["id"])
+    return redirect("chatbot:chatbot_chat", convo_id=convo.id)
 
 # ---------- Legacy simple form (optional) ----------
 def form_view(request):
     return render(request, "chatbot/form.html")
 
+# ---------- Upstream request helpers ----------
+SYSTEM_PROMPT = "You are a helpful coding mentor."
+
+
+def _read_chat_payload(request) -> dict:
+    """Fields of a chat submission, from a JSON body or form POST; "message" is stripped."""
+    if request.content_type and "application/json" in request.content_type:
+        try:
+            payload = json.loads(request.body.decode("utf-8"))
+        except Exception:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+    else:
+        payload = request.POST.dict()
+    payload["message"] = str(payload.get("message") or "").strip()
+    return payload
+
+def _cache_bypassed(request, payload) -> bool:
+    if str(payload.get("no_cache", "")).lower() in ("1", "true", "on"):
+        return True
+    return "no-cache" in request.headers.get("Cache-Control", "").lower()
+
+def _rate_limited(request, payload):
+    """None if the user's buckets admit this message (after any queueing wait),
+    else the 429 response to send. Nothing has been recorded yet at this point."""
+    admitted, wait = ratelimit.reserve_user(_owner(request), count_tokens(payload["message"]))
+    if admitted:
+        time.sleep(wait)
+        return None
+    return _too_many_requests(wait)
+
+async def _arate_limited(request, payload):
+    admitted, wait = await sync_to_async(ratelimit.reserve_user)(
+        await sync_to_async(_owner)(request), count_tokens(payload["message"])
+    )
+    if admitted:
+        await asyncio.sleep(wait)
+        return None
+    return _too_many_requests(wait)
+
+def _too_many_requests(wait):
+    seconds = max(1, round(wait))
+    response = JsonResponse({"error": ratelimit.USER_REPLY.format(seconds=seconds)}, status=429)
+    response["Retry-After"] = str(seconds)
+    return response
+
+def _reply_html(reply: str) -> str:
+    return rendering.render_cached(reply)
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _delta_event(renderer, delta) -> str:
+    """``delta`` event: the text, plus HTML for the blocks it completed and how
+    much of the reply that HTML now covers (see rendering.StreamRenderer)."""
+    html, upto = renderer.feed(delta)
+    data = {"text": delta, "upto": upto}
+    if html:
+        data["html"] = html
+    return _sse("delta", data)
+
+def _start_turn(request, payload):
+    """Record the user message and prepare the upstream call.
+
+    Returns a dict with provider, model, messages, cache_key (None when
+    caching is off or bypassed), flight_key (for coalescing identical
+    in-flight requests) and error (a reply to use instead of calling
+    upstream, e.g. when the key is missing).
+    """
+    _append_current_message(request, "user", payload["message"])
+    convo = _current_convo(request)
+    _maybe_set_title_from_first_user_msg(convo)
+
+    chain = providers.provider_chain()
+    if not chain:
+        provider_name = providers.select_provider()
+        key_env = PROVIDERS[provider_name]["key_env"]
+        error = f"{provider_name} API key is missing. Set {key_env} in Render → Environment."
+        return {"provider": provider_name, "chain": [], "messages": None, "cache_key": None, "flight_key": None, "error": error}
+
+    provider_name, model = chain[0]
+    turn = {
+        "provider": provider_name, "model": model, "chain": chain,
+        "messages": None, "cache_key": None, "flight_key": None, "error": None,
+    }
+
+    system_messages = [{"role": "system", "content": SYSTEM_PROMPT}] + summary.summary_messages(convo)
+    with metrics.timed("retrieve"):
+        reference = retrieval.context_message(payload["message"])
+    reserve = message_tokens(reference["content"]) if reference else 0
+    with metrics.timed("pack_context"):
+        turn["messages"], first_seq = pack_messages(
+            convo, model, system_messages, summary.summarized_upto(convo), reserve=reserve
+        )
+    if reference:
+        # Just before the user's message, so the cached prompt prefix stays the same
+        turn["messages"].insert(-1, reference)
+    summary.maybe_schedule(convo, first_seq, lambda msgs: _complete(turn, None, msgs))
+    if not _cache_bypassed(request, payload):
+        if completion_cache.enabled():
+            turn["cache_key"] = completion_cache.make_key(provider_name, model, turn["messages"])
+        if singleflight.enabled():
+            turn["flight_key"] = singleflight.make_key(provider_name, model, turn["messages"])
+    return turn
+
+def _complete(turn, request, messages=None, budget=None) -> str:
+    return providers.complete(turn["chain"], messages or turn["messages"], request, budget)
+
+def _open_stream(turn, request, budget=None):
+    return providers.open_stream(turn["chain"], turn["messages"], request, budget)
+
+async def _acomplete(turn, request, budget=None) -> str:
+    return await providers.acomplete(turn["chain"], turn["messages"], request, budget)
+
+async def _aopen_stream(turn, request, budget=None):
+    return await providers.aopen_stream(turn["chain"], turn["messages"], request, budget)
+
+def _generate(turn, request, budget=None) -> str:
+    """Upstream completion, shared with identical requests already in flight."""
+    if turn["flight_key"]:
+        reply = singleflight.run(turn["flight_key"], lambda shared: _complete(turn, request, budget=shared), budget)
+        return reply.strip() or EMPTY_REPLY
+    return _complete(turn, request, budget=budget)
+
+def _generate_stream(turn, request, budget=None):
+    if turn["flight_key"]:
+        return singleflight.stream(turn["flight_key"], lambda shared: _open_stream(turn, request, shared), budget)
+    return _open_stream(turn, request, budget)
+
+async def _agenerate(turn, request, budget=None) -> str:
+    if turn["flight_key"]:
+        reply = await singleflight.arun(turn["flight_key"], lambda shared: _acomplete(turn, request, shared), budget)
+        return reply.strip() or EMPTY_REPLY
+    return await _acomplete(turn, request, budget)
+
+async def _agenerate_stream(turn, request, budget=None):
+    if turn["flight_key"]:
+        return singleflight.astream(turn["flight_key"], lambda shared: _aopen_stream(turn, request, shared), budget)
+    return await _aopen_stream(turn, request, budget)
+
+def _cached_reply(turn):
+    return completion_cache.lookup(turn["cache_key"]) if turn["cache_key"] else None
+
+def _remember_reply(turn, reply, budget=None):
+    # A reply cut short by the deadline is not what the prompt would get with more time
+    if turn["cache_key"] and reply and reply != EMPTY_REPLY and not (budget and budget.truncated):
+        completion_cache.store(turn["cache_key"], reply)
+
+def _final_reply(parts, failed, budget=None) -> str:
+    reply = "".join(parts).strip()
+    if failed and reply:
+        reply = f"{reply}\n\n[{failed}]"
+    elif reply and budget is not None and budget.truncated:
+        reply = f"{reply}\n\n{deadlines.TRUNCATED_NOTE}"
+    return reply or failed or EMPTY_REPLY
+
+def _event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 # ---------- Send message to model ----------
 def submit_chat(request):
     if request.method != "POST":
@@ -204,89 +583,270 @@ def submit_chat(request):
     is_ajax = request.headers.get("x-requested-with") == "XMLHttpRequest"
 
     # Read message
-    question = ""
-    if request.content_type and "application/json" in request.content_type:
-        try:
-            payload = json.loads(request.body.decode("utf-8"))
-            question = (payload.get("message") or "").strip()
-        except Exception:
-            question = ""
-    if not question:
-        question = (request.POST.get("message") or "").strip()
+    payload = _read_chat_payload(request)
+    budget = deadlines.budget_for(request, _owner(request), payload)
 
-    if not question:
+    if not payload["message"]:
         msg = "Please enter a message."
         _append_current_message(request, "assistant", msg)
         if is_ajax:
             return JsonResponse({"error": msg}, status=400)
         return redirect("chatbot:chatbot_home")
 
-    # Append user message
-    _append_current_message(request, "user", question)
-    convo = _current_convo(request)
-    _maybe_set_title_from_first_user_msg(convo)
+    limited = _rate_limited(request, payload)
+    if limited is not None:
+        return limited
 
-    provider_name = _select_provider()
-    p = PROVIDERS[provider_name]
+    turn = _start_turn(request, payload)
+    reply = turn["error"] or _cached_reply(turn)
 
-    key = _get_api_key(p["key_env"])
-    if not key:
-        reply = f"{provider_name} API key is missing. Set {p['key_env']} in Render → Environment."
+    if reply is None and jobs.enabled():
+        return _job_accepted(request, turn, is_ajax)
+    if reply is None:
+        try:
+            reply = _final_reply([_generate(turn, request, budget)], None, budget)
+            _remember_reply(turn, reply, budget)
+        except UpstreamError as e:
+            reply = str(e)
+        except Exception:
+            logger.exception("submit_chat failed (provider=%s)", turn["provider"])
+            reply = CONNECT_ERROR_REPLY
+
+    _append_current_message(request, "assistant", reply)
+
+    if is_ajax:
+        return JsonResponse({"reply_html": _reply_html(reply)})
+    return redirect("chatbot:chatbot_home")
+
+def submit_chat_stream(request):
+    """Like submit_chat, but streams reply deltas as server-sent events.
+
+    Events: ``delta`` ({"text", "upto", "html"}), then ``done`` ({"reply_html"}) or ``error``.
+    The assembled reply is stored once the stream finishes.
+    """
+    if request.method != "POST":
+        return redirect("chatbot:chatbot_home")
+
+    payload = _read_chat_payload(request)
+    if not payload["message"]:
+        return JsonResponse({"error": "Please enter a message."}, status=400)
+    budget = deadlines.budget_for(request, _owner(request), payload)
+    limited = _rate_limited(request, payload)
+    if limited is not None:
+        return limited
+
+    turn = _start_turn(request, payload)
+    cached = None if turn["error"] else _cached_reply(turn)
+    if cached is None and turn["error"] is None and jobs.enabled():
+        return _job_accepted(request, turn, True)
+
+    def event_stream():
+        parts = []
+        renderer = rendering.StreamRenderer()
+        error = turn["error"]
+        if cached is not None:
+            parts.append(cached)
+            yield _delta_event(renderer, cached)
+        elif error is None:
+            try:
+                stream = _generate_stream(turn, request, budget)
+                try:
+                    for delta in stream:
+                        parts.append(delta)
+                        yield _delta_event(renderer, delta)
+                finally:
+                    stream.close()
+            except UpstreamError as e:
+                error = str(e)
+            except GeneratorExit:
+                # The client went away mid-reply (the upstream stream is closed by now)
+                _append_current_message(request, "assistant", _final_reply(parts, routing.STOPPED_REPLY))
+                raise
+            except Exception:
+                logger.exception("submit_chat_stream failed (provider=%s)", turn["provider"])
+                error = CONNECT_ERROR_REPLY
+
+        reply = _final_reply(parts, error, budget)
+        if error is None and cached is None:
+            _remember_reply(turn, reply, budget)
         _append_current_message(request, "assistant", reply)
+        yield _sse("error" if error else "done", {"reply_html": _reply_html(reply)})
+
+    return _event_stream_response(event_stream())
+
+def cancel_chat(request):
+    """Stop the reply to ``request_id`` (sent with the message by the page), in whichever worker runs it."""
+    if request.method != "POST":
+        return JsonResponse({"error": "POST a request_id to stop."}, status=405)
+    try:
+        payload = json.loads(request.body.decode("utf-8")) if request.body else {}
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict) or not payload:
+        payload = request.POST.dict()
+    request_id = str(payload.get("request_id") or "")[:64]
+    if not request_id:
+        return JsonResponse({"error": "Missing request_id."}, status=400)
+    deadlines.cancel(_owner(request), request_id)
+    return JsonResponse({"stopped": request_id})
+
+# ---------- Async (ASGI) variants ----------
+# Same contract as the views above; upstream calls share one httpx.AsyncClient
+# per provider, so a uvicorn worker can hold many in-flight generations.
+async def submit_chat_async(request):
+    if request.method != "POST":
+        return redirect("chatbot:chatbot_home")
+
+    is_ajax = request.headers.get("x-requested-with") == "XMLHttpRequest"
+    payload = _read_chat_payload(request)
+    budget = deadlines.budget_for(request, await sync_to_async(_owner)(request), payload)
+
+    if not payload["message"]:
+        msg = "Please enter a message."
+        await sync_to_async(_append_current_message)(request, "assistant", msg)
         if is_ajax:
-            return JsonResponse({"reply_html": escape(reply).replace("\n", "<br>")})
+            return JsonResponse({"error": msg}, status=400)
         return redirect("chatbot:chatbot_home")
 
-    model = (os.environ.get("LLM_MODEL") or p["default_model"]).strip()
+    limited = await _arate_limited(request, payload)
+    if limited is not None:
+        return limited
 
-    transcript = convo["messages"][-20:]
-    messages_payload = [{"role": "system", "content": "You are a helpful coding mentor."}] + transcript
+    turn = await sync_to_async(_start_turn)(request, payload)
+    reply = turn["error"] or await sync_to_async(_cached_reply)(turn)
 
-    if provider_name == "gemini":
-        base = PROVIDERS["gemini"]["url"].format(model=model)
-        api_key = _get_api_key(PROVIDERS["gemini"]["key_env"])
-        url = f"{base}?key={api_key}"
-        headers = {"Content-Type": "application/json"}
-        payload = {"contents": _to_gemini_contents(messages_payload)}
-    else:
-        url = PROVIDERS[provider_name]["url"]
-        headers = PROVIDERS[provider_name]["headers"](_get_api_key(PROVIDERS[provider_name]["key_env"]), request)
-        headers["Content-Type"] = "application/json"
-        payload = {"model": model, "messages": messages_payload}
+    if reply is None and jobs.enabled():
+        return await sync_to_async(_job_accepted)(request, turn, is_ajax)
+    if reply is None:
+        try:
+            reply = _final_reply([await _agenerate(turn, request, budget)], None, budget)
+            await sync_to_async(_remember_reply)(turn, reply, budget)
+        except UpstreamError as e:
+            reply = str(e)
+        except Exception:
+            logger.exception("submit_chat_async failed (provider=%s)", turn["provider"])
+            reply = CONNECT_ERROR_REPLY
 
-    try:
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
-
-        if r.status_code in (401, 403):
-            reply = f"{provider_name} rejected the key (HTTP {r.status_code}). Verify the key and referer/domain settings."
-        elif r.status_code == 402:
-            reply = f"{provider_name} returned 402 (billing required)."
-        elif r.status_code >= 400:
-            body = r.text[:1200]
-            logger.error("%s error %s: %s", provider_name, r.status_code, body)
-            try:
-                j = r.json()
-                msg = (j.get("error") or {}).get("message") or j.get("message") or body
-            except Exception:
-                msg = body
-            reply = f"Upstream error {r.status_code}: {msg}"
-        else:
-            data = r.json()
-            if provider_name == "gemini":
-                reply = _parse_gemini_reply(data).strip() or "The model returned an empty reply."
-            else:
-                choice0 = (data.get("choices") or [{}])[0]
-                reply = (choice0.get("message") or {}).get("content") or choice0.get("text") or ""
-                reply = (reply or "").strip() or "The model returned an empty reply."
-
-    except requests.Timeout:
-        reply = "The model request timed out. Please try again."
-    except Exception:
-        logger.exception("submit_chat failed (provider=%s)", provider_name)
-        reply = "Unexpected error contacting model. Please try again."
+    await sync_to_async(_append_current_message)(request, "assistant", reply)
 
-    _append_current_message(request, "assistant", reply)
+    if is_ajax:
+        return JsonResponse({"reply_html": await sync_to_async(_reply_html)(reply)})
+    return redirect("chatbot:chatbot_home")
+
+async def submit_chat_stream_async(request):
+    if request.method != "POST":
+        return redirect("chatbot:chatbot_home")
 
+    payload = _read_chat_payload(request)
+    if not payload["message"]:
+        return JsonResponse({"error": "Please enter a message."}, status=400)
+    budget = deadlines.budget_for(request, await sync_to_async(_owner)(request), payload)
+    limited = await _arate_limited(request, payload)
+    if limited is not None:
+        return limited
+
+    turn = await sync_to_async(_start_turn)(request, payload)
+    cached = None if turn["error"] else await sync_to_async(_cached_reply)(turn)
+    if cached is None and turn["error"] is None and jobs.enabled():
+        return await sync_to_async(_job_accepted)(request, turn, True)
+
+    async def event_stream():
+        parts = []
+        renderer = rendering.StreamRenderer()
+        error = turn["error"]
+        if cached is not None:
+            parts.append(cached)
+            yield _delta_event(renderer, cached)
+        elif error is None:
+            try:
+                stream = await _agenerate_stream(turn, request, budget)
+                try:
+                    async for delta in stream:
+                        parts.append(delta)
+                        yield _delta_event(renderer, delta)
+                finally:
+                    await stream.aclose()
+            except UpstreamError as e:
+                error = str(e)
+            except asyncio.CancelledError:
+                # Django cancels the response when the client disconnects
+                reply = _final_reply(parts, routing.STOPPED_REPLY)
+                await sync_to_async(_append_current_message)(request, "assistant", reply)
+                raise
+            except Exception:
+                logger.exception("submit_chat_stream_async failed (provider=%s)", turn["provider"])
+                error = CONNECT_ERROR_REPLY
+
+        reply = _final_reply(parts, error, budget)
+        if error is None and cached is None:
+            await sync_to_async(_remember_reply)(turn, reply, budget)
+        await sync_to_async(_append_current_message)(request, "assistant", reply)
+        yield _sse("error" if error else "done", {"reply_html": await sync_to_async(_reply_html)(reply)})
+
+    return _event_stream_response(event_stream())
+
+# ---------- Queued generations (LLM_JOB_QUEUE) ----------
+def _job_urls(job) -> dict:
+    return {
+        "status_url": reverse("chatbot:chatbot_job", args=[job.pk]),
+        "events_url": reverse("chatbot:chatbot_job_events", args=[job.pk]),
+    }
+
+def _job_accepted(request, turn, is_ajax):
+    """Enqueue the turn's generation; 202 with the job's URLs (or back to the page)."""
+    job = jobs.enqueue(_current_convo(request), turn)
     if is_ajax:
-        return JsonResponse({"reply_html": escape(reply).replace("\n", "<br>")})
+        return JsonResponse({"job_id": job.pk, "status": job.status, **_job_urls(job)}, status=202)
     return redirect("chatbot:chatbot_home")
+
+def _job_result(job) -> dict:
+    data = {"job_id": job.pk, "status": job.status}
+    if job.finished:
+        data["reply_html"] = _reply_html(job.reply)
+    else:
+        data["partial"] = jobs.partial_text(job.pk)
+    return data
+
+def job_status(request, job_id: str):
+    """Job state as JSON; ``?wait=N`` long-polls up to N (<= LLM_JOB_WAIT) seconds for the result."""
+    job = jobs.get_owned(job_id, _owner(request))
+    if job is None:
+        return JsonResponse({"error": "Unknown job."}, status=404)
+    try:
+        wait = min(float(request.GET.get("wait") or 0), getattr(settings, "LLM_JOB_WAIT", 25.0))
+    except ValueError:
+        wait = 0.0
+    if wait > 0 and not job.finished:
+        jobs.wait(job, wait)
+    return JsonResponse(_job_result(job))
+
+def job_events(request, job_id: str):
+    """Server-sent events for a job: ``delta`` (as in ask/stream/) while partial text
+    arrives, then ``done`` or ``error`` ({"reply_html"}). A stream lasts at most
+    LLM_JOB_WAIT seconds (below the web worker timeout) and then ends with
+    ``pending``; clients reconnect and get the partial text so far again."""
+    job = jobs.get_owned(job_id, _owner(request))
+    if job is None:
+        return JsonResponse({"error": "Unknown job."}, status=404)
+
+    def event_stream():
+        sent = ""
+        renderer = rendering.StreamRenderer()
+        deadline = time.monotonic() + min(jobs.lease_seconds(job), getattr(settings, "LLM_JOB_WAIT", 25.0))
+        checked = 0.0
+        while time.monotonic() < deadline:
+            partial = jobs.partial_text(job.pk)
+            if len(partial) > len(sent) and partial.startswith(sent):
+                yield _delta_event(renderer, partial[len(sent):])
+                sent = partial
+            if time.monotonic() - checked >= 1.0:
+                checked = time.monotonic()
+                job.refresh_from_db(fields=["status", "reply", "error", "finished_at"])
+                if job.finished:
+                    yield _sse("error" if job.status == Job.FAILED else "done", {"reply_html": _reply_html(job.reply)})
+                    return
+                yield ": waiting\n\n"
+            time.sleep(jobs.PARTIAL_INTERVAL)
+        yield _sse("pending", _job_urls(job))
+
+    return _event_stream_response(event_stream())
@@ -0,0 +1,18 @@
+# gunicorn.conf.py (picked up automatically from the working directory)
+import os
+import shutil
+
+
+def on_starting(server):
+    # Multiprocess Prometheus metrics: start each deploy from an empty directory
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from chatbot.metrics import mark_process_dead
+
+        mark_process_dead(worker.pid)